@@ -1,35 +1,82 @@
+import collections
+import hashlib
 import json
+import threading
 import falcon
 import control
 import requests
 import urllib
+from time import monotonic
 
 class Inputs(object):
     def __init__(self, input1, input2, output_pipeline):
         self.input1_pipeline = input1
         self.input2_pipeline = input2
         self.output_pipeline = output_pipeline
-        self.active_input = self.output_pipeline.get_property(self.output_pipeline.name, 'listen-to')
+        self.active_input = self.output_pipeline.get_property(self.output_pipeline.element("interpipesrc"), 'listen-to')
+        # The InputSupervisor watching the inputs, set once it's been started.
+        self.supervisor = None
+        self.lock = threading.Lock()
 
-    def as_json(self):
+    def as_dict(self):
         which = self.active_input
-        nice_name = self.input1_pipeline.nice_name if which == self.input1_pipeline.name else self.input2_pipeline.nice_name
-        j = {"active_input": which, "nice_name": nice_name, "total_inputs": 2}
-        return json.dumps(j, ensure_ascii=False)
+        if which.startswith("standby"):
+            nice_name = "Standby"
+        else:
+            nice_name = self.input1_pipeline.nice_name if which == self.input1_pipeline.name else self.input2_pipeline.nice_name
+        res = {"active_input": which, "nice_name": nice_name, "total_inputs": 2}
+        if self.supervisor is not None:
+            res["health"] = self.supervisor.as_dict()
+        return res
+
+    def as_json(self):
+        return json.dumps(self.as_dict(), ensure_ascii=False)
+
+    def can_switch_to(self, inp):
+        """
+        Inputs that have failed and haven't been rebuilt yet would stop the stream, so they can't be switched to.
+        """
+        if self.supervisor is not None and not self.supervisor.healthy(inp):
+            print(f"Input {inp} has failed, not switching to it.")
+            return False
+        return True
+
+    @property
+    def switch_lock(self):
+        """
+        The supervisor's switch lock once there is one, so a manual switch can't interleave with it switching away from a failed input.
+        """
+        if self.supervisor is not None:
+            return self.supervisor.switch_lock
+        return self.lock
+
+    def switch_to(self, inp):
+        """
+        Check inp can be switched to, and switch output1 to it, with nothing else switching in between.
+        """
+        if not self.can_switch_to(inp):
+            return False
+        self.active_input = inp
+        self.output_pipeline.switch_src(inp)
+        return True
 
     def swap_inputs(self):
-        if self.active_input == self.input1_pipeline.name:
-            swap_to = "input2"
-        else:
-            swap_to = "input1"
-        self.active_input = swap_to
-        self.output_pipeline.switch_src(swap_to)
+        with self.switch_lock:
+            if self.active_input == self.input1_pipeline.name:
+                swap_to = "input2"
+            else:
+                swap_to = "input1"
+            if not self.switch_to(swap_to):
+                return False
         print("inputs swapped")
+        return True
 
     def activate_input(self, inp):
-        self.active_input = inp
-        self.output_pipeline.switch_src(inp)
+        with self.switch_lock:
+            if not self.switch_to(inp):
+                return False
         print(f"Input activated: {inp}")
+        return True
 
     def on_get(self, req, res, input_name=''):
         res.body = self.as_json()
@@ -37,22 +84,25 @@ class Inputs(object):
 
     def on_post(self, req, res, input_name=''):
         err = False
+        switched = True
         if input_name == "swap":
-            self.swap_inputs()
+            switched = self.swap_inputs()
         elif input_name == "input1":
-            self.activate_input(input_name)
+            switched = self.activate_input(input_name)
         elif input_name == "input2":
-            self.activate_input(input_name)
+            switched = self.activate_input(input_name)
         elif input_name == '':
             pass
         else:
             err = True
 
         res.body = self.as_json()
-        if not err:
-            res.status = falcon.HTTP_200
-        else:
+        if err:
             res.status = falcon.HTTP_404
+        elif not switched:
+            res.status = falcon.HTTP_409
+        else:
+            res.status = falcon.HTTP_200
 
 class Outputs(object):
     def __init__(self, output_pipeline):
@@ -61,40 +111,65 @@ class Outputs(object):
         self.target_bitrate = self.output_pipeline.bitrate
         self.current_bitrate = self.target_bitrate
         self.bitrate_locked = False
+        self.last_state = None
+        # The BitrateWatcherThread controlling this output, set once it's been started.
+        self.bitrate_watcher = None
 
     @property
     def state(self):
         return self.output_pipeline.state
 
-    def as_json(self):
-        j = {
+    def as_dict(self, refresh=True):
+        """
+        Args:
+            refresh (bool, optional): Read the pipeline state from gstd. If False, use the last one read. Defaults to True.
+        """
+        if refresh or self.last_state is None:
+            self.last_state = self.state
+        return {
             "current_bitrate": self.current_bitrate,
             "bitrate_steps": self.bitrate_steps,
-            "state": self.state,
+            "state": self.last_state,
         }
-        return json.dumps(j, ensure_ascii=False)
+
+    def as_json(self):
+        return json.dumps(self.as_dict(), ensure_ascii=False)
 
     def on_get(self, req, res):
         res.body = self.as_json()
         res.status = falcon.HTTP_200
 
+    def on_get_rate_control(self, req, res):
+        """
+        The bitrate watcher's counters and CPU use.
+        """
+        if self.bitrate_watcher is None:
+            res.body = json.dumps({"error": "bitrate watcher not running"}, ensure_ascii=False)
+            res.status = falcon.HTTP_503
+            return
+        stats = self.bitrate_watcher.stats()
+        stats["locked"] = self.bitrate_locked
+        stats["current_bitrate"] = self.current_bitrate
+        res.body = json.dumps(stats, ensure_ascii=False)
+        res.status = falcon.HTTP_200
+
     def on_post(self, req, res, bitrate=None):
         """
         Bitrate could be a numeric value, but "reset", "inc" and "dec" are also supported.
         """
         post_contents = req.bounded_stream.read()
 
-        bitrate_idx = self.bitrate_steps.index(self.current_bitrate)
+        # The rate controller can leave the bitrate between steps, so inc/dec go to the next step above/below it.
         if bitrate == "reset":
             self.current_bitrate = self.target_bitrate
             self.bitrate_locked = False
         elif bitrate == "dec":
-            new_idx = max(0, min(bitrate_idx + 1, len(self.bitrate_steps) - 1))
-            self.current_bitrate = self.bitrate_steps[new_idx]
+            lower = [x for x in self.bitrate_steps if x < self.current_bitrate]
+            self.current_bitrate = max(lower) if lower else min(self.bitrate_steps)
             self.bitrate_locked = True
         elif bitrate == "inc":
-            new_idx = max(0, min(bitrate_idx - 1, len(self.bitrate_steps) - 1))
-            self.current_bitrate = self.bitrate_steps[new_idx]
+            higher = [x for x in self.bitrate_steps if x > self.current_bitrate]
+            self.current_bitrate = min(higher) if higher else max(self.bitrate_steps)
             self.bitrate_locked = True
         else:
             try:
@@ -117,7 +192,7 @@ class SRT(object):
         self.stats = {"flow": 0, "flight": 0, "rtt": 0, "send_dropped": 0, "bitrate": 0.0}
         self.srt_message = ''
 
-    def on_get(self, req, res):
+    def as_dict(self):
         srt_stats = self.srt_output.last_stats
         self.srt_message = self.srt_output.last_message
         try:
@@ -132,13 +207,14 @@ class SRT(object):
             # Sometimes the stats are blank, so we'll just send the 0'd json.
             pass
         censored_url = self.censor_url()
-        doc = {
-            "stats": self.stats,
+        return {
+            "stats": dict(self.stats),
             "output": censored_url,
             "message": str(self.srt_message)
         }
 
-        res.body = json.dumps(doc, ensure_ascii=False)
+    def on_get(self, req, res):
+        res.body = json.dumps(self.as_dict(), ensure_ascii=False)
         res.status = falcon.HTTP_200
 
     def censor_url(self, raw_url=None, mode="partial"):
@@ -176,24 +252,41 @@ class SRT(object):
         return new_url
 
 class SRTLA(object):
-    def __init__(self, srtla):
+    def __init__(self, srtla, link_manager=None):
         self.srtla_output = srtla
-        self.ip_addrs = self.get_ips()
+        self.link_manager = link_manager
 
     def get_ips(self):
+        # Read every time, as the link manager rewrites it when the links change.
         with open(self.srtla_output.ip_file, 'r') as f:
             raw = f.readlines()
-        print(raw)
         return [str(x.strip()) for x in raw]
 
 
     def on_get(self, req, res):
         doc = {
-            "ip_list": self.ip_addrs
+            "ip_list": self.get_ips(),
+            "srtla_restarts": self.srtla_output.restarts,
         }
+        if self.link_manager is not None:
+            doc["link_manager"] = self.link_manager.stats()
+        if self.srtla_output.telemetry is not None:
+            doc.update(self.srtla_output.telemetry.as_dict())
         res.body = json.dumps(doc, ensure_ascii=False)
         res.status = falcon.HTTP_200
 
+    def on_get_link(self, req, res, ip):
+        """
+        The rate history for one link.
+        """
+        telemetry = self.srtla_output.telemetry
+        if telemetry is None or ip not in telemetry.links:
+            res.body = json.dumps({"error": f"no link {ip}"}, ensure_ascii=False)
+            res.status = falcon.HTTP_404
+            return
+        res.body = json.dumps({"ip": ip, "series": telemetry.series(ip)}, ensure_ascii=False)
+        res.status = falcon.HTTP_200
+
 
 class StreamOutput(object):
     def __init__(self, output_pipeline):
@@ -243,21 +336,202 @@ class StreamControls(object):
 class AudioControls(object):
     def __init__(self, output_pipe):
         self.output_pipe = output_pipe
+        self.active_audio = None
+
+    def as_dict(self, refresh=True):
+        """
+        Args:
+            refresh (bool, optional): Read the active audio input from gstd. If False, use the last one read. Defaults to True.
+        """
+        if refresh or self.active_audio is None:
+            self.active_audio = self.output_pipe.get_property(self.output_pipe.element("audio_interpipesrc"), "listen-to")
+        return {"active": self.active_audio, "muted": self.output_pipe.audio_mute, "total_inputs": 2}
 
     def on_get(self, req, res):
-        active_audio = self.output_pipe.get_property("output1-audio", "listen-to")
-        res.body = json.dumps({"active": active_audio, "muted": self.output_pipe.audio_mute, "total_inputs": 2}, ensure_ascii=False)
+        res.body = json.dumps(self.as_dict(), ensure_ascii=False)
         res.status = falcon.HTTP_200
 
     def on_post_mute(self, req, res):
         self.output_pipe.toggle_audio_mute()
-        active_audio = self.output_pipe.get_property("output1-audio", "listen-to")
+        active_audio = self.output_pipe.get_property(self.output_pipe.element("audio_interpipesrc"), "listen-to")
         res.body = json.dumps({"active": active_audio, "muted": self.output_pipe.audio_mute, "total_inputs": 2}, ensure_ascii=False)
         res.status = falcon.HTTP_200
 
     def on_post_name(self, req, res, input_name):
         print(f"Switch to input {input_name}.")
         self.output_pipe.switch_audio_src(input_name)
-        active_audio = self.output_pipe.get_property("output1-audio", "listen-to")
+        active_audio = self.output_pipe.get_property(self.output_pipe.element("audio_interpipesrc"), "listen-to")
         res.body = json.dumps({"active": active_audio, "muted": self.output_pipe.audio_mute, "total_inputs": 2}, ensure_ascii=False)
         res.status = falcon.HTTP_200
+
+
+class Dashboard(object):
+    """
+    Everything the web interface shows, in one response.
+    The snapshot is rebuilt by a background thread, so requests never wait on gstd or the network.
+    Responses have an ETag, and a poll with a matching If-None-Match gets an empty 304.
+    It's also middleware, so that any POST triggers an update straight away.
+
+    /dashboard/events streams it as Server-Sent Events instead: the full snapshot on connect, then only the parts that changed.
+    New SRT stats trigger an update, so changes are pushed as they happen, but never more often than every push_interval.
+    Anything that needs gstd (pipeline state, active audio) is only read every update_interval, or after a POST.
+    """
+    def __init__(self, srt, inputs, outputs, audio, stream_remote, update_interval=1.0, push_interval=0.2, max_subscribers=4, keepalive=15.0):
+        # Each takes refresh, and only talks to gstd if it's True.
+        self.sources = {
+            "srt": lambda refresh: srt.as_dict(),
+            "outputs": outputs.as_dict,
+            "inputs": lambda refresh: inputs.as_dict(),
+            "audio": audio.as_dict,
+            "stream": lambda refresh: self.stream_status(stream_remote),
+        }
+        self.update_interval = update_interval
+        self.push_interval = push_interval
+        self.max_subscribers = max_subscribers
+        self.keepalive = keepalive
+        self.snapshot = {}
+        self.body = json.dumps(self.snapshot, ensure_ascii=False)
+        self.etag = hashlib.sha1(self.body.encode("utf-8")).hexdigest()[:16]
+        self.errors = {}
+        # version counts snapshots, and deltas has what changed in the most recent ones, for subscribers that are a little behind.
+        self.version = 0
+        self.deltas = collections.deque(maxlen=32)
+        self.changed = threading.Condition()
+        self.subscribers = 0
+        self.event = threading.Event()
+        self.wakeup = threading.Event()
+        self.force_refresh = False
+        self.updater = threading.Thread(target=self.update_loop, name="Dashboard", daemon=True)
+        srt.srt_output.add_update_listener(self.wakeup.set)
+
+    def start(self):
+        self.updater.start()
+
+    def stop(self):
+        self.event.set()
+        self.wakeup.set()
+        with self.changed:
+            self.changed.notify_all()
+
+    @staticmethod
+    def stream_status(stream_remote):
+        status = stream_remote.get_status()
+        # The age changes every time, which would change the ETag every time.
+        status["remote"] = {k: v for k, v in status.get("remote", {}).items() if k != "age"}
+        return status
+
+    def update(self, refresh=True):
+        """
+        Rebuild the snapshot. If part of it can't be read, the previous value of that part is kept.
+        Args:
+            refresh (bool, optional): Also update the parts that need gstd. Defaults to True.
+        """
+        snapshot = dict(self.snapshot)
+        for name, source in self.sources.items():
+            try:
+                snapshot[name] = source(refresh)
+                self.errors.pop(name, None)
+            except Exception as e:
+                if name not in self.errors:
+                    print(f"Dashboard: {name} update failed: {e}")
+                self.errors[name] = str(e)
+        delta = {k: v for k, v in snapshot.items() if self.snapshot.get(k) != v}
+        if not delta:
+            return
+        body = json.dumps(snapshot, ensure_ascii=False, sort_keys=True)
+        with self.changed:
+            # Swapped together, so a request never sees the body of one snapshot with the ETag of another.
+            self.snapshot, self.body, self.etag = snapshot, body, hashlib.sha1(body.encode("utf-8")).hexdigest()[:16]
+            self.version += 1
+            self.deltas.append((self.version, delta))
+            self.changed.notify_all()
+
+    def update_loop(self):
+        next_refresh = 0
+        while not self.event.is_set():
+            self.wakeup.clear()
+            now = monotonic()
+            refresh = self.force_refresh or now >= next_refresh
+            self.force_refresh = False
+            self.update(refresh)
+            if refresh:
+                next_refresh = now + self.update_interval
+            # Coalesce: however many stats arrive, update at most once per push_interval.
+            self.event.wait(self.push_interval)
+            self.wakeup.wait(max(next_refresh - monotonic(), 0))
+
+    def process_response(self, req, res, resource, req_succeeded):
+        """
+        Middleware hook. Anything POSTed has probably changed something, so rebuild the snapshot now instead of on the next interval.
+        """
+        if req.method == "POST" and req_succeeded:
+            self.force_refresh = True
+            self.wakeup.set()
+
+    def on_get(self, req, res):
+        body, etag = self.body, self.etag
+        res.set_header("ETag", f'"{etag}"')
+        res.set_header("Cache-Control", "no-cache")
+        if req.get_header("If-None-Match") == f'"{etag}"':
+            res.status = falcon.HTTP_304
+            return
+        res.body = body
+        res.status = falcon.HTTP_200
+
+    def deltas_since(self, version):
+        """
+        Merge everything that changed after version into one delta. Call with self.changed held.
+        Returns:
+            dict: The merged delta, or None if version is too old to build one from the kept deltas.
+        """
+        if not self.deltas or self.deltas[0][0] > version + 1:
+            return None
+        merged = {}
+        for v, delta in self.deltas:
+            if v > version:
+                merged.update(delta)
+        return merged
+
+    def sse(self, event, data, version=None):
+        msg = f"event: {event}\n"
+        if version is not None:
+            msg += f"id: {version}\n"
+        msg += f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+        return msg.encode("utf-8")
+
+    def event_stream(self):
+        with self.changed:
+            # Counted here, not in on_get_events(), so that it's only undone once the stream has actually started.
+            self.subscribers += 1
+            version, snapshot = self.version, self.snapshot
+        try:
+            yield self.sse("snapshot", snapshot, version)
+            while not self.event.is_set():
+                with self.changed:
+                    if not self.changed.wait_for(lambda: self.version != version or self.event.is_set(), self.keepalive):
+                        msg = b": keepalive\n\n"
+                    else:
+                        delta = self.deltas_since(version)
+                        version = self.version
+                        if delta is None:
+                            msg = self.sse("snapshot", self.snapshot, version)
+                        else:
+                            msg = self.sse("delta", delta, version)
+                yield msg
+        finally:
+            with self.changed:
+                self.subscribers -= 1
+
+    def on_get_events(self, req, res):
+        with self.changed:
+            full = self.subscribers >= self.max_subscribers
+        if full:
+            # Each subscriber holds a server thread for as long as it's connected.
+            res.body = json.dumps({"error": "too many subscribers"}, ensure_ascii=False)
+            res.status = falcon.HTTP_503
+            return
+        res.content_type = "text/event-stream"
+        res.set_header("Cache-Control", "no-cache")
+        res.set_header("X-Accel-Buffering", "no")
+        res.stream = self.event_stream()
+        res.status = falcon.HTTP_200
@@ -8,11 +8,17 @@ from api import Outputs
 from api import StreamControls
 from api import AudioControls
 from api import StreamOutput
+from api import Dashboard
 from time import sleep
 
 from srt_stats import SRTThread, SRTLAThread
+from srtla_telemetry import SRTLATelemetry
+from link_manager import LinkManager
+from device_registry import DeviceRegistry
+from input_supervisor import InputSupervisor
 from helpers import srtla_ip_setup
 import control
+from startup import Startup, StartupApp
 
 
 class StaticResource(object):
@@ -27,53 +33,156 @@ class StaticResource(object):
         with open(fn, 'r') as f:
             resp.body = f.read()
 
-api = application = falcon.API()
-
-pipelines, pipelines_meta, srt_passphrase = control.setup()
-
-srt_watcher_thread = SRTThread(passphrase=srt_passphrase, srt_destination="srt://localhost:6000?mode=caller")
-srt_watcher_thread.daemon = True
-srt_watcher_thread.start()
-
-srt_protocol, srt_hostname, srt_port = re.split('://|:', pipelines["output1"].url)
-
-srtla_ips_path, srtla_ip_addrs = srtla_ip_setup()
-print("srtla ips:", srtla_ips_path)
-
-control.setup_source_routing(srtla_ip_addrs.keys(), debug=True)
-control.set_clocks(debug=True)
-
-srtla_thread = SRTLAThread(srtla_send="/home/bob/git/srtla/srtla_send", destination_host=srt_hostname, destination_port=srt_port, ip_file=srtla_ips_path)
-srtla_thread.daemon = True
-srtla_thread.start()
-
-srt_stats = SRT(srt=srt_watcher_thread)
-srtla_stats = SRTLA(srtla=srtla_thread)
-input_status = Inputs(pipelines["input1"], pipelines["input2"], pipelines["output1"])
-output_status = Outputs(pipelines["output1"])
-remote_controls = control.StreamRemoteControl()
-stream_controls = StreamControls(remote_controls)
-audio_controls = AudioControls(pipelines["output1"])
-output_controls = StreamOutput(pipelines["output1"])
-
-bitrate_watcher_thread = control.BitrateWatcherThread(output_status, srt_watcher_thread)
-bitrate_watcher_thread.daemon = True
-bitrate_watcher_thread.start()
-
-api.add_static_route("/static", path.join(getcwd(), "frontend"), fallback_filename='index.html')
-api.add_route("/srt-stats", srt_stats)
-api.add_route("/srtla-stats", srtla_stats)
-api.add_route("/inputs/{input_name}", input_status)
-api.add_route("/inputs", input_status)
-api.add_route("/outputs/play", output_controls, suffix="play")
-api.add_route("/outputs/pause", output_controls, suffix="pause")
-api.add_route("/outputs", output_status)
-api.add_route("/outputs/encoder/{bitrate}", output_status)
-api.add_route("/stream/start", stream_controls)
-api.add_route("/stream/stop", stream_controls)
-api.add_route("/stream/brb", stream_controls)
-api.add_route("/stream/back", stream_controls)
-api.add_route("/stream/status", stream_controls)
-api.add_route("/audio/", audio_controls)
-api.add_route("/audio/mute", audio_controls, suffix="mute")
-api.add_route("/audio/{input_name}", audio_controls, suffix="name")
\ No newline at end of file
+config = control.read_config()
+srtla_config = config["srtla_config"]
+api_server_config = config["api_server"]
+
+
+def find_devices():
+    device_registry = DeviceRegistry(
+        poll_interval=api_server_config.get("device_poll_interval", 10.0),
+        settle_time=api_server_config.get("device_settle_time", 1.0),
+        debug=True,)
+    device_registry.daemon = True
+    device_registry.start()
+    return device_registry
+
+
+def set_clocks():
+    control.set_clocks(debug=True).wait()
+
+
+def setup_network():
+    srtla_ips_path, srtla_ip_addrs = srtla_ip_setup()
+    print("srtla ips:", srtla_ips_path)
+    for proc in control.setup_source_routing(srtla_ip_addrs.keys(), debug=True):
+        proc.wait()
+    return srtla_ips_path, srtla_ip_addrs
+
+
+def start_srt():
+    srt_watcher_thread = SRTThread(passphrase=config["output1"]["srt_passphrase"], srt_destination="srt://localhost:6000?mode=caller")
+    srt_watcher_thread.daemon = True
+    srt_watcher_thread.start()
+    return srt_watcher_thread
+
+
+def start_pipelines(devices):
+    pipelines, _, _ = control.setup(devices=devices.by_name())
+    return pipelines
+
+
+def start_input_supervisor(devices, pipelines):
+    standby_config = config.get("standby", {})
+    input_supervisor = InputSupervisor(
+        pipelines, config, devices=devices,
+        bus_timeout=standby_config.get("bus_timeout", 1.0),
+        rebuild_interval=standby_config.get("rebuild_interval", 2.0),
+        debug=True,)
+    input_supervisor.start()
+    return input_supervisor
+
+
+def start_srtla(network):
+    srtla_ips_path, srtla_ip_addrs = network
+    srt_protocol, srt_hostname, srt_port = re.split('://|:', config["output1"]["url"])
+    srtla_telemetry = SRTLATelemetry(
+        srtla_ip_addrs,
+        sample_interval=srtla_config.get("stats_interval", 1.0),
+        history=srtla_config.get("stats_history", 60),
+        window=srtla_config.get("stats_window", 5),)
+    srtla_thread = SRTLAThread(srtla_send="/home/bob/git/srtla/srtla_send", destination_host=srt_hostname, destination_port=srt_port, ip_file=srtla_ips_path, telemetry=srtla_telemetry)
+    srtla_thread.daemon = True
+    srtla_thread.start()
+
+    link_manager = None
+    if not srtla_config["srtla_ip_path"]:
+        # The IP file is only kept up to date if this app wrote it.
+        link_manager = LinkManager(
+            srtla_thread, srtla_ips_path, srtla_ip_addrs,
+            devices=srtla_config["srtla_devices"],
+            poll_interval=srtla_config.get("link_poll_interval", 2.0),
+            settle_time=srtla_config.get("link_settle_time", 1.0),
+            telemetry=srtla_telemetry,
+            debug=True,)
+        link_manager.daemon = True
+        link_manager.start()
+    return srtla_thread, link_manager
+
+
+def start_remote_controls():
+    remote_controls = control.StreamRemoteControl()
+    remote_controls.start()
+    return remote_controls
+
+
+def start_api(devices, pipelines, input_supervisor, srt, srtla, remote_controls):
+    """
+    Create the resources and the real falcon app, once everything they need is running.
+    """
+    srtla_thread, link_manager = srtla
+    srt_stats = SRT(srt=srt)
+    srtla_stats = SRTLA(srtla=srtla_thread, link_manager=link_manager)
+    input_status = Inputs(pipelines["input1"], pipelines["input2"], pipelines["output1"])
+    input_status.supervisor = input_supervisor
+    input_supervisor.inputs = input_status
+    output_status = Outputs(pipelines["output1"])
+    stream_controls = StreamControls(remote_controls)
+    audio_controls = AudioControls(pipelines["output1"])
+    output_controls = StreamOutput(pipelines["output1"])
+
+    bitrate_watcher_thread = control.BitrateWatcherThread(output_status, srt)
+    bitrate_watcher_thread.daemon = True
+    bitrate_watcher_thread.start()
+    output_status.bitrate_watcher = bitrate_watcher_thread
+
+    dashboard = Dashboard(
+        srt_stats, input_status, output_status, audio_controls, remote_controls,
+        update_interval=api_server_config.get("dashboard_interval", 1.0),
+        push_interval=api_server_config.get("push_interval", 0.2),
+        max_subscribers=api_server_config.get("max_subscribers", 4),)
+    dashboard.start()
+
+    api = falcon.API(middleware=[dashboard])
+
+    api.add_static_route("/static", path.join(getcwd(), "frontend"), fallback_filename='index.html')
+    api.add_route("/srt-stats", srt_stats)
+    api.add_route("/srtla-stats", srtla_stats)
+    api.add_route("/srtla-stats/{ip}", srtla_stats, suffix="link")
+    api.add_route("/inputs/{input_name}", input_status)
+    api.add_route("/inputs", input_status)
+    api.add_route("/outputs/play", output_controls, suffix="play")
+    api.add_route("/outputs/pause", output_controls, suffix="pause")
+    api.add_route("/outputs", output_status)
+    api.add_route("/outputs/rate-control", output_status, suffix="rate_control")
+    api.add_route("/outputs/encoder/{bitrate}", output_status)
+    api.add_route("/stream/start", stream_controls)
+    api.add_route("/stream/stop", stream_controls)
+    api.add_route("/stream/brb", stream_controls)
+    api.add_route("/stream/back", stream_controls)
+    api.add_route("/stream/status", stream_controls)
+    api.add_route("/audio/", audio_controls)
+    api.add_route("/audio/mute", audio_controls, suffix="mute")
+    api.add_route("/audio/{input_name}", audio_controls, suffix="name")
+    api.add_route("/dashboard", dashboard)
+    api.add_route("/dashboard/events", dashboard, suffix="events")
+    api.add_route("/devices", devices)
+    api.add_route("/health", startup)
+    application.ready(api)
+    return api
+
+
+# Nothing here waits on anything else it doesn't need, and gunicorn can answer /health while it runs.
+startup = Startup(max_workers=api_server_config.get("startup_workers", 4), debug=True)
+startup.add("devices", find_devices)
+startup.add("clocks", set_clocks)
+startup.add("network", setup_network)
+startup.add("srt", start_srt)
+startup.add("remote_controls", start_remote_controls)
+startup.add("pipelines", start_pipelines, after=["devices"])
+startup.add("input_supervisor", start_input_supervisor, after=["devices", "pipelines"])
+startup.add("srtla", start_srtla, after=["network"])
+startup.add("api", start_api, after=["devices", "pipelines", "input_supervisor", "srt", "srtla", "remote_controls"])
+
+application = StartupApp(startup)
+startup.start()
@@ -5,42 +5,31 @@ import toml
 import pprint
 import re
 import threading
+import random
 import requests
-import alsaaudio
+import requests.adapters
 
 import gstd_streaming as gstds
+import rate_control
+import device_registry
+from gstd_client import PersistentGstdClient
 from pygstc.gstc import *
 from collections import namedtuple
-from time import sleep
+from time import monotonic, sleep, thread_time
 from datetime import datetime
 import subprocess
 
 def find_devices():
     """
     Used to determine the device node of the different devices, and the alsa devices for the audio.
+    This is a one off scan, DeviceRegistry keeps the same thing up to date as devices are plugged in and out.
     Returns:
         Dictionary, with the being the name of the device, and the value a list of ["/dev/videoX", "usb-id", "alsa-index"].
             This is the device node, the USB-id and the related alsa audio device index.
     """
-    res = subprocess.run(
-        ["v4l2-ctl", "--list-devices"], stdout=subprocess.PIPE, universal_newlines=True
-    )
-    # output has the form:
-    # 'Cam Link 4K (usb-70090000.xusb-1.4):'
-    # '   /dev/video0'
-    cleaned = [x for x in res.stdout.split("\n") if x != ""]
-    audio_devices = {x: alsaaudio.card_name(x) for x in alsaaudio.card_indexes()}
-    devices = {}
-    for idx in range(0, len(cleaned), 2):
-        dev = cleaned[idx + 1][1:]
-        name, usb = cleaned[idx][:-2].split(" (usb-")
-        usb = "usb-" + usb
-        audio_idx = -1
-        for k, v in audio_devices.items():
-            if name in v:
-                audio_idx = k
-        devices[name] = [dev, usb, audio_idx]
-    return devices
+    devices = device_registry.scan_video()
+    device_registry.match_audio(devices, device_registry.scan_audio())
+    return {v["name"]: [v["video"], k, v["audio"]] for k, v in devices.items()}
 
 
 def read_config(config_path="config.toml"):
@@ -69,15 +58,36 @@ def parse_url(url):
     pass
 
 
-def create_pipelines(client, config, debug=False):
+# Common interpipesink options for inputs.
+INTERPIPE_SINK_OPTIONS = "sync=false async=false forward-events=true forward-eos=true"
+
+
+def input_description(name, input_config, video_dev, audio_dev):
+    """
+    The gstreamer description of an input pipeline.
+    Args:
+        name (str): Pipeline name, like "input1". Its interpipesinks are this with "-video" and "-audio" on the end.
+        input_config (dict): The input's section of the config.
+        video_dev (str): Video device node, like "/dev/video0".
+        audio_dev (int): Alsa card index.
+    Returns:
+        str: The pipeline description.
+    """
+    audio_gst = f"alsasrc device=hw:{audio_dev} ! identity name=delay signal-handoffs=TRUE"
+    return f"v4l2src device={video_dev} ! {input_config['gst']} ! interpipesink name={name}-video {INTERPIPE_SINK_OPTIONS} {audio_gst} ! interpipesink name={name}-audio"# {INTERPIPE_SINK_OPTIONS}"
+
+
+def create_pipelines(client, config, debug=False, devices=None):
     """
     Creates the pipelines as specified in the configuration TOML file, details in the readme.
     Conceptually, there are two input pipelines and one output pipeline, that uses gst-interpipe to switch between the two.
+        If the config has a [standby] section, there's also a standby test pattern pipeline, for when neither input is working.
         This output includes the encoder.
     Args:
         client (GstdClient): fstd client to use for commands.
         config (dict): Configuration file to use to create the pipelines.
         debug (bool, optional): Print debugging information. Defaults to False.
+        devices (dict, optional): Capture devices, as returned by find_devices(). Defaults to None, which looks them up.
     Returns:
         tuple(dictionary, dictionary).
             The first dictionary contains the pipelines, and the key is the pipeline name and the value is the pipeline.
@@ -92,7 +102,8 @@ def create_pipelines(client, config, debug=False):
     if "default" in input2_config.keys():
         initial_input = "input2"
 
-    devices = find_devices()
+    if devices is None:
+        devices = find_devices()
     input1_dev = [devices[x] for x in devices.keys() if input1_config['name'] in x][0][0]
     input1_audio_dev = [devices[x] for x in devices.keys() if input1_config['name'] in x][0][2]
     input2_dev = [devices[x] for x in devices.keys() if input2_config['name'] in x][0][0]
@@ -112,18 +123,12 @@ def create_pipelines(client, config, debug=False):
         print("\nOutput config:")
         pp.pprint(output_config)
 
-    # Common interpipesink options for inputs.
-    interpipe_sink_options = (
-        "sync=false async=false forward-events=true forward-eos=true"
-    )
-    input1_audio_gst = f"alsasrc device=hw:{input1_audio_dev} ! identity name=delay signal-handoffs=TRUE"
-    input1_gst = f"v4l2src device={input1_dev} ! {input1_config['gst']} ! interpipesink name=input1-video {interpipe_sink_options} {input1_audio_gst} ! interpipesink name=input1-audio"# {interpipe_sink_options}"
+    input1_gst = input_description("input1", input1_config, input1_dev, input1_audio_dev)
     if debug:
         print("input1 gst:", input1_gst)
     input1_config["full_gst"] = input1_gst
     input1 = gstds.Pipeline(gstdclient=client, name="input1", config=input1_config, debug=debug)
-    input2_audio_gst = f"alsasrc device=hw:{input2_audio_dev} ! identity name=delay signal-handoffs=TRUE"
-    input2_gst = f"v4l2src device={input2_dev} ! {input2_config['gst']} ! interpipesink name=input2-video {interpipe_sink_options} {input2_audio_gst} ! interpipesink name=input2-audio"# {interpipe_sink_options}"
+    input2_gst = input_description("input2", input2_config, input2_dev, input2_audio_dev)
     if debug:
         print("input2 gst:", input2_gst)
     input2_config["full_gst"] = input2_gst
@@ -131,6 +136,18 @@ def create_pipelines(client, config, debug=False):
 
     pipelines = {"input1": input1, "input2": input2}
 
+    if "standby" in config:
+        # Test pattern and silence, for output1 to switch to if neither input is working.
+        standby_config = config["standby"]
+        standby_gst = (
+            f"videotestsrc is-live=true pattern={standby_config.get('pattern', 'smpte')} ! {standby_config['gst']} ! interpipesink name=standby-video {INTERPIPE_SINK_OPTIONS} "
+            f"audiotestsrc is-live=true wave=silence ! interpipesink name=standby-audio"
+        )
+        if debug:
+            print("standby gst:", standby_gst)
+        standby_config["full_gst"] = standby_gst
+        pipelines["standby"] = gstds.Pipeline(gstdclient=client, name="standby", config=standby_config, debug=debug)
+
     output1_inter = (
         f"interpipesrc format=time listen-to={initial_input}-video block=true name=output1 stream-sync=1"
     )
@@ -171,19 +188,20 @@ def stop_pipelines(pipelines):
         print(f"[{datetime.now()}] Attempting to cleanup {p.name}.")
         p.cleanup()
 
-def setup():
+def setup(devices=None):
     """
     Convenience function to set everything up.
+    Args:
+        devices (dict, optional): Capture devices, as returned by find_devices(). Defaults to None, which looks them up.
     """
     config = read_config()
     debug = config["api_server"]["debug"]
 
-    client = GstdClient()
-    pipelines, pipelines_meta = create_pipelines(client, config, debug=debug)
+    client = PersistentGstdClient()
+    pipelines, pipelines_meta = create_pipelines(client, config, debug=debug, devices=devices)
 
     start_pipelines(pipelines)
-    encoder_name = [x for x in pipelines["output1"].list_elements() if "nvv4l2h265enc" in x["name"]][0]["name"]
-    pipelines["output1"].encoder = encoder_name
+    pipelines["output1"].encoder = pipelines["output1"].element("encoder")
     pipelines["output1"].set_bitrate()
 
     srt_passphrase = config["output1"]["srt_passphrase"]
@@ -191,86 +209,283 @@ def setup():
 
 
 class BitrateWatcherThread(threading.Thread):
-    def __init__(self, output_pipeline, srt_stats, update_interval=0.5):
+    def __init__(self, output_pipeline, srt_stats, idle_timeout=1.0):
+        """
+        Runs the rate controller on every new SRT stats sample. It sleeps until SRTThread has new stats, so it costs nothing while there aren't any.
+        Args:
+            output_pipeline (api.Outputs): Output to control the bitrate of.
+            srt_stats (SRTThread): Where the stats come from.
+            idle_timeout (float, optional): Longest to sleep without stats, in seconds. Only affects how quickly stop() is noticed. Defaults to 1.0.
+        """
         self.config = read_config()
         self.output_config = self.config["output1"]
         self.output_pipe = output_pipeline
         self.srt = srt_stats
         self.event = threading.Event()
-        self.rtt_backoff_threshold = self.output_config["backoff_rtt"]
-        self.rtt_normal_threshold = self.output_config["backoff_rtt_normal"]
-        self.cooldown_time = self.output_config["backoff_retry_time"]
-        self.update_interval=update_interval
-        self.backoff = 0
+        self.idle_timeout = idle_timeout
         self.debug = self.config["api_server"]["debug"]
+        # The step controller's settings live in [output1], the rest in [rate_control].
+        rc_config = dict(self.output_config, **self.config.get("rate_control", {}))
+        self.controller = rate_control.make_controller(rc_config, self.output_pipe.bitrate_steps, self.output_pipe.target_bitrate)
+        print(f"BitrateWatcher: using the {self.controller.name} rate controller.")
+        # Counters, to check this stays cheap. cpu_time is this thread's own CPU use, from time.thread_time().
+        self.wakeups = 0
+        self.idle_wakeups = 0
+        self.decisions = 0
+        self.bitrate_changes = 0
+        self.cpu_time = 0.0
+        self.decision_time = 0.0
+        self.start_time = None
         super().__init__(group=None)
 
     def run(self):
-        bitrate_steps = self.output_pipe.bitrate_steps
+        self.start_time = monotonic()
+        cpu_start = thread_time()
+        last_count = self.srt.update_count
+        last_stats = self.srt.last_stats
         while not self.event.is_set():
-            cooldown = 0
+            count = self.srt.wait_for_update(last_count, self.idle_timeout)
+            self.wakeups += 1
+            self.cpu_time = thread_time() - cpu_start
+            if count == last_count:
+                self.idle_wakeups += 1
+                continue
+            last_count = count
             stats = self.srt.last_stats
-            if stats == {}:
+            if stats == {} or stats is last_stats:
+                # A message, with no new stats. Each stats record is a new dict, so the same one means nothing's changed.
+                # Running the controller again would count the same sample twice.
                 continue
-            rtt = stats["link"]["rtt"]
+            last_stats = stats
+            decision_start = thread_time()
+            self.decide(stats)
+            self.decisions += 1
+            self.decision_time += thread_time() - decision_start
+
+    def decide(self, stats):
+        if self.debug:
+            print("bw:", self.output_pipe.current_bitrate, "rtt:", stats["link"]["rtt"], "controller:", self.controller.name, "locked:", self.output_pipe.bitrate_locked)
+        if self.output_pipe.bitrate_locked:
+            # If the bitrate is manually locked, don't switch, even if we otherwise would be. Carry on from there when it's unlocked.
+            self.controller.reset(self.output_pipe.current_bitrate)
+            return
+        bitrate = self.controller.update(stats, monotonic())
+        if bitrate != self.output_pipe.current_bitrate:
             if self.debug:
-                print("bw:", bitrate_steps, self.output_pipe.current_bitrate, "rtt:", rtt, "backoff:", self.backoff, "locked:", self.output_pipe.bitrate_locked)
-            # To override the backoff behaviour.
-            if self.output_pipe.bitrate_locked:
-                # If the bitrate is manually locked, don't switch, even if we otherwise would be.
-                pass
-            elif self.backoff >= 0 and rtt >= self.rtt_backoff_threshold:
-                self.backoff = max(0, min(self.backoff + 1, len(bitrate_steps) - 1))
-                self.output_pipe.current_bitrate = bitrate_steps[self.backoff]
-                self.output_pipe.output_pipeline.set_bitrate(bitrate_steps[self.backoff])
-                if self.debug:
-                    print(f"BitrateWatcher: Drop bitrate to {bitrate_steps[self.backoff]}. RTT: {rtt}, backoff: {self.backoff}")
-                cooldown = self.cooldown_time
-            elif self.backoff > 0 and rtt < self.rtt_normal_threshold:
-                self.backoff = max(0, min(self.backoff - 1, len(bitrate_steps) - 1))
-                self.output_pipe.current_bitrate = bitrate_steps[self.backoff]
-                self.output_pipe.output_pipeline.set_bitrate(bitrate_steps[self.backoff])
-                if self.debug:
-                    print(f"BitrateWatcher: Increase bitrate to {bitrate_steps[self.backoff]}. RTT: {rtt}, backoff: {self.backoff}")
-                cooldown = self.cooldown_time
-            self.event.wait(self.update_interval + cooldown)
+                print(f"BitrateWatcher: bitrate {self.output_pipe.current_bitrate} -> {bitrate}. RTT: {stats['link']['rtt']}")
+            self.output_pipe.current_bitrate = bitrate
+            self.output_pipe.output_pipeline.set_bitrate(bitrate)
+            self.bitrate_changes += 1
+
+    def stats(self):
+        """
+        Returns:
+            dict: Wakeup/decision counters and CPU use.
+        """
+        elapsed = monotonic() - self.start_time if self.start_time else 0
+        return {
+            "controller": self.controller.name,
+            "wakeups": self.wakeups,
+            "idle_wakeups": self.idle_wakeups,
+            "decisions": self.decisions,
+            "bitrate_changes": self.bitrate_changes,
+            "cpu_time": round(self.cpu_time, 4),
+            "cpu_percent": round(self.cpu_time / elapsed * 100, 3) if elapsed else None,
+            "decision_ms": round(self.decision_time / self.decisions * 1000, 3) if self.decisions else None,
+        }
 
     def stop(self):
         """
-        Stops the srt-live-transmit process and the stats-gathering loop.
+        Stops the loop. It's noticed within idle_timeout.
         """
         self.event.set()
 
+class RemoteUnavailable(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    """
+    Stops calls to the relay for a while after it has failed a few times in a row, so callers get an answer straight away instead of waiting out a timeout every time.
+    After reset_time, one trial call is let through. If that works the breaker closes again, otherwise it stays open for another reset_time.
+    """
+    def __init__(self, failure_threshold=3, reset_time=10.0):
+        self.failure_threshold = failure_threshold
+        self.reset_time = reset_time
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if monotonic() - self.opened_at >= self.reset_time:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        with self.lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and not self.trial:
+                self.trial = True
+                return True
+            return False
+
+    def retry_in(self):
+        """
+        Returns:
+            float: Seconds until the next trial call is allowed, 0 if calls are allowed now.
+        """
+        if self.opened_at is None:
+            return 0
+        return max(0, self.opened_at + self.reset_time - monotonic())
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def cancel(self):
+        """
+        Gives back a trial call that was allowed but never made, without counting it either way.
+        """
+        with self.lock:
+            self.trial = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    print(f"[{datetime.now()}] StreamRemoteControl: relay unreachable, pausing calls for {self.reset_time}s.")
+                self.opened_at = monotonic()
+            self.trial = False
+
+
 class StreamRemoteControl(object):
+    """
+    Client for the relay's remote control API.
+    Every call is bounded by a deadline, retried with jittered backoff inside it, and limited to a fixed number of connections at once.
+    The status is kept up to date by a background thread, so get_status() never waits on the network. When the relay is unreachable, the last status is returned.
+    """
     def __init__(self):
         self.cfg = read_config()["output1"]
         self.url = self.cfg["api_url"]
         self.api_key = self.cfg["api_key"]
         self.ssl_pem = self.cfg["ssl_pem"]
+        self.timeout = self.cfg.get("api_timeout", 2.0)
+        self.retries = self.cfg.get("api_retries", 2)
+        self.status_interval = self.cfg.get("api_status_interval", 1.0)
+        pool_size = self.cfg.get("api_pool_size", 4)
+        self.breaker = CircuitBreaker(self.cfg.get("api_breaker_failures", 3), self.cfg.get("api_breaker_reset_time", 10.0))
         self.r_session = requests.Session()
+        # Bounded pool: at most pool_size requests in flight, each on a kept alive connection.
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.r_session.mount("https://", adapter)
+        self.r_session.mount("http://", adapter)
+        self.pool_slots = threading.BoundedSemaphore(pool_size)
         self.last_status = {"streaming": False, "recording": False, "scene": "<strong>Connection failed.</strong>"}
+        self.last_status_time = None
         if self.ssl_pem:
             self.r_session.verify = self.ssl_pem
         else:
             self.r_session.verify = True
         self.r_session.headers.update({"X-API-key": self.api_key})
+        self.event = threading.Event()
+        self.refresh_now = threading.Event()
+        self.refresher = threading.Thread(target=self.refresh_loop, name="RemoteStatus", daemon=True)
+
+    def start(self):
+        """
+        Start refreshing the status in the background.
+        """
+        self.refresher.start()
+
+    def stop(self):
+        self.event.set()
+        self.refresh_now.set()
+
+    def request(self, method, endpoint='/', retry_reads=True, **kwargs):
+        """
+        Make a request to the relay, retrying until it works or the deadline passes.
+        Args:
+            method (str): HTTP method.
+            endpoint (str, optional): Path on the relay. Defaults to '/'.
+            retry_reads (bool, optional): Also retry if the request was sent but the response timed out. Not safe for commands. Defaults to True.
+        Returns:
+            requests.Response: The response. 5xx responses count as failures.
+        Raises:
+            RemoteUnavailable: If the circuit breaker is open, no connection slot freed up in time, or every attempt failed.
+        """
+        if not self.breaker.allow():
+            raise RemoteUnavailable(f"Relay unreachable, retrying in {round(self.breaker.retry_in(), 1)}s.")
+        deadline = monotonic() + self.timeout
+        error = None
+        for attempt in range(self.retries + 1):
+            remaining = deadline - monotonic()
+            if remaining <= 0 or not self.pool_slots.acquire(timeout=remaining):
+                break
+            try:
+                # (connect, read) timeouts. The read timeout is per read, so this is close to, but not exactly, the deadline.
+                remaining = max(deadline - monotonic(), 0.01)
+                res = self.r_session.request(method, self.url + endpoint, verify=False, timeout=(remaining, remaining), **kwargs)
+                if res.status_code < 500:
+                    self.breaker.success()
+                    return res
+                error = RemoteUnavailable(f"{method} {endpoint}: HTTP {res.status_code}.")
+            except requests.ConnectionError as e:
+                # Includes connect timeouts, so the request never made it to the relay and it's always safe to try again.
+                error = e
+            except requests.Timeout as e:
+                error = e
+                if not retry_reads:
+                    break
+            finally:
+                self.pool_slots.release()
+            # Full jitter, so retries from several callers don't all land at once.
+            backoff = random.uniform(0, min(0.1 * 2 ** attempt, 1.0))
+            if self.event.wait(min(backoff, max(deadline - monotonic(), 0))):
+                break
+        if error is None:
+            # Nothing was sent, so this says nothing about the relay. Only the local pool was busy.
+            self.breaker.cancel()
+            raise RemoteUnavailable(f"{method} {endpoint}: pool busy.")
+        self.breaker.failure()
+        raise RemoteUnavailable(f"{method} {endpoint} failed: {error}")
 
-    # ToDo: This is all likely going to need a short timeout, or be async.
     def r_get(self, endpoint='/'):
-        res = self.r_session.get(self.url + endpoint, verify=False)
-        return res
+        return self.request("GET", endpoint)
 
     def r_post(self, endpoint='/', data={}):
-        res = self.r_session.post(self.url + endpoint, data=data, verify=False)
-        return res
+        return self.request("POST", endpoint, retry_reads=False, data=data)
 
-    def get_status(self):
+    def refresh_status(self):
         try:
             res = self.r_get('/status')
             self.last_status = json.loads(res.text)
+            self.last_status_time = monotonic()
         except Exception as e:
-            print(e)
-        return self.last_status
+            print(f"[{datetime.now()}] StreamRemoteControl: status refresh failed: {e}")
+
+    def refresh_loop(self):
+        while not self.event.is_set():
+            self.refresh_now.clear()
+            self.refresh_status()
+            # While the breaker is open, there's no point trying before it lets calls through again.
+            self.refresh_now.wait(max(self.status_interval, self.breaker.retry_in()))
+
+    def get_status(self):
+        """
+        Returns:
+            dict: The last status from the relay, and how fresh it is under "remote".
+        """
+        age = None if self.last_status_time is None else round(monotonic() - self.last_status_time, 2)
+        return dict(self.last_status, remote={"connected": self.breaker.state == "closed", "age": age, "breaker": self.breaker.state})
 
     def start_stream(self):
         return self.get_res('/start')
@@ -291,8 +506,11 @@ class StreamRemoteControl(object):
                 msg = {"message": "success"}
             else:
                 msg = {"message": "failure"}
-        except Exception:
+        except Exception as e:
+            print(f"[{datetime.now()}] StreamRemoteControl: {endpoint} failed: {e}")
             msg = {"message": "failure"}
+        # The command has probably changed the status, so don't wait for the next refresh.
+        self.refresh_now.set()
         return json.dumps(msg)
 
 
@@ -302,7 +520,10 @@ def setup_source_routing(interfaces, debug=False):
     Args:
         interfaces (list): list of network interfaces to set up.
         debug (bool, optional): Whether or not to print debug info. Defaults to False.
+    Returns:
+        list: The subprocess.Popen for each interface's script, to wait on if it needs to be done.
     """
+    procs = []
     for iface in interfaces:
         if iface == "eth0":
             continue
@@ -310,6 +531,8 @@ def setup_source_routing(interfaces, debug=False):
         res = subprocess.Popen(cmd, stdout=subprocess.PIPE, shell=True)
         if debug:
             print(res)
+        procs += [res]
+    return procs
 
 def set_clocks(debug=False):
     """
@@ -317,10 +540,13 @@ def set_clocks(debug=False):
     This is needed because otherwise the audio can get choppy when the cpu throttles.
     Args:
         debug (bool, optional): Whether or not to print debug info. Defaults to False.
+    Returns:
+        subprocess.Popen: The jetson_clocks process.
     """
     res = subprocess.Popen("sudo jetson_clocks", stdout=subprocess.PIPE, shell=True)
     if debug:
         print(res)
+    return res
 
 
 if __name__ == "__main__":
@@ -331,7 +557,7 @@ if __name__ == "__main__":
     test_bitrates = pipelines["output1"].fallback_bitrates
     idx = 0
     sleep_time = 5
-    text = [x["name"] for x in pipelines["output1"].list_elements() if "textoverlay" in x["name"]][0]
+    text = pipelines["output1"].element("overlay")
     if debug:
         print(f"text name: {text}")
 
@@ -0,0 +1,323 @@
+import json
+import re
+import selectors
+import socket
+import threading
+from os import listdir, path
+from time import monotonic
+
+import falcon
+
+# Netlink protocol for hotplug events, from linux/netlink.h. The socket module doesn't have it.
+NETLINK_KOBJECT_UEVENT = 15
+# Kernel uevents go to this netlink multicast group. udev rebroadcasts them on group 2, in its own format.
+UEVENT_KERNEL_GROUP = 1
+# The subsystems that change what capture devices there are.
+WATCHED_SUBSYSTEMS = ("video4linux", "sound")
+# Lines like " 1 [Link4K         ]: USB-Audio - Cam Link 4K" in /proc/asound/cards.
+CARD_LINE = re.compile(r"^\s*(\d+) \[[^\]]*\]: .* - (.*)$")
+USB_PATH = re.compile(r"\bat (usb-[^\s,]+)")
+
+
+def usb_path(device_dir):
+    """
+    Work out the bus path of a device, like "usb-70090000.xusb-1.4", the same as v4l2-ctl and /proc/asound show it.
+    Args:
+        device_dir (str): The device's real sysfs directory, normally the USB interface it's on.
+    Returns:
+        str: The bus path. Devices not on USB get "platform:" and their sysfs name.
+    """
+    parts = device_dir.rstrip("/").split("/")
+    for idx in range(len(parts) - 1, 0, -1):
+        # The root hub is "usbN", and the host controller is its parent.
+        if re.fullmatch(r"usb\d+", parts[idx]):
+            devices = [x for x in parts[idx + 1:] if re.fullmatch(r"\d+-[\d.]+", x)]
+            if devices:
+                return f"usb-{parts[idx - 1]}-{devices[-1].split('-', 1)[1]}"
+    return f"platform:{parts[-1]}"
+
+
+def read_attr(attr_path, default=None):
+    try:
+        with open(attr_path, "r") as f:
+            return f.read().strip()
+    except OSError:
+        return default
+
+
+def scan_video(sys_path="/sys", nodes=None):
+    """
+    Find the video capture devices in /sys/class/video4linux.
+    A UVC device has several nodes (capture and metadata), its capture node is the one with the lowest index.
+    Args:
+        sys_path (str, optional): Where sysfs is mounted. Defaults to "/sys".
+        nodes (set, optional): Only look at these nodes, like "video0". Defaults to None, all of them.
+    Returns:
+        dict: USB path to {"name", "video", "nodes"}.
+    """
+    class_dir = path.join(sys_path, "class", "video4linux")
+    if nodes is None:
+        try:
+            nodes = listdir(class_dir)
+        except OSError:
+            return {}
+    found = {}
+    for node in nodes:
+        node_dir = path.join(class_dir, node)
+        if not path.exists(node_dir):
+            continue
+        usb = usb_path(path.realpath(path.join(node_dir, "device")))
+        index = int(read_attr(path.join(node_dir, "index"), 0))
+        number = int(re.sub(r"\D", "", node) or 0)
+        dev = found.setdefault(usb, {"name": read_attr(path.join(node_dir, "name"), node), "nodes": []})
+        dev["nodes"] += [(index, number, f"/dev/{node}")]
+    for dev in found.values():
+        dev["nodes"] = [x[2] for x in sorted(dev["nodes"])]
+        dev["video"] = dev["nodes"][0]
+    return found
+
+
+def scan_audio(proc_path="/proc"):
+    """
+    Find the sound cards in /proc/asound/cards.
+    Args:
+        proc_path (str, optional): Where procfs is mounted. Defaults to "/proc".
+    Returns:
+        list: [alsa card index, card name, USB path or None] for each card.
+    """
+    try:
+        with open(path.join(proc_path, "asound", "cards"), "r") as f:
+            lines = f.read().split("\n")
+    except OSError:
+        return []
+    cards = []
+    for idx, line in enumerate(lines):
+        match = CARD_LINE.match(line)
+        if match is None:
+            continue
+        # The second line of each card is the long name, which ends with where it's plugged in for USB ones.
+        usb = USB_PATH.search(lines[idx + 1]) if idx + 1 < len(lines) else None
+        cards += [[int(match.group(1)), match.group(2).strip(), usb.group(1) if usb else None]]
+    return cards
+
+
+def match_audio(devices, cards):
+    """
+    Set each video device's "audio" to the alsa card on the same USB device, or -1 if there isn't one.
+    Cards that don't say where they're plugged in are matched by name, like find_devices() used to.
+    """
+    for usb, dev in devices.items():
+        dev["audio"] = -1
+        for idx, name, card_usb in cards:
+            if card_usb == usb or (card_usb is None and dev["name"] in name):
+                dev["audio"] = idx
+
+
+def open_uevents():
+    """
+    Subscribe to the kernel's hotplug events.
+    Returns:
+        socket.socket: A netlink socket with an event in each message, or None if netlink isn't available.
+    """
+    try:
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+        sock.bind((0, UEVENT_KERNEL_GROUP))
+        sock.setblocking(False)
+        return sock
+    except (AttributeError, OSError) as e:
+        print(f"DeviceRegistry: netlink not available, polling instead: {e}")
+        return None
+
+
+def parse_uevent(msg):
+    """
+    Args:
+        msg (bytes): A kernel uevent, "action@devpath" then null separated KEY=value pairs.
+    Returns:
+        dict: The KEY=value pairs.
+    """
+    fields = msg.decode("utf-8", "replace").split("\x00")
+    return dict(x.split("=", 1) for x in fields[1:] if "=" in x)
+
+
+class DeviceRegistry(threading.Thread):
+    def __init__(self, sys_path="/sys", proc_path="/proc", poll_interval=10.0, settle_time=1.0, debug=False):
+        """
+        The capture devices and their alsa cards, keyed by USB path, kept up to date as they're plugged in and out.
+        Devices are found from sysfs and /proc/asound instead of running v4l2-ctl.
+        After the first scan, only the devices named in hotplug events are looked at again, with a full scan every poll_interval in case an event is missed.
+        Args:
+            sys_path (str, optional): Where sysfs is mounted. Defaults to "/sys".
+            proc_path (str, optional): Where procfs is mounted. Defaults to "/proc".
+            poll_interval (float, optional): Seconds between full scans. Defaults to 10.0.
+            settle_time (float, optional): Seconds to wait after an event before looking, so the device nodes exist and a burst is handled in one go. Defaults to 1.0.
+            debug (bool, optional): Whether or not to print debug info. Defaults to False.
+        """
+        self.sys_path = sys_path
+        self.proc_path = proc_path
+        self.poll_interval = poll_interval
+        self.settle_time = settle_time
+        self.debug = debug
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.devices = {}
+        self.listeners = []
+        self.netlink = open_uevents()
+        self.selector = selectors.DefaultSelector()
+        if self.netlink is not None:
+            self.selector.register(self.netlink, selectors.EVENT_READ)
+        self.changes = 0
+        self.events = 0
+        self.last_change = None
+        self.scan()
+        super().__init__(group=None)
+
+    def scan(self):
+        """
+        Look at every device again.
+        Returns:
+            dict: The changes, as in update().
+        """
+        found = scan_video(self.sys_path)
+        match_audio(found, scan_audio(self.proc_path))
+        return self.update(found)
+
+    def rescan_nodes(self, nodes):
+        """
+        Look again at only the USB devices with these video nodes, and redo the audio matching.
+        Args:
+            nodes (set): Video node names, like "video0".
+        Returns:
+            dict: The changes, as in update().
+        """
+        found = {k: dict(v) for k, v in self.devices.items()}
+        touched = {k for k, v in found.items() if {path.basename(x) for x in v["nodes"]} & nodes}
+        # Any other nodes of those devices need looking at too, to work out which one is the capture node.
+        nodes = set(nodes) | {path.basename(x) for k in touched for x in found[k]["nodes"]}
+        current = scan_video(self.sys_path, nodes)
+        touched |= set(current)
+        for usb in touched:
+            if usb in current:
+                found[usb] = current[usb]
+            else:
+                found.pop(usb, None)
+        match_audio(found, scan_audio(self.proc_path))
+        return self.update(found)
+
+    def update(self, found):
+        """
+        Replace the devices, and tell the listeners what changed.
+        Returns:
+            dict: {"added": [usb paths], "removed": [usb paths], "changed": [usb paths]}
+        """
+        with self.lock:
+            old = self.devices
+            self.devices = found
+        changes = {
+            "added": sorted(set(found) - set(old)),
+            "removed": sorted(set(old) - set(found)),
+            "changed": sorted(k for k in set(found) & set(old) if found[k] != old[k]),
+        }
+        if any(changes.values()):
+            self.changes += 1
+            self.last_change = monotonic()
+            if self.debug:
+                print(f"DeviceRegistry: {changes}, now {self.devices}.")
+            for callback in self.listeners:
+                callback(changes)
+        return changes
+
+    def add_listener(self, callback):
+        """
+        Call callback(changes) from this thread whenever devices are added, removed or changed.
+        """
+        self.listeners += [callback]
+
+    def by_name(self):
+        """
+        Returns:
+            dict: The devices in the format find_devices() returns, {"name": ["/dev/videoX", "usb-id", alsa index]}.
+        """
+        with self.lock:
+            return {v["name"]: [v["video"], k, v["audio"]] for k, v in self.devices.items()}
+
+    def find(self, name):
+        """
+        Args:
+            name (str): Part of the device's name, as in the inputs' config.
+        Returns:
+            list: ["/dev/videoX", "usb-id", alsa index] for the first device with name in its name, or None if it isn't plugged in.
+        """
+        for dev_name, dev in sorted(self.by_name().items()):
+            if name in dev_name:
+                return dev
+        return None
+
+    def read_events(self):
+        """
+        Returns:
+            set: The video nodes named in the pending hotplug events, and "sound" if any were for sound cards.
+        """
+        nodes = set()
+        while True:
+            try:
+                msg = self.netlink.recv(65536)
+            except (BlockingIOError, InterruptedError):
+                return nodes
+            if not msg:
+                return nodes
+            uevent = parse_uevent(msg)
+            subsystem = uevent.get("SUBSYSTEM")
+            if subsystem not in WATCHED_SUBSYSTEMS:
+                continue
+            self.events += 1
+            if subsystem == "video4linux":
+                nodes.add(path.basename(uevent.get("DEVPATH", "")))
+            else:
+                nodes.add("sound")
+
+    def run(self):
+        last_scan = monotonic()
+        while not self.event.is_set():
+            nodes = set()
+            if self.netlink is None:
+                self.event.wait(self.poll_interval)
+            elif self.selector.select(max(0, self.poll_interval - (monotonic() - last_scan))):
+                nodes = self.read_events()
+                # Let the rest of the burst arrive and the /dev nodes be created.
+                self.event.wait(self.settle_time)
+                nodes |= self.read_events()
+            if self.event.is_set():
+                break
+            try:
+                if nodes:
+                    self.rescan_nodes(nodes - {"sound"})
+                elif monotonic() - last_scan >= self.poll_interval:
+                    self.scan()
+                    last_scan = monotonic()
+            except Exception as e:
+                print(f"DeviceRegistry: updating devices failed: {e}")
+        if self.netlink is not None:
+            self.selector.close()
+            self.netlink.close()
+
+    def as_dict(self):
+        with self.lock:
+            devices = {k: dict(v) for k, v in self.devices.items()}
+        return {
+            "devices": devices,
+            "netlink": self.netlink is not None,
+            "events": self.events,
+            "changes": self.changes,
+            "last_change_age": round(monotonic() - self.last_change, 1) if self.last_change else None,
+        }
+
+    def on_get(self, req, res):
+        res.body = json.dumps(self.as_dict())
+        res.status = falcon.HTTP_200
+
+    def stop(self):
+        """
+        Stops watching. It's noticed within poll_interval.
+        """
+        self.event.set()
@@ -0,0 +1,190 @@
+"""
+Latency benchmark for the API's routes, run against mock_gstd.py instead of a real gstd, so it works without a Jetson.
+The pipelines are created from config.toml as usual (with made up capture devices), and each route is called through falcon's test client.
+For every route the report has the latency percentiles, the throughput, and how many gstd commands each request sent, by command.
+
+Usage:
+    python gstd_bench.py [--requests 200] [--latency-ms 1.0] [--concurrency 1] [--report report.json] [--baseline old_report.json]
+
+With --baseline, it fails if any route sends more gstd commands per request than it did in that report,
+or, with --max-slowdown, if its p95 latency is more than that many times the baseline's.
+"""
+import argparse
+import json
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+import falcon
+from falcon import testing
+
+import control
+from api import AudioControls, Inputs, Outputs, StreamOutput
+from gstd_client import PersistentGstdClient
+from mock_gstd import MockGstd, parse_command_latency
+
+# (method, path, json body). Every route that talks to gstd, in an order that leaves the pipelines as they started.
+ROUTES = [
+    ("GET", "/inputs", None),
+    ("POST", "/inputs/swap", None),
+    ("POST", "/inputs/input1", None),
+    ("GET", "/outputs", None),
+    ("POST", "/outputs/encoder/dec", None),
+    ("POST", "/outputs/encoder/inc", None),
+    ("POST", "/outputs/encoder/set", "preferred_bitrate"),
+    ("POST", "/outputs/encoder/reset", None),
+    ("GET", "/audio", None),
+    ("POST", "/audio/mute", None),
+    ("POST", "/audio/input2", None),
+    ("POST", "/audio/input1", None),
+    ("POST", "/outputs/pause", None),
+    ("POST", "/outputs/play", None),
+]
+
+
+def build_app(client, config):
+    """
+    Create the pipelines and the gstd backed resources, with the same routes as app.py.
+    Returns:
+        falcon.API: The app.
+    """
+    devices = {
+        config["input1"]["name"]: ["/dev/video0", "usb-bench-1", 1],
+        config["input2"]["name"]: ["/dev/video1", "usb-bench-2", 2],
+    }
+    pipelines, _ = control.create_pipelines(client, config, devices=devices)
+    control.start_pipelines(pipelines)
+    pipelines["output1"].encoder = pipelines["output1"].element("encoder")
+    pipelines["output1"].set_bitrate()
+
+    input_status = Inputs(pipelines["input1"], pipelines["input2"], pipelines["output1"])
+    output_status = Outputs(pipelines["output1"])
+    audio_controls = AudioControls(pipelines["output1"])
+    output_controls = StreamOutput(pipelines["output1"])
+
+    api = falcon.API()
+    api.add_route("/inputs/{input_name}", input_status)
+    api.add_route("/inputs", input_status)
+    api.add_route("/outputs/play", output_controls, suffix="play")
+    api.add_route("/outputs/pause", output_controls, suffix="pause")
+    api.add_route("/outputs", output_status)
+    api.add_route("/outputs/encoder/{bitrate}", output_status)
+    api.add_route("/audio/", audio_controls)
+    api.add_route("/audio/mute", audio_controls, suffix="mute")
+    api.add_route("/audio/{input_name}", audio_controls, suffix="name")
+    return api
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+
+def bench_route(test_client, gstd, method, path, body, requests, concurrency):
+    """
+    Call one route requests times.
+    Returns:
+        dict: Latency, throughput and gstd command counts for the route.
+    """
+    def one(_):
+        start = perf_counter()
+        res = test_client.simulate_request(method, path, body=body)
+        return perf_counter() - start, res.status_code
+
+    gstd.state.reset_counts()
+    start = perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(one, range(requests)))
+    elapsed = perf_counter() - start
+    counts = dict(gstd.state.counts)
+    latencies = [x[0] * 1000 for x in results]
+    return {
+        "route": f"{method} {path}",
+        "requests": requests,
+        "errors": len([x for x in results if x[1] >= 400]),
+        "mean_ms": round(statistics.mean(latencies), 3),
+        "p50_ms": round(percentile(latencies, 0.5), 3),
+        "p95_ms": round(percentile(latencies, 0.95), 3),
+        "max_ms": round(max(latencies), 3),
+        "throughput_rps": round(requests / elapsed, 1),
+        "gstd_commands_per_request": round(sum(counts.values()) / requests, 3),
+        "gstd_commands": {k: round(v / requests, 3) for k, v in sorted(counts.items())},
+    }
+
+
+def run_bench(config, requests=200, latency=0.001, command_latency=None, concurrency=1):
+    """
+    Returns:
+        dict: The report.
+    """
+    gstd = MockGstd(latency=latency, command_latency=command_latency).start()
+    client = PersistentGstdClient(port=gstd.port)
+    try:
+        start = perf_counter()
+        api = build_app(client, config)
+        setup = {"seconds": round(perf_counter() - start, 3), "gstd_commands": dict(gstd.state.counts)}
+        test_client = testing.TestClient(api)
+        preferred = json.dumps({"current_bitrate": config["encoder"]["preferred_bitrate"]})
+        routes = []
+        for method, path, body in ROUTES:
+            body = preferred if body == "preferred_bitrate" else body
+            routes += [bench_route(test_client, gstd, method, path, body, requests, concurrency)]
+    finally:
+        client.close()
+        gstd.stop()
+    return {
+        "gstd_latency_ms": latency * 1000,
+        "gstd_command_latency_ms": {k: v * 1000 for k, v in (command_latency or {}).items()},
+        "concurrency": concurrency,
+        "setup": setup,
+        "gstd_connections": gstd.state.connections,
+        "client": dict(client.stats),
+        "routes": routes,
+    }
+
+
+def compare(report, baseline, max_slowdown=None):
+    """
+    Returns:
+        list: Descriptions of the routes that got worse than the baseline report.
+    """
+    old = {x["route"]: x for x in baseline["routes"]}
+    failures = []
+    for route in report["routes"]:
+        before = old.get(route["route"])
+        if before is None:
+            continue
+        if route["gstd_commands_per_request"] > before["gstd_commands_per_request"]:
+            failures += [f"{route['route']}: {route['gstd_commands_per_request']} gstd commands per request, was {before['gstd_commands_per_request']}."]
+        if max_slowdown and route["p95_ms"] > before["p95_ms"] * max_slowdown:
+            failures += [f"{route['route']}: p95 {route['p95_ms']}ms, was {before['p95_ms']}ms."]
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the API routes against a mock gstd.")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per route. Defaults to 200.")
+    parser.add_argument("--concurrency", type=int, default=1, help="Requests in flight at once. Defaults to 1.")
+    parser.add_argument("--latency-ms", type=float, default=1.0, help="Milliseconds every gstd command takes. Defaults to 1.0.")
+    parser.add_argument("--command-latency", default="", help="Per command gstd latency in ms, like element_set=5,list_elements=10.")
+    parser.add_argument("--config", default="config.toml", help="Config to create the pipelines from. Defaults to config.toml.")
+    parser.add_argument("--report", default=None, help="Write the json report here as well as printing it.")
+    parser.add_argument("--baseline", default=None, help="Earlier report to compare against. Fails if any route sends more gstd commands.")
+    parser.add_argument("--max-slowdown", type=float, default=None, help="With --baseline, also fail if a route's p95 is more than this many times slower.")
+    args = parser.parse_args()
+
+    report = run_bench(
+        control.read_config(args.config),
+        requests=args.requests,
+        latency=args.latency_ms / 1000,
+        command_latency=parse_command_latency(args.command_latency),
+        concurrency=args.concurrency,)
+    print(json.dumps(report, indent=2))
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            failures = compare(report, json.load(f), args.max_slowdown)
+        if failures:
+            raise SystemExit("\n".join(failures))
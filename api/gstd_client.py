@@ -0,0 +1,157 @@
+import json
+import queue
+import socket
+import threading
+from contextlib import contextmanager
+
+from pygstc.gstc import GstdClient
+from pygstc.gstcerror import GstdError
+
+
+class GstdConnection(object):
+    """
+    One TCP connection to gstd, kept open and used for any number of commands.
+    gstd answers each command with a json response followed by a null byte.
+    """
+    def __init__(self, ip="localhost", port=5000, timeout=5.0):
+        self.address = (ip, port)
+        self.timeout = timeout
+        self.sock = None
+        self.reconnect()
+
+    def reconnect(self):
+        self.close()
+        self.sock = socket.create_connection(self.address, timeout=self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buffer = bytearray()
+        self.commands = 0
+        self.closed = False
+
+    def send(self, cmd_line):
+        """
+        Send one command, and wait for its response.
+        Args:
+            cmd_line (str): gstd command, as it'd be typed into gst-client.
+        Returns:
+            str: The raw json response.
+        """
+        self.sock.sendall(cmd_line.encode("utf-8"))
+        while True:
+            end = self.buffer.find(b"\x00")
+            if end != -1:
+                res = bytes(self.buffer[:end])
+                del self.buffer[:end + 1]
+                self.commands += 1
+                return res.decode("utf-8")
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                raise ConnectionError("gstd closed the connection.")
+            self.buffer += chunk
+
+    def close(self):
+        self.closed = True
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+
+
+class PersistentGstdClient(GstdClient):
+    """
+    GstdClient that keeps a small pool of open connections to gstd, instead of connecting for every command.
+    It's a drop in replacement, all the GstdClient methods work as normal.
+
+    batch() holds one connection for several commands, so they go out back to back without any other thread's commands in between:
+        with client.batch():
+            client.element_set(pipe, encoder, "bitrate", "4000000")
+            client.element_set(pipe, overlay, "text", "bitrate: 4000kb/s")
+    """
+    def __init__(self, ip="localhost", port=5000, logger=None, timeout=5.0, pool_size=2):
+        self.gstd_ip = ip
+        self.gstd_port = port
+        self.gstd_timeout = timeout
+        self.pool = queue.LifoQueue()
+        self.pool_slots = threading.BoundedSemaphore(pool_size)
+        self.held = threading.local()
+        self.stats = {"commands": 0, "connects": 0, "reconnects": 0}
+        super().__init__(ip=ip, port=port, logger=logger, timeout=timeout)
+
+    def connect(self):
+        conn = GstdConnection(self.gstd_ip, self.gstd_port, self.gstd_timeout)
+        self.stats["connects"] += 1
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """
+        Get a connection for this thread: the one held by a batch() if there is one, otherwise one from the pool.
+        """
+        held = getattr(self.held, "conn", None)
+        if held is not None:
+            yield held
+            return
+        if not self.pool_slots.acquire(timeout=self.gstd_timeout):
+            raise TimeoutError("No gstd connection free.")
+        try:
+            try:
+                conn = self.pool.get_nowait()
+            except queue.Empty:
+                conn = self.connect()
+            try:
+                yield conn
+            except Exception:
+                # Don't reuse a connection that might be part way through a response.
+                conn.close()
+                raise
+            if not conn.closed:
+                self.pool.put(conn)
+        finally:
+            self.pool_slots.release()
+
+    @contextmanager
+    def batch(self):
+        """
+        Run every command in the with block on one connection, back to back.
+        """
+        if getattr(self.held, "conn", None) is not None:
+            # Already in a batch, nested ones just join it.
+            yield self
+            return
+        with self.connection() as conn:
+            self.held.conn = conn
+            try:
+                yield self
+            finally:
+                self.held.conn = None
+
+    def send_line(self, cmd_line):
+        with self.connection() as conn:
+            try:
+                return conn.send(cmd_line)
+            except ConnectionError:
+                # gstd may have dropped the connection while it sat idle in the pool, so try once more on a new one.
+                # A new connection that fails has a real problem, so that isn't retried.
+                if conn.commands == 0:
+                    raise
+                self.stats["reconnects"] += 1
+                conn.reconnect()
+                return conn.send(cmd_line)
+
+    def _send_cmd(self, cmd):
+        """
+        Overrides GstdClient's, which opens a new connection for every command.
+        """
+        cmd_line = cmd if isinstance(cmd, str) else " ".join(cmd)
+        self.stats["commands"] += 1
+        result = json.loads(self.send_line(cmd_line))
+        if result["code"] != 0:
+            raise GstdError(result["description"], result["code"])
+        return result
+
+    def close(self):
+        while True:
+            try:
+                self.pool.get_nowait().close()
+            except queue.Empty:
+                return
@@ -1,4 +1,6 @@
+import re
 from pygstc.gstc import *
+from contextlib import nullcontext
 from dataclasses import dataclass
 from datetime import datetime
 from pygstc.gstcerror import GstdError
@@ -10,12 +12,16 @@ class Pipeline(object):
     nice_name: str
     description: str
     debug: bool
+    element_index: dict
+    # Role: regex for the element name. {name} is this pipeline's name. The first element matching is used.
+    roles = {}
     def __init__(self, gstdclient, name, config, debug=False):
         self.client = gstdclient
         self.name = name
         self.nice_name = config["nice_name"]
         self.description = config["full_gst"]
         self.debug = debug
+        self.element_index = None
         self.create_pipeline()
 
     def create_pipeline(self):
@@ -26,6 +32,8 @@ class Pipeline(object):
         There _may_ be a bug in gstd where if we try to re-create an existing pipeline and get an error, the pipeline gets into a weird state.
         So instead of a try/except block, explicitly check to see if this pipeline already exists.
         """
+        # Element names can change when the pipeline is (re)created, so look them up again when next needed.
+        self.element_index = None
         existing_pipelines = [x["name"] for x in self.client.list_pipelines()]
         if self.name not in existing_pipelines:
             if self.debug:
@@ -66,6 +74,39 @@ class Pipeline(object):
             self.print_debug(f"{self.name} elements: {elements}")
         return elements
 
+    def build_element_index(self):
+        """
+        Find the element for each of this pipeline's roles, with one list_elements call.
+        Returns:
+            dict: Role to element name, for the roles that were found.
+        """
+        names = [x["name"] for x in self.list_elements()]
+        index = {}
+        for role, pattern in self.roles.items():
+            pattern = pattern.format(name=self.name)
+            found = [n for n in names if re.fullmatch(pattern, n)]
+            if found:
+                index[role] = found[0]
+        if self.debug:
+            self.print_debug(f"{self.name} element index: {index}")
+        self.element_index = index
+        return index
+
+    def element(self, role):
+        """
+        Get the name of the element that fills a role, like "encoder", without asking gstd every time.
+        Args:
+            role (str): One of this pipeline's roles.
+        Returns:
+            str: Element name.
+        """
+        if self.element_index is None:
+            self.build_element_index()
+        try:
+            return self.element_index[role]
+        except KeyError:
+            raise KeyError(f"Pipeline {self.name} has no {role} element.")
+
     def set_property(self, element, prop, val):
         new_val = str(val)
         if self.debug:
@@ -89,6 +130,14 @@ class Pipeline(object):
     def state(self):
         return self.client.read(f"pipelines/{self.name}/state")['value']
 
+    def batch(self):
+        """
+        Send the commands in the with block back to back on one gstd connection, if the client supports it.
+        """
+        if hasattr(self.client, "batch"):
+            return self.client.batch()
+        return nullcontext()
+
     def print_debug(self, msg):
         print(f"[{datetime.now()}] {msg}")
 
@@ -106,6 +155,13 @@ class Output(Pipeline):
     url: str
     audio_mute: bool
     volume_element: str
+    roles = {
+        "encoder": r"nvv4l2h265enc\d*",
+        "overlay": r"textoverlay\d*",
+        "volume": r"volume\d*",
+        "interpipesrc": r"{name}",
+        "audio_interpipesrc": r"{name}-audio",
+    }
     def __init__(self, gstdclient, name, config, encoder_config, debug=False):
         self.encoder = ''
         self.bitrate = encoder_config["preferred_bitrate"]
@@ -113,13 +169,13 @@ class Output(Pipeline):
         self.url = config["url"]
         self.audio_mute = False
         super().__init__(gstdclient, name, config, debug)
-        self.volume_element = [x['name'] for x in self.list_elements() if "volume" in x['name']][0]
+        self.volume_element = self.element("volume")
 
     def switch_src(self, new_src):
         new_src = new_src + "-video"
         if self.debug:
             self.print_debug(f"Switching pipeline: {self.name} to source {new_src}")
-        self.set_property(self.name, 'listen-to', new_src)
+        self.set_property(self.element("interpipesrc"), 'listen-to', new_src)
 
     def set_bitrate(self, val=0):
         if not val:
@@ -127,9 +183,10 @@ class Output(Pipeline):
         new_val = str(val)
         if self.debug:
             self.print_debug(f"{self.name} encoder '{self.encoder}' bitrate changed to {new_val}.")
-        self.client.element_set(self.name, self.encoder, "bitrate", new_val)
-        text_elem_name = [x["name"] for x in self.list_elements() if "textoverlay" in x["name"]][0]
-        self.set_property(text_elem_name, "text", f"bitrate: {val / 1000}kb/s")
+        # One batch, so the overlay never shows a different bitrate to the encoder for longer than it has to.
+        with self.batch():
+            self.client.element_set(self.name, self.encoder, "bitrate", new_val)
+            self.set_property(self.element("overlay"), "text", f"bitrate: {val / 1000}kb/s")
 
     def toggle_audio_mute(self):
         """
@@ -160,4 +217,4 @@ class Output(Pipeline):
         new_src = new_src + "-audio"
         if self.debug:
             self.print_debug(f"Switching audio: {self.name} to source {new_src}")
-        self.set_property(self.name + "-audio", 'listen-to', new_src)
+        self.set_property(self.element("audio_interpipesrc"), 'listen-to', new_src)
@@ -4,5 +4,7 @@ from control import read_config
 
 _config = read_config()["api_server"]
 bind = f"{_config['address']}:{_config['port']}"
+# Threads, as each web interface receiving live updates keeps a request open.
+threads = _config.get("threads", 8)
 if _config["debug"]:
     log_level = "debug"
\ No newline at end of file
@@ -1,14 +1,16 @@
+import os
 import netifaces
 from control import read_config
 from pathlib import Path
 from collections import defaultdict
 from datetime import datetime
 
-def find_ips(devs=[], exclude_lo=True):
+def find_ips(devs=[], exclude_lo=True, debug=True):
     """
     Args:
         devs (list, optional): Devices to limit the search for IP addresses to. Defaults to [].
         exclude_lo (bool, optional): Exclude loopback. If lo in devs, include it. Defaults to True.
+        debug (bool, optional): Print the addresses found. Defaults to True.
     Returns:
         [dict]: Dictionary of {"interface": ["ip addresses"]}.
     """
@@ -28,10 +30,38 @@ def find_ips(devs=[], exclude_lo=True):
             pass  # No key 2, which is IPv4 addresses.
         except ValueError:
             pass  # If devs contains an interface that isn't part of the system.
-    print(f"find_ips: ip_addrs {ip_addrs}")
+    if debug:
+        print(f"find_ips: ip_addrs {ip_addrs}")
     return ip_addrs
 
 
+def write_ip_file(output_path, ip_addrs):
+    """
+    Write the IP addresses for SRTLA to a file. It's written to a temporary file first and moved into place, so srtla_send never sees half a file.
+    Args:
+        output_path (Path): The file to write.
+        ip_addrs (dict): Dictionary of {"interface": ["ip addresses"]}.
+    """
+    output_path = Path(output_path)
+    tmp_path = output_path.with_name(f".{output_path.name}.tmp")
+    with open(tmp_path, 'w') as f:
+        for row in ip_addrs.values():
+            for ip in row:
+                f.write(f"{ip}\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, output_path)
+
+
+def read_ip_file(file_path):
+    """
+    Returns:
+        list: The IP addresses in an SRTLA IP file.
+    """
+    with open(file_path, 'r') as f:
+        return [x.strip() for x in f if x.strip()]
+
+
 def srtla_ip_setup(file_path="srtla_ips.txt"):
     """
     Make sure there's a file with IP addresses to pass to SRTLA.
@@ -45,13 +75,15 @@ def srtla_ip_setup(file_path="srtla_ips.txt"):
     config = read_config()["srtla_config"]
     output_path = Path(config["srtla_ip_path"])
     print("output_path:", output_path)
+    ip_addrs = find_ips(devs=config["srtla_devices"])
     if not config["srtla_ip_path"]:
         output_path = Path(file_path)
-        ip_addrs = find_ips(devs=config["srtla_devices"])
-        with open (output_path, 'w') as f:
-            for row in ip_addrs.values():
-                for ip in row:
-                    f.write(f"{ip}\n")
+        write_ip_file(output_path, ip_addrs)
+    else:
+        # The file's been given, so only keep the interfaces for the addresses in it.
+        file_ips = read_ip_file(output_path)
+        ip_addrs = {k: [ip for ip in v if ip in file_ips] for k, v in ip_addrs.items()}
+        ip_addrs = {k: v for k, v in ip_addrs.items() if v}
     return output_path, ip_addrs
 
 def timestamp():
@@ -0,0 +1,232 @@
+import threading
+from datetime import datetime
+from time import monotonic
+
+from pygstc.gstcerror import GstdError
+
+import control
+from gstd_client import PersistentGstdClient
+
+
+class InputSupervisor(object):
+    """
+    Keeps output1 going when a capture device goes away.
+    Each input pipeline's bus is watched through gstd for errors. When an input fails, output1's interpipesrcs are switched to the other input if it's healthy,
+    or to the standby test pattern if it isn't, then only the failed input pipeline is deleted and built again once its device is back.
+    output1, and so the encoder and the SRT connection, are never touched.
+    When the rebuilt input is healthy again, output1 only goes back to it if it was on the standby. Otherwise it stays where it is until someone switches it.
+    """
+    def __init__(self, pipelines, config, devices=None, bus_timeout=1.0, rebuild_interval=2.0, debug=False):
+        """
+        Args:
+            pipelines (dict): The pipelines from create_pipelines().
+            config (dict): Configuration, for the inputs' sections.
+            devices (DeviceRegistry, optional): Where to find the inputs' devices. Defaults to None, which looks them up with find_devices() each time.
+            bus_timeout (float, optional): Longest time, in seconds, to wait on a bus for an error before checking the pipeline's state instead. Defaults to 1.0.
+            rebuild_interval (float, optional): Seconds between attempts to rebuild a failed input. Defaults to 2.0.
+            debug (bool, optional): Whether or not to print debug info. Defaults to False.
+        """
+        self.pipelines = pipelines
+        self.output = pipelines["output1"]
+        self.standby = pipelines.get("standby")
+        self.config = config
+        self.devices = devices
+        self.bus_timeout = bus_timeout
+        self.rebuild_interval = rebuild_interval
+        self.debug = debug
+        # The Inputs resource, so its idea of the active input follows the switches made here. Set once it exists.
+        self.inputs = None
+        self.names = ["input1", "input2"]
+        self.health = {x: {"healthy": True, "error": None, "failures": 0, "rebuilds": 0, "last_failure": None} for x in self.names}
+        self.bound = {x: self.find_device(x)[1] for x in self.names}
+        self.last_rebuild = {x: 0 for x in self.names}
+        self.lock = threading.Lock()
+        self.switch_lock = threading.Lock()
+        self.event = threading.Event()
+        self.wakeup = {x: threading.Event() for x in self.names}
+        self.switches = 0
+        self.last_switch_ms = None
+        client = self.output.client
+        # Each watcher blocks in bus_read, so it gets its own connection instead of holding one of the shared ones.
+        self.watchers = [
+            threading.Thread(
+                target=self.watch,
+                args=(x, PersistentGstdClient(ip=client.gstd_ip, port=client.gstd_port, pool_size=1)),
+                name=f"InputSupervisor-{x}",
+                daemon=True,)
+            for x in self.names]
+        if devices is not None:
+            devices.add_listener(self.devices_changed)
+
+    def start(self):
+        for watcher in self.watchers:
+            watcher.start()
+
+    def stop(self):
+        """
+        Stops watching. It's noticed within bus_timeout.
+        """
+        self.event.set()
+        for wakeup in self.wakeup.values():
+            wakeup.set()
+
+    def healthy(self, name):
+        """
+        Returns:
+            bool: False if name is an input that has failed and hasn't been rebuilt yet.
+        """
+        return self.health.get(name, {}).get("healthy", True)
+
+    def find_device(self, name):
+        """
+        Returns:
+            list: ["/dev/videoX", "usb-id", alsa index] for the input's device, or [None, None, None] if it isn't plugged in.
+        """
+        dev_name = self.config[name]["name"]
+        if self.devices is not None:
+            dev = self.devices.find(dev_name)
+        else:
+            found = control.find_devices()
+            dev = next((found[x] for x in sorted(found) if dev_name in x), None)
+        return dev or [None, None, None]
+
+    def watch(self, name, client):
+        """
+        Watch one input, and rebuild it whenever it's failed.
+        """
+        configured = False
+        while not self.event.is_set():
+            if not self.healthy(name):
+                self.rebuild(name)
+                configured = False
+                continue
+            try:
+                if not configured:
+                    client.bus_filter(name, "error+eos")
+                    client.bus_timeout(name, int(self.bus_timeout * 1e9))
+                    configured = True
+                msg = client.bus_read(name)
+                if msg:
+                    self.input_failed(name, f"{msg.get('type')} from {msg.get('source')}: {msg.get('message')}")
+                    continue
+                state = client.read(f"pipelines/{name}/state")["value"]
+                if state != "PLAYING":
+                    self.input_failed(name, f"state is {state}")
+            except GstdError as e:
+                # Most likely the pipeline's gone.
+                self.input_failed(name, repr(e))
+            except (ConnectionError, TimeoutError, OSError) as e:
+                # gstd itself isn't answering, which switching inputs won't help with.
+                print(f"[{datetime.now()}] InputSupervisor: can't watch {name}: {e}")
+                configured = False
+                self.event.wait(self.bus_timeout)
+        client.close()
+
+    def input_failed(self, name, reason):
+        """
+        Mark an input as failed and switch output1 away from it. Only the first call for each failure does anything.
+        """
+        with self.lock:
+            health = self.health[name]
+            if not health["healthy"]:
+                return
+            health["healthy"] = False
+            health["error"] = reason
+            health["failures"] += 1
+            health["last_failure"] = datetime.now().isoformat()
+        print(f"[{datetime.now()}] InputSupervisor: {name} failed: {reason}")
+        self.switch_away(name)
+        self.wakeup[name].set()
+
+    def switch_source(self, role, switch, from_name, to_name):
+        """
+        If output1's interpipesrc for role is listening to from_name, switch it to to_name.
+        Returns:
+            bool: True if it was switched.
+        """
+        active = self.output.get_property(self.output.element(role), "listen-to")
+        if active.rsplit("-", 1)[0] != from_name:
+            return False
+        switch(to_name)
+        return True
+
+    def switch_away(self, name):
+        """
+        Move output1 off a failed input, to the other input if it's healthy, otherwise to the standby.
+        """
+        others = [x for x in self.names if x != name and self.healthy(x)]
+        target = others[0] if others else ("standby" if self.standby is not None else None)
+        if target is None:
+            print(f"[{datetime.now()}] InputSupervisor: nothing to switch to from {name}.")
+            return
+        self.switch(name, target)
+
+    def switch(self, from_name, to_name):
+        """
+        Switch output1's video and audio from one source to another, if they're listening to it.
+        """
+        start = monotonic()
+        # Manual switches through the Inputs resource take switch_lock too.
+        with self.switch_lock:
+            with self.output.batch():
+                video = self.switch_source("interpipesrc", self.output.switch_src, from_name, to_name)
+                self.switch_source("audio_interpipesrc", self.output.switch_audio_src, from_name, to_name)
+            if not video:
+                return
+            if self.inputs is not None:
+                self.inputs.active_input = to_name
+        self.switches += 1
+        self.last_switch_ms = round((monotonic() - start) * 1000, 3)
+        print(f"[{datetime.now()}] InputSupervisor: switched output from {from_name} to {to_name} in {self.last_switch_ms}ms.")
+
+    def rebuild(self, name):
+        """
+        Delete and recreate a failed input pipeline, with its device as it is now.
+        Waits for the device to be plugged back in, and for rebuild_interval since the last attempt.
+        """
+        wait = self.last_rebuild[name] + self.rebuild_interval - monotonic()
+        dev = self.find_device(name)
+        if wait > 0 or dev[0] is None:
+            # A device coming back wakes this up early.
+            self.wakeup[name].wait(max(wait, self.rebuild_interval if dev[0] is None else 0))
+            self.wakeup[name].clear()
+            return
+        self.last_rebuild[name] = monotonic()
+        pipeline = self.pipelines[name]
+        print(f"[{datetime.now()}] InputSupervisor: rebuilding {name} on {dev[0]}.")
+        try:
+            # Not cleanup(), that sends an EOS first, and the interpipesink forwards it to whatever's listening.
+            pipeline.stop()
+            pipeline.delete()
+        except GstdError:
+            pass
+        try:
+            pipeline.description = control.input_description(name, self.config[name], dev[0], dev[2])
+            pipeline.create_pipeline()
+            pipeline.play()
+        except GstdError as e:
+            print(f"[{datetime.now()}] InputSupervisor: rebuilding {name} failed: {e}")
+            return
+        self.bound[name] = dev[1]
+        with self.lock:
+            self.health[name]["healthy"] = True
+            self.health[name]["error"] = None
+            self.health[name]["rebuilds"] += 1
+        # If it fails again, the watcher will see it.
+        if self.standby is not None:
+            self.switch("standby", name)
+
+    def devices_changed(self, changes):
+        """
+        DeviceRegistry listener. An input's device being unplugged fails it straight away, without waiting for gstreamer to notice.
+        """
+        for name in self.names:
+            if self.bound[name] is not None and self.bound[name] in changes["removed"]:
+                self.input_failed(name, f"device {self.bound[name]} removed")
+            elif changes["added"] or changes["changed"]:
+                self.wakeup[name].set()
+
+    def as_dict(self):
+        with self.lock:
+            health = {k: dict(v) for k, v in self.health.items()}
+        return {"inputs": health, "switches": self.switches, "last_switch_ms": self.last_switch_ms}
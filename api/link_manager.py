@@ -0,0 +1,142 @@
+import selectors
+import socket
+import threading
+from time import monotonic
+
+import control
+from helpers import find_ips, write_ip_file
+
+# Netlink multicast groups for link up/down and IPv4 address changes, from linux/rtnetlink.h.
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+
+
+def open_netlink():
+    """
+    Subscribe to the kernel's link and address change notifications.
+    Returns:
+        socket.socket: A netlink socket that becomes readable when something changes, or None if netlink isn't available.
+    """
+    try:
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+        sock.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR))
+        sock.setblocking(False)
+        return sock
+    except (AttributeError, OSError) as e:
+        print(f"LinkManager: netlink not available, polling instead: {e}")
+        return None
+
+
+class LinkManager(threading.Thread):
+    def __init__(self, srtla_thread, ip_file, ip_addrs, devices=[], poll_interval=2.0, settle_time=1.0, telemetry=None, debug=False):
+        """
+        Keeps SRTLA's set of links up to date as modems come and go.
+        When an interface's addresses change, its source routing is set up again, the IP file is rewritten and srtla_send is told to reload it.
+        The SRT connection and the gstreamer pipelines are left alone.
+        Changes are picked up from netlink as they happen, and by polling every poll_interval in case netlink isn't available or a notification is missed.
+        Args:
+            srtla_thread (SRTLAThread): Thread running srtla_send.
+            ip_file (Path): The IP file srtla_send reads.
+            ip_addrs (dict): {"interface": ["ip addresses"]} the IP file was written with.
+            devices (list, optional): Interfaces to look on, as in find_ips(). Defaults to [], all of them.
+            poll_interval (float, optional): Seconds between checks without a netlink notification. Defaults to 2.0.
+            settle_time (float, optional): Seconds to wait after a notification before checking, as a modem coming up sends a few of them. Defaults to 1.0.
+            telemetry (SRTLATelemetry, optional): Told about the new set of links. Defaults to None.
+            debug (bool, optional): Whether or not to print debug info. Defaults to False.
+        """
+        self.srtla = srtla_thread
+        self.ip_file = ip_file
+        self.ip_addrs = {k: sorted(v) for k, v in ip_addrs.items()}
+        self.devices = devices
+        self.poll_interval = poll_interval
+        self.settle_time = settle_time
+        self.telemetry = telemetry
+        self.debug = debug
+        self.event = threading.Event()
+        self.netlink = open_netlink()
+        self.selector = selectors.DefaultSelector()
+        if self.netlink is not None:
+            self.selector.register(self.netlink, selectors.EVENT_READ)
+        self.changes = 0
+        self.last_change = None
+        super().__init__(group=None)
+
+    def drain(self):
+        """
+        Throw away the pending netlink messages, only the fact that something changed is used.
+        """
+        while True:
+            try:
+                if not self.netlink.recv(65536):
+                    return
+            except (BlockingIOError, InterruptedError):
+                return
+
+    def wait_for_change(self):
+        """
+        Block until netlink says something changed or poll_interval passes.
+        """
+        if self.netlink is None:
+            self.event.wait(self.poll_interval)
+            return
+        if self.selector.select(self.poll_interval):
+            self.drain()
+            # Let the rest of the burst arrive, so it's handled in one go.
+            self.event.wait(self.settle_time)
+            self.drain()
+
+    def check(self):
+        """
+        Look for changed interfaces, and update SRTLA if there are any.
+        Returns:
+            list: Interfaces that changed.
+        """
+        found = {k: sorted(v) for k, v in find_ips(devs=self.devices, debug=False).items()}
+        changed = sorted(k for k in set(found) | set(self.ip_addrs) if found.get(k) != self.ip_addrs.get(k))
+        if not changed:
+            return changed
+        print(f"LinkManager: links changed on {changed}. Was {self.ip_addrs}, now {found}.")
+        # Routing only needs setting up again for interfaces that have addresses now.
+        control.setup_source_routing([k for k in changed if k in found], debug=self.debug)
+        self.ip_addrs = found
+        if self.telemetry is not None:
+            self.telemetry.set_links(found)
+        if found:
+            write_ip_file(self.ip_file, found)
+            self.srtla.reload()
+        else:
+            # srtla_send can't start without any addresses, so leave it retrying the old ones until something comes back.
+            print("LinkManager: no links left.")
+        self.changes += 1
+        self.last_change = monotonic()
+        return changed
+
+    def run(self):
+        while not self.event.is_set():
+            self.wait_for_change()
+            if self.event.is_set():
+                break
+            try:
+                self.check()
+            except Exception as e:
+                # Keep watching, the next change might fix it.
+                print(f"LinkManager: updating links failed: {e}")
+        if self.netlink is not None:
+            self.selector.close()
+            self.netlink.close()
+
+    def stats(self):
+        return {
+            "links": self.ip_addrs,
+            "netlink": self.netlink is not None,
+            "changes": self.changes,
+            "last_change_age": round(monotonic() - self.last_change, 1) if self.last_change else None,
+            "srtla_reloads": self.srtla.reloads,
+            "srtla_restarts": self.srtla.restarts,
+        }
+
+    def stop(self):
+        """
+        Stops watching. It's noticed within poll_interval.
+        """
+        self.event.set()
@@ -0,0 +1,265 @@
+"""
+Stand-in for gstd, for running the API and benchmarks without a Jetson.
+It speaks gstd's TCP protocol (a command line in, a json response and a null byte out) and keeps a model of the pipelines:
+each pipeline description is parsed into named elements and their properties, which element_set/element_get and read then work on.
+Nothing is actually run.
+
+Usage:
+    python mock_gstd.py [--port 5000] [--latency-ms 1.0] [--command-latency element_set=5,list_elements=10]
+"""
+import argparse
+import json
+import re
+import socketserver
+import threading
+import time
+from collections import Counter
+
+SUCCESS = {"code": 0, "description": "Success", "response": None}
+NOT_FOUND = {"code": 4, "description": "Resource not found", "response": None}
+BAD_COMMAND = {"code": 2, "description": "Bad command", "response": None}
+EXISTS = {"code": 5, "description": "Resource already exists", "response": None}
+
+
+def parse_description(description, factory_counts):
+    """
+    Find the elements and their properties in a gst-launch style description.
+    Elements without a name= get one like gstreamer does: the factory name and a number, counting up across all pipelines.
+    Args:
+        description (str): Pipeline description.
+        factory_counts (Counter): How many of each factory have been named so far.
+    Returns:
+        dict: Element name to a dict of its properties.
+    """
+    elements = {}
+    current = None
+    for token in re.findall(r'(?:[^\s"]|"[^"]*")+', description):
+        if token == "!" or token.endswith("."):
+            # Links, and references to named elements' pads like "mux."
+            continue
+        key, sep, value = token.partition("=")
+        if "/" in key or "," in key:
+            # Caps.
+            continue
+        if sep:
+            if current is not None:
+                current[key] = value.strip('"')
+            continue
+        current = {"factory": token}
+        elements[(token, len(elements))] = current
+    named = {}
+    for (factory, _), props in elements.items():
+        name = props.pop("name", None)
+        if name is None:
+            name = f"{factory}{factory_counts[factory]}"
+            factory_counts[factory] += 1
+        named[name] = props
+    return named
+
+
+class MockGstdState(object):
+    """
+    The pipelines and counters, shared by every connection.
+    """
+    def __init__(self, latency=0.0, command_latency=None):
+        """
+        Args:
+            latency (float, optional): Seconds every command takes. Defaults to 0.0.
+            command_latency (dict, optional): Command name to seconds, overriding latency for those commands. Defaults to None.
+        """
+        self.latency = latency
+        self.command_latency = command_latency or {}
+        self.lock = threading.Lock()
+        # bus_read waits on this for messages to be posted.
+        self.bus_changed = threading.Condition(self.lock)
+        self.pipelines = {}
+        self.factory_counts = Counter()
+        self.counts = Counter()
+        self.connections = 0
+
+    def reset_counts(self):
+        with self.lock:
+            self.counts = Counter()
+
+    def handle(self, line):
+        """
+        Run one command.
+        Returns:
+            dict: The json response.
+        """
+        parts = line.strip().split(" ", 1)
+        cmd = parts[0]
+        args = parts[1] if len(parts) > 1 else ""
+        delay = self.command_latency.get(cmd, self.latency)
+        if delay:
+            time.sleep(delay)
+        with self.lock:
+            self.counts[cmd] += 1
+            handler = getattr(self, f"cmd_{cmd}", None)
+            if handler is None:
+                return BAD_COMMAND
+            try:
+                return handler(args)
+            except (KeyError, ValueError):
+                return NOT_FOUND
+
+    def cmd_pipeline_create(self, args):
+        name, description = args.split(" ", 1)
+        if name in self.pipelines:
+            return EXISTS
+        self.pipelines[name] = {
+            "state": "NULL", "description": description, "elements": parse_description(description, self.factory_counts),
+            "bus": [], "bus_filter": [], "bus_timeout": -1,
+        }
+        return SUCCESS
+
+    def set_state(self, name, state):
+        self.pipelines[name.strip()]["state"] = state
+        return SUCCESS
+
+    def cmd_pipeline_play(self, args):
+        return self.set_state(args, "PLAYING")
+
+    def cmd_pipeline_pause(self, args):
+        return self.set_state(args, "PAUSED")
+
+    def cmd_pipeline_stop(self, args):
+        return self.set_state(args, "NULL")
+
+    def cmd_pipeline_delete(self, args):
+        del self.pipelines[args.strip()]
+        self.bus_changed.notify_all()
+        return SUCCESS
+
+    def cmd_event_eos(self, args):
+        self.pipelines[args.strip()]
+        return SUCCESS
+
+    def cmd_element_set(self, args):
+        pipe, element, prop, value = args.split(" ", 3)
+        self.pipelines[pipe]["elements"][element][prop] = value
+        return SUCCESS
+
+    def cmd_element_get(self, args):
+        pipe, element, prop = args.split(" ", 2)
+        value = self.pipelines[pipe]["elements"][element][prop]
+        return dict(SUCCESS, response={"name": prop, "value": value, "param": {"access": "((GParamFlags) 3)"}})
+
+    def post_message(self, pipe, msg_type="error", message="Mock error", source="mock"):
+        """
+        Put a message on a pipeline's bus, like an element would. For testing how errors are handled.
+        """
+        with self.lock:
+            self.pipelines[pipe]["bus"] += [{"type": msg_type, "source": source, "timestamp": time.time(), "seqnum": 0, "message": message, "debug": ""}]
+            self.bus_changed.notify_all()
+
+    def cmd_bus_filter(self, args):
+        pipe, types = args.split(" ", 1)
+        self.pipelines[pipe]["bus_filter"] = [x for x in types.strip().split("+") if x]
+        return SUCCESS
+
+    def cmd_bus_timeout(self, args):
+        pipe, timeout = args.split(" ", 1)
+        self.pipelines[pipe]["bus_timeout"] = int(timeout)
+        return SUCCESS
+
+    def cmd_bus_read(self, args):
+        """
+        Wait up to the pipeline's bus_timeout (nanoseconds, -1 is forever) for a message that passes its bus_filter.
+        """
+        name = args.strip()
+        pipe = self.pipelines[name]
+        timeout = None if pipe["bus_timeout"] < 0 else pipe["bus_timeout"] / 1e9
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if name not in self.pipelines:
+                # Deleted while waiting.
+                return NOT_FOUND
+            # Other messages are dropped, as gstd does.
+            pipe["bus"] = [x for x in pipe["bus"] if not pipe["bus_filter"] or x["type"] in pipe["bus_filter"]]
+            if pipe["bus"]:
+                return dict(SUCCESS, response=pipe["bus"].pop(0))
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return SUCCESS
+            self.bus_changed.wait(remaining)
+
+    def cmd_list_pipelines(self, args):
+        return self.cmd_read("pipelines")
+
+    def cmd_read(self, args):
+        path = [x for x in args.strip().split("/") if x]
+        if path == ["pipelines"]:
+            return dict(SUCCESS, response={"name": "pipelines", "nodes": [{"name": x} for x in self.pipelines]})
+        pipe = self.pipelines[path[1]]
+        if path[2:] == ["elements"]:
+            return dict(SUCCESS, response={"name": "elements", "nodes": [{"name": x} for x in pipe["elements"]]})
+        if path[2:] == ["state"]:
+            return dict(SUCCESS, response={"name": "state", "value": pipe["state"], "param": {"access": "((GParamFlags) 3)"}})
+        if len(path) == 6 and path[2] == "elements" and path[4] == "properties":
+            return dict(SUCCESS, response={"name": path[5], "value": pipe["elements"][path[3]][path[5]], "param": {"access": "((GParamFlags) 3)"}})
+        return NOT_FOUND
+
+
+class GstdHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        state = self.server.state
+        with state.lock:
+            state.connections += 1
+        while True:
+            data = self.request.recv(65536)
+            if not data:
+                return
+            # Clients wait for each response before sending another command, so one read is one command.
+            res = state.handle(data.decode("utf-8").rstrip("\x00"))
+            self.request.sendall(json.dumps(res).encode("utf-8") + b"\x00")
+
+
+class MockGstd(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host="localhost", port=0, latency=0.0, command_latency=None):
+        """
+        Args:
+            port (int, optional): Port to listen on. 0 picks a free one, see self.port. Defaults to 0.
+            latency (float, optional): Seconds every command takes. Defaults to 0.0.
+            command_latency (dict, optional): Command name to seconds, for commands that take longer or shorter. Defaults to None.
+        """
+        self.state = MockGstdState(latency, command_latency)
+        super().__init__((host, port), GstdHandler)
+        self.port = self.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def parse_command_latency(arg):
+    """
+    Parse "element_set=5,list_elements=10" (milliseconds) into {"element_set": 0.005, "list_elements": 0.01}.
+    """
+    latency = {}
+    for item in filter(None, arg.split(",")):
+        cmd, ms = item.split("=")
+        latency[cmd.strip()] = float(ms) / 1000
+    return latency
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pretend to be gstd.")
+    parser.add_argument("--port", type=int, default=5000, help="Port to listen on. Defaults to 5000, the same as gstd.")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Milliseconds every command takes. Defaults to 0.")
+    parser.add_argument("--command-latency", default="", help="Per command latency in ms, like element_set=5,list_elements=10.")
+    args = parser.parse_args()
+    server = MockGstd(port=args.port, latency=args.latency_ms / 1000, command_latency=parse_command_latency(args.command_latency))
+    print(f"Mock gstd listening on port {server.port}.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print("Commands:", dict(server.state.counts))
@@ -0,0 +1,215 @@
+from abc import ABCMeta, abstractmethod
+from collections import deque
+
+
+def stat(stats, section, key, default=0):
+    """
+    Get one value out of srt-live-transmit's json stats, or default if it's missing.
+    """
+    try:
+        return stats[section][key]
+    except (KeyError, TypeError):
+        return default
+
+
+class RateController(object, metaclass=ABCMeta):
+    """
+    Base class for the encoder bitrate controllers.
+    A controller is given every SRT stats sample, and decides what the encoder bitrate should be.
+    It doesn't touch the encoder itself, so the same controller can be run live or in rate_sim.py against a recorded log.
+
+    To add one, subclass this, implement update(), and add it to CONTROLLERS.
+    """
+    name = ""
+
+    def __init__(self, config, bitrate_steps, preferred_bitrate):
+        """
+        Args:
+            config (dict): The [rate_control] config section.
+            bitrate_steps (list): The encoder's fallback bitrates, in bits/second.
+            preferred_bitrate (int): Nominal bitrate, in bits/second. This is where the controller starts.
+        """
+        self.config = config
+        self.steps = sorted(bitrate_steps, reverse=True)
+        self.max_bitrate = config.get("max_bitrate", preferred_bitrate)
+        self.min_bitrate = config.get("min_bitrate", min(bitrate_steps))
+        self.bitrate = preferred_bitrate
+
+    @abstractmethod
+    def update(self, stats, t):
+        """
+        Args:
+            stats (dict): Decoded json stats from srt-live-transmit.
+            t (float): time.monotonic() of the sample, or the replayed time in the simulator.
+        Returns:
+            int: The bitrate the encoder should be at, in bits/second. The same as self.bitrate for no change.
+        """
+
+    def reset(self, bitrate):
+        """
+        Carry on from bitrate, like after it's been set by hand.
+        """
+        self.bitrate = bitrate
+
+    def clamp(self, bitrate):
+        return int(max(self.min_bitrate, min(bitrate, self.max_bitrate)))
+
+
+class StepController(RateController):
+    """
+    The original behaviour: RTT with two thresholds, stepping through the fallback bitrates one at a time, with a cooldown after every step.
+    """
+    name = "step"
+
+    def __init__(self, config, bitrate_steps, preferred_bitrate):
+        super().__init__(config, bitrate_steps, preferred_bitrate)
+        self.rtt_backoff_threshold = config["backoff_rtt"]
+        self.rtt_normal_threshold = config["backoff_rtt_normal"]
+        self.cooldown_time = config["backoff_retry_time"]
+        self.backoff = 0
+        self.hold_until = None
+
+    def reset(self, bitrate):
+        super().reset(bitrate)
+        self.backoff = min(range(len(self.steps)), key=lambda idx: abs(self.steps[idx] - bitrate))
+
+    def update(self, stats, t):
+        if self.hold_until is not None and t < self.hold_until:
+            return self.bitrate
+        rtt = stat(stats, "link", "rtt")
+        if rtt >= self.rtt_backoff_threshold:
+            backoff = min(self.backoff + 1, len(self.steps) - 1)
+        elif self.backoff > 0 and rtt < self.rtt_normal_threshold:
+            backoff = self.backoff - 1
+        else:
+            return self.bitrate
+        if backoff != self.backoff:
+            self.backoff = backoff
+            self.bitrate = self.steps[backoff]
+            self.hold_until = t + self.cooldown_time
+        return self.bitrate
+
+
+class DelayGradientController(RateController):
+    """
+    Congestion control in the style of GCC: the bitrate is cut as soon as the queue along the path starts to grow, before it gets to loss.
+    Three signals are combined:
+        delay gradient: the trend of the smoothed RTT over the last few samples. A rising RTT means a queue is building.
+        send buffer: msBuf, how much video is waiting in srt-live-transmit's send buffer. It grows when the link can't keep up.
+        loss: lost and dropped packets as a fraction of those sent.
+    On overuse, the bitrate drops to decrease_factor of what's actually getting through. Otherwise, after hold_time, it increases:
+    multiplicatively (increase_rate per second) when well away from where congestion last happened, additively (additive_increase
+    bits/second per second) when close to it, so it doesn't keep overshooting the same limit.
+    The output is continuous, rounded to bitrate_quantum, and only changes by at least min_change so the encoder isn't constantly poked.
+    """
+    name = "delay_gradient"
+
+    def __init__(self, config, bitrate_steps, preferred_bitrate):
+        super().__init__(config, bitrate_steps, preferred_bitrate)
+        self.trend_samples = config.get("trend_samples", 12)
+        self.overuse_gradient = config.get("overuse_gradient", 20.0)  # ms of RTT growth per second
+        self.overuse_buffer = config.get("overuse_buffer", 250)  # ms in the send buffer
+        self.loss_high = config.get("loss_high", 0.1)
+        self.loss_low = config.get("loss_low", 0.02)
+        self.decrease_factor = config.get("decrease_factor", 0.85)
+        self.increase_rate = config.get("increase_rate", 0.08)
+        self.additive_increase = config.get("additive_increase", 100000)
+        self.hold_time = config.get("hold_time", 2.0)
+        self.quantum = config.get("bitrate_quantum", 50000)
+        self.min_change = config.get("min_change", 0.03)
+        self.rtt_smoothing = config.get("rtt_smoothing", 0.3)
+        self.reset(preferred_bitrate)
+
+    def reset(self, bitrate):
+        super().reset(bitrate)
+        self.target = float(bitrate)
+        self.rtts = deque(maxlen=self.trend_samples)
+        self.smoothed_rtt = None
+        self.loss = 0.0
+        self.last_time = None
+        self.hold_until = None
+        self.congestion_bitrate = None
+        self.signal = "normal"
+
+    def gradient(self):
+        """
+        Least squares slope of the smoothed RTT, in ms/second. None until there are enough samples.
+        """
+        if len(self.rtts) < max(3, self.trend_samples // 2):
+            return None
+        n = len(self.rtts)
+        mean_t = sum(t for t, _ in self.rtts) / n
+        mean_r = sum(r for _, r in self.rtts) / n
+        denom = sum((t - mean_t) ** 2 for t, _ in self.rtts)
+        if denom == 0:
+            return None
+        return sum((t - mean_t) * (r - mean_r) for t, r in self.rtts) / denom
+
+    def detect(self, stats):
+        """
+        Returns:
+            str: "overuse", "underuse" or "normal".
+        """
+        gradient = self.gradient()
+        if self.loss > self.loss_high:
+            return "overuse"
+        if stat(stats, "send", "msBuf") > self.overuse_buffer:
+            return "overuse"
+        if gradient is not None and gradient > self.overuse_gradient:
+            return "overuse"
+        if gradient is not None and gradient < -self.overuse_gradient:
+            # The queue is draining, let it empty before pushing harder.
+            return "underuse"
+        return "normal"
+
+    def update(self, stats, t):
+        dt = 0 if self.last_time is None else max(t - self.last_time, 0)
+        self.last_time = t
+        rtt = stat(stats, "link", "rtt")
+        if self.smoothed_rtt is None:
+            self.smoothed_rtt = rtt
+        self.smoothed_rtt += self.rtt_smoothing * (rtt - self.smoothed_rtt)
+        self.rtts.append((t, self.smoothed_rtt))
+        sent = stat(stats, "send", "packets")
+        lost = stat(stats, "send", "packetsLost") + stat(stats, "send", "packetsDropped")
+        if sent + lost > 0:
+            self.loss += 0.5 * (lost / (sent + lost) - self.loss)
+
+        self.signal = self.detect(stats)
+        if self.signal == "overuse":
+            if self.hold_until is None or t >= self.hold_until:
+                # Cut to below what's actually getting through, not what we're asking the encoder for.
+                send_rate = stat(stats, "send", "mbitRate") * 1000000
+                base = min(self.target, send_rate) if send_rate > 0 else self.target
+                if self.loss > self.loss_high:
+                    base *= 1 - 0.5 * self.loss
+                self.target = base * self.decrease_factor
+                self.congestion_bitrate = self.target / self.decrease_factor
+                self.hold_until = t + self.hold_time
+                self.rtts.clear()
+        elif self.signal == "normal" and self.loss < self.loss_low and (self.hold_until is None or t >= self.hold_until):
+            if self.congestion_bitrate is not None and self.target > 0.9 * self.congestion_bitrate:
+                self.target += self.additive_increase * dt
+            else:
+                self.target *= (1 + self.increase_rate) ** dt
+        self.target = self.clamp(self.target)
+
+        new_bitrate = self.clamp(round(self.target / self.quantum) * self.quantum)
+        if abs(new_bitrate - self.bitrate) >= self.min_change * self.bitrate or new_bitrate in (self.min_bitrate, self.max_bitrate):
+            self.bitrate = new_bitrate
+        return self.bitrate
+
+
+CONTROLLERS = {c.name: c for c in (StepController, DelayGradientController)}
+
+
+def make_controller(config, bitrate_steps, preferred_bitrate):
+    """
+    Create the controller named by config["controller"], "step" if it isn't set.
+    Args:
+        config (dict): The [rate_control] config section, with the [output1] backoff settings for the step controller.
+    """
+    name = config.get("controller", "step")
+    if name not in CONTROLLERS:
+        raise ValueError(f"Unknown rate controller {name}, expected one of {list(CONTROLLERS)}.")
+    return CONTROLLERS[name](config, bitrate_steps, preferred_bitrate)
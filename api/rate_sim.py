@@ -0,0 +1,159 @@
+"""
+Offline simulator for the bitrate controllers in rate_control.py.
+Replays a recorded srt-live-transmit json stats log as the link's capacity over time, and runs each controller against it.
+
+A recorded log can't say what would have happened at a different bitrate, so the link is modelled:
+    capacity: each sample's link.bandwidth (SRT's estimate of the path's capacity, Mb/s), times --capacity-scale.
+        Samples without one fall back to the recorded send rate.
+    base RTT: the lowest recorded RTT, plus half of each sample's RTT above that. The rest is assumed to be queueing, which is modelled instead.
+    queue: when the controller's bitrate is above the capacity, the excess queues up in the send buffer. Its delay is added to the RTT.
+    drops: anything that's been queued longer than --latency ms is dropped, as SRT does with packets that are too late.
+Each controller gets stats built from this model, so it sees the effect of its own decisions.
+
+Usage:
+    python rate_sim.py srt_stats.log [--controllers step,delay_gradient] [--interval 0.25]
+
+Recording a log on the Jetson: run srt-live-transmit with "-s 100 -pf json" and redirect its output to a file.
+"""
+import argparse
+import json
+
+import toml
+
+from rate_control import CONTROLLERS, make_controller, stat
+
+
+def load_stats(path):
+    """
+    Read the json stats records out of an srt-live-transmit log, skipping its other messages.
+    Returns:
+        list: Decoded stats records, in order.
+    """
+    records = []
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line.startswith("{"):
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.decoder.JSONDecodeError:
+                continue
+    return records
+
+
+class LinkModel(object):
+    """
+    Trace driven model of the link: one queue in front of a pipe whose capacity comes from the recorded stats.
+    """
+    def __init__(self, records, interval, latency, capacity_scale=1.0, packet_size=1316):
+        self.records = records
+        self.interval = interval
+        self.latency = latency
+        self.capacity_scale = capacity_scale
+        self.packet_bits = packet_size * 8
+        rtts = [stat(r, "link", "rtt") for r in records if stat(r, "link", "rtt") > 0]
+        self.min_rtt = min(rtts) if rtts else 0
+
+    def capacity(self, record):
+        """
+        Returns:
+            float: Capacity for this sample, in bits/second.
+        """
+        bandwidth = stat(record, "link", "bandwidth") or stat(record, "send", "mbitRate")
+        return bandwidth * 1000000 * self.capacity_scale
+
+    def run(self, controller):
+        """
+        Replay the whole log against one controller.
+        Returns:
+            dict: Totals for the run, see summarize().
+        """
+        queue = 0.0  # bits waiting to be sent
+        totals = {"offered": 0.0, "delivered": 0.0, "dropped": 0.0, "changes": 0, "time_at_min": 0.0, "max_rtt": 0.0}
+        bitrate = controller.bitrate
+        for idx, record in enumerate(self.records):
+            t = idx * self.interval
+            capacity = self.capacity(record)
+            offered = bitrate * self.interval
+            queue += offered
+            sent = min(queue, capacity * self.interval)
+            queue -= sent
+            # Anything that'd still be queued after the latency is too late, and SRT drops it.
+            max_queue = capacity * self.latency / 1000
+            dropped = max(queue - max_queue, 0)
+            queue -= dropped
+            queue_ms = queue / capacity * 1000 if capacity > 0 else self.latency
+            # Keep the recorded RTT's variation, but not the queueing that was in it, as that's modelled here.
+            rtt = max(stat(record, "link", "rtt") - self.min_rtt, 0) * 0.5 + self.min_rtt + queue_ms
+            stats = {
+                "link": {"rtt": rtt, "bandwidth": capacity / 1000000},
+                "window": {"flight": round(queue / self.packet_bits), "flow": stat(record, "window", "flow")},
+                "send": {
+                    "mbitRate": sent / self.interval / 1000000,
+                    "packets": round(sent / self.packet_bits),
+                    "packetsDropped": round(dropped / self.packet_bits),
+                    "packetsLost": 0,
+                    "packetsRetransmitted": 0,
+                    "msBuf": queue_ms,
+                },
+            }
+            new_bitrate = controller.update(stats, t)
+            if new_bitrate != bitrate:
+                totals["changes"] += 1
+            bitrate = new_bitrate
+            totals["offered"] += offered
+            totals["delivered"] += sent
+            totals["dropped"] += dropped
+            totals["max_rtt"] = max(totals["max_rtt"], rtt)
+            if bitrate <= controller.min_bitrate:
+                totals["time_at_min"] += self.interval
+        return self.summarize(totals)
+
+    def summarize(self, totals):
+        duration = len(self.records) * self.interval
+        return {
+            "duration": round(duration, 2),
+            "goodput_mbps": round(totals["delivered"] / duration / 1000000, 3) if duration else 0,
+            "mean_bitrate_mbps": round(totals["offered"] / duration / 1000000, 3) if duration else 0,
+            "drop_rate": round(totals["dropped"] / totals["offered"], 4) if totals["offered"] else 0,
+            "bitrate_changes": totals["changes"],
+            "time_at_min": round(totals["time_at_min"], 2),
+            "max_rtt": round(totals["max_rtt"], 1),
+        }
+
+
+def simulate(records, controllers, config, interval=0.25, latency=2000, capacity_scale=1.0):
+    """
+    Run each of the named controllers against the same log.
+    Returns:
+        dict: Controller name to the results of its run.
+    """
+    encoder_cfg = config["encoder"]
+    model = LinkModel(records, interval, latency, capacity_scale)
+    results = {}
+    for name in controllers:
+        rc_config = dict(config["output1"], **config.get("rate_control", {}))
+        rc_config["controller"] = name
+        controller = make_controller(rc_config, encoder_cfg["fallback_bitrates"], encoder_cfg["preferred_bitrate"])
+        results[name] = model.run(controller)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare bitrate controllers on a recorded srt-live-transmit stats log.")
+    parser.add_argument("log", help="srt-live-transmit output, recorded with -pf json.")
+    parser.add_argument("--controllers", default=",".join(CONTROLLERS), help="Comma separated controllers to run. Defaults to all of them.")
+    parser.add_argument("--interval", type=float, default=0.25, help="Seconds between stats records in the log. Defaults to 0.25.")
+    parser.add_argument("--latency", type=float, default=2000, help="SRT latency in ms, queued data older than this is dropped. Defaults to 2000.")
+    parser.add_argument("--capacity-scale", type=float, default=1.0, help="Scale the recorded capacity, to try a worse or better link. Defaults to 1.0.")
+    parser.add_argument("--config", default="config.toml", help="Config file to take the encoder and controller settings from.")
+    args = parser.parse_args()
+
+    records = load_stats(args.log)
+    if not records:
+        raise SystemExit(f"No json stats found in {args.log}.")
+    with open(args.config, "r") as f:
+        config = toml.load(f)
+    results = simulate(records, args.controllers.split(","), config, args.interval, args.latency, args.capacity_scale)
+    print(json.dumps(results, indent=2))
@@ -1,12 +1,13 @@
+import signal
 import threading
 import subprocess
-import select
+import selectors
 import json
-from os import set_blocking
+from os import set_blocking, read
 
 
 class SRTThread(threading.Thread):
-    def __init__(self, passphrase, srt_destination, srt_source="udp://:4200", stats_interval=100, update_interval=0.1):
+    def __init__(self, passphrase, srt_destination, srt_source="udp://:4200", stats_interval=100, update_interval=None, skip_to_latest=True):
         """
         Wrapper thread to start/stop srt-live-transmit and get stats out of it.
         Source and destination as per documentation at: https://github.com/Haivision/srt/blob/master/docs/srt-live-transmit.md
@@ -15,7 +16,9 @@ class SRTThread(threading.Thread):
             srt_source (str, optional): Port and protocol that srt-live-transmit listens on. Defaults to "udp://:4200"
                 Ideally this would be using SRT, but the build of gstreamer that comes with the Jetson doesn't support it.
             stats_interval (int, optional): How often to update the SRT stats, in _packets_, not time. Defaults to 100.
-            update_interval (float, optional): How often to should read stats from the process, too often and it blocks the web thread, not often enough and output from the process gets blocked.. Defaults to 0.1.
+            update_interval (float, optional): Longest time, in seconds, to block waiting on the process.
+                None blocks until there's output, as stats and messages are read as soon as they arrive. Defaults to None.
+            skip_to_latest (bool, optional): Only decode the newest stats record of each burst read from the process. Defaults to True.
         """
         self.event = threading.Event()
         self.stats_interval = stats_interval
@@ -29,13 +32,26 @@ class SRTThread(threading.Thread):
         self.dst_conn = f"{srt_destination}{d}passphrase={self.passphrase}&enforcedencryption=true"
         self.srt_process = self.start_process()
         set_blocking(self.srt_process.stdout.fileno(), False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.srt_process.stdout, selectors.EVENT_READ)
+        self.read_size = 65536
+        self.buffer = bytearray()
+        self.eof = False
         self.last_message = ''
         self.last_stats = {}
+        # Consumers can wait on this to be woken as soon as new stats or a message arrive, instead of polling.
+        self.update_cond = threading.Condition()
+        self.update_count = 0
+        self.update_listeners = []
+        self.skip_to_latest = skip_to_latest
+        self.skipped_stats = 0
+        self.skipped_stats_total = 0
         super().__init__(group=None)
 
     def run(self):
         """
         Get the stats and save the last one to this object.
+        There's no sleep here, get_raw_stats() blocks until srt-live-transmit has output.
         """
         while not self.event.is_set():
             stats, msg = self.stats_parse()
@@ -44,7 +60,37 @@ class SRTThread(threading.Thread):
             if msg:
                 self.last_message = msg[-1]
                 print(f"Message: {msg}")
-            self.event.wait(self.update_interval)
+            if stats or msg:
+                self.publish_update()
+
+    def publish_update(self):
+        """
+        Wake up anything waiting in wait_for_update(), and call the update listeners.
+        """
+        with self.update_cond:
+            self.update_count += 1
+            self.update_cond.notify_all()
+        for callback in self.update_listeners:
+            callback()
+
+    def add_update_listener(self, callback):
+        """
+        Call callback() from this thread whenever there are new stats or a message. It needs to be quick, like setting an Event.
+        """
+        self.update_listeners += [callback]
+
+    def wait_for_update(self, last_count, timeout=None):
+        """
+        Block until there are stats or a message newer than last_count, or the timeout expires.
+        Args:
+            last_count (int): The update_count the caller last saw.
+            timeout (float, optional): Longest time to wait, in seconds. None waits forever. Defaults to None.
+        Returns:
+            int: The current update_count. If it's the same as last_count, the wait timed out.
+        """
+        with self.update_cond:
+            self.update_cond.wait_for(lambda: self.update_count != last_count, timeout)
+            return self.update_count
 
     def start_process(self):
         """
@@ -63,28 +109,41 @@ class SRTThread(threading.Thread):
 
     def get_raw_stats(self):
         """
-        Get the raw stats from the SRT process.
+        Get the raw stats from the SRT process, blocking until there are some (or update_interval passes).
+        Reads go straight to the fd into a reusable buffer, partial lines are kept until the rest arrives.
         Returns:
-            bytestring: Raw output strings from srt-live-transmit's stderr and stdout.
+            list: Raw output lines from srt-live-transmit's stderr and stdout, without line endings.
         """
-        res = []
-        idx = 0
-        while True:
-            idx += 1
-            l = self.srt_process.stdout.readline()
-            if l == b'':
-                break
-            res += [l]
-        return res
+        if self.eof:
+            # The pipe stays readable at EOF, so don't spin on it.
+            self.event.wait(self.update_interval)
+            return []
+        if not self.selector.select(self.update_interval):
+            return []
+        chunk = read(self.srt_process.stdout.fileno(), self.read_size)
+        if not chunk:
+            print("srt-live-transmit output closed.")
+            self.eof = True
+            return []
+        self.buffer += chunk
+        end = self.buffer.rfind(b'\n')
+        if end == -1:
+            return []
+        lines = [x for x in self.buffer[:end].splitlines() if x.strip()]
+        del self.buffer[:end + 1]
+        return lines
 
 
     def stats_parse(self):
         """
         Parses a raw message from srt-live-transmit, into either a dict or a message.
+        With skip_to_latest, only the newest stats record in a burst is decoded, older ones are counted and dropped.
         Returns:
             tuple: message (empty if there isn't one, making this json only), dictionary (empty, otherwise decoded json).
         """
         raw_stats = self.get_raw_stats()
+        if self.skip_to_latest:
+            return self.stats_parse_latest(raw_stats)
         messages = []
         stats = []
         for line in raw_stats:
@@ -94,6 +153,36 @@ class SRTThread(threading.Thread):
                 messages += [line.decode('ASCII')]
         return stats, messages
 
+    def stats_parse_latest(self, raw_stats):
+        """
+        Scans the lines backwards, decoding only the newest stats record plus any messages.
+        When we fall behind, a burst can be hundreds of stats lines and only the last one is used anyway.
+        Args:
+            raw_stats (list): Raw output lines from srt-live-transmit.
+        Returns:
+            tuple: stats (list with at most the newest decoded json), messages (in the order they arrived).
+        """
+        messages = []
+        stats = []
+        skipped = 0
+        for line in reversed(raw_stats):
+            if line.startswith(b'{'):
+                if stats:
+                    skipped += 1
+                    continue
+                try:
+                    stats = [json.loads(line)]
+                    continue
+                except json.decoder.JSONDecodeError:
+                    pass
+            messages += [line.decode('ASCII')]
+        messages.reverse()
+        self.skipped_stats = skipped
+        if skipped:
+            self.skipped_stats_total += skipped
+            print(f"SRT: Skipped {skipped} stale stats records, {self.skipped_stats_total} total.")
+        return stats, messages
+
     def stop(self):
         """
         Stops the srt-live-transmit process and the stats-gathering loop.
@@ -102,8 +191,20 @@ class SRTThread(threading.Thread):
         self.event.set()
 
 class SRTLAThread(threading.Thread):
-    def __init__(self, srtla_send="srtla_send", source_port=6000, destination_host="localhost", destination_port=4000, ip_file="srtla_ips.txt"):
+    def __init__(self, srtla_send="srtla_send", source_port=6000, destination_host="localhost", destination_port=4000, ip_file="srtla_ips.txt", telemetry=None):
+        """
+        Args:
+            telemetry (SRTLATelemetry, optional): Given srtla_send's output and sampled, for per link stats. Defaults to None.
+        """
         self.event = threading.Event()
+        self.telemetry = telemetry
+        self.partial = b""
+        # Held while srtla_send is being restarted, so the output isn't read from a process that's going away.
+        self.process_lock = threading.Lock()
+        self.restarts = 0
+        self.reloads = 0
+        # Seconds to wait before starting srtla_send again if it exits by itself.
+        self.restart_delay = 1.0
         self.src_port = source_port
         self.dst_port = destination_port
         self.srtla_exec = srtla_send
@@ -122,16 +223,53 @@ class SRTLAThread(threading.Thread):
         """
         srtla_cmd = f"{self.srtla_exec} {self.src_port} {self.host} {self.dst_port} {self.ip_file}"
         print(f"starting srtla: {srtla_cmd}")
+        # exec, so the process is srtla_send itself and not a shell. Otherwise signals only reach the shell, and srtla_send is left running.
         return subprocess.Popen(
-            f"{srtla_cmd}", shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+            f"exec {srtla_cmd}", shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
         )
 
     def kill_process(self):
         """
-        Start the SRT process.
+        Kill the srtla_send process.
         """
         self.srtla_process.kill()
 
+    @property
+    def process_running(self):
+        return self.srtla_process.poll() is None
+
+    def reload(self):
+        """
+        Make srtla_send read the IP file again. It's sent a SIGHUP, which it handles without dropping the links that are still there.
+        If it isn't running any more, it's started again instead.
+        """
+        with self.process_lock:
+            if self.process_running:
+                self.srtla_process.send_signal(signal.SIGHUP)
+                self.reloads += 1
+                return
+        print("SRTLA: srtla_send isn't running, starting it.")
+        self.restart()
+
+    def restart(self):
+        """
+        Restart srtla_send. The new one is only started once the old one has exited, so the listen port is free.
+        This thread, and anything using it, carries on.
+        """
+        with self.process_lock:
+            if self.process_running:
+                self.srtla_process.terminate()
+                try:
+                    self.srtla_process.wait(timeout=5)
+                except subprocess.TimeoutExpired:
+                    print("SRTLA: old srtla_send didn't exit, killing it.")
+                    self.kill_process()
+                    self.srtla_process.wait()
+            self.srtla_process = self.start_process()
+            set_blocking(self.srtla_process.stdout.fileno(), False)
+            self.partial = b""
+            self.restarts += 1
+
     def stop(self):
         """
         Stops the srt-live-transmit process and the stats-gathering loop.
@@ -145,7 +283,28 @@ class SRTLAThread(threading.Thread):
         """
         print("SRTLA thread running.")
         while not self.event.is_set():
-            msg = self.srtla_process.stdout.read()
+            with self.process_lock:
+                msg = self.srtla_process.stdout.read()
             if msg:
-                print(f"SRTLA Message: {msg.decode('ASCII')}")
-            self.event.wait(0.1)
\ No newline at end of file
+                print(f"SRTLA Message: {msg.decode('ASCII', errors='replace')}")
+                self.handle_output(msg)
+            if self.telemetry is not None:
+                self.telemetry.sample()
+            if not self.process_running and not self.event.is_set():
+                print(f"SRTLA: srtla_send exited with code {self.srtla_process.returncode}, restarting in {self.restart_delay}s.")
+                if self.event.wait(self.restart_delay):
+                    break
+                self.restart()
+            self.event.wait(0.1)
+
+    def handle_output(self, msg):
+        """
+        Split srtla_send's output into lines for the telemetry. A line that's been cut off is kept until the rest of it arrives.
+        """
+        if self.telemetry is None:
+            return
+        *lines, self.partial = (self.partial + msg).split(b"\n")
+        for line in lines:
+            line = line.decode("ASCII", errors="replace").strip()
+            if line:
+                self.telemetry.parse(line)
\ No newline at end of file
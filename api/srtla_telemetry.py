@@ -0,0 +1,206 @@
+import re
+import threading
+from collections import deque
+from time import monotonic
+
+IP_RE = re.compile(r"\b(\d{1,3}(?:\.\d{1,3}){3})\b")
+# "key: value" or "key=value" numbers, like the in_flight and window counts srtla_send prints when built with debugging.
+VALUE_RE = re.compile(r"\b([a-z_]+)[:=] ?(-?\d+)\b")
+# srtla_send's messages aren't a stable format, so link events are picked out by keyword.
+LINK_EVENTS = (
+    ("down", ("fail", "timed out", "timeout", "error", "disconnect")),
+    ("up", ("established", "registered", "connected")),
+    ("added", ("added connection",)),
+)
+COUNTERS = ("tx_bytes", "rx_bytes", "tx_packets", "rx_packets", "tx_errors", "tx_dropped")
+
+
+def read_counters(iface, sys_path="/sys/class/net"):
+    """
+    Read an interface's traffic counters from the kernel.
+    Returns:
+        dict: Counter name to value, or None if the interface has gone away.
+    """
+    counters = {}
+    try:
+        for name in COUNTERS:
+            with open(f"{sys_path}/{iface}/statistics/{name}", "r") as f:
+                counters[name] = int(f.read())
+    except (OSError, ValueError):
+        return None
+    return counters
+
+
+class LinkStats(object):
+    """
+    Telemetry for one bonded link: srtla_send's state for it and a rolling history of its traffic.
+    """
+    def __init__(self, iface, ip, history=60):
+        self.iface = iface
+        self.ip = ip
+        self.state = "unknown"
+        self.state_since = monotonic()
+        self.events = {"up": 0, "down": 0, "added": 0}
+        self.last_message = None
+        self.values = {}
+        self.last_counters = None
+        self.last_sample = None
+        # (time, tx bits/second, rx bits/second, tx packets/second, rx packets/second)
+        self.series = deque(maxlen=history)
+
+    def event(self, kind, msg):
+        self.events[kind] += 1
+        self.last_message = msg
+        state = "up" if kind == "added" else kind
+        if state != self.state:
+            self.state = state
+            self.state_since = monotonic()
+
+    def sample(self, t, counters):
+        """
+        Add a sample of the interface counters, and the rates since the last one to the series.
+        """
+        if counters is None:
+            self.last_counters = None
+            return
+        if self.last_counters is not None and t > self.last_sample:
+            dt = t - self.last_sample
+            delta = {k: max(counters[k] - self.last_counters[k], 0) for k in COUNTERS}
+            self.series.append((
+                round(t, 3),
+                delta["tx_bytes"] * 8 / dt,
+                delta["rx_bytes"] * 8 / dt,
+                delta["tx_packets"] / dt,
+                delta["rx_packets"] / dt,
+            ))
+        self.last_counters = counters
+        self.last_sample = t
+
+    def as_dict(self, window):
+        """
+        Args:
+            window (int): Number of the most recent samples to average the rates over.
+        """
+        recent = list(self.series)[-window:]
+        def avg(idx):
+            return sum(x[idx] for x in recent) / len(recent) if recent else 0
+        return {
+            "iface": self.iface,
+            "ip": self.ip,
+            "state": self.state,
+            "state_age": round(monotonic() - self.state_since, 1),
+            "events": dict(self.events),
+            "tx_mbps": round(avg(1) / 1000000, 3),
+            "rx_mbps": round(avg(2) / 1000000, 3),
+            "tx_pps": round(avg(3), 1),
+            "rx_pps": round(avg(4), 1),
+            "tx_errors": self.last_counters["tx_errors"] if self.last_counters else None,
+            "tx_dropped": self.last_counters["tx_dropped"] if self.last_counters else None,
+            "values": dict(self.values),
+            "last_message": self.last_message,
+        }
+
+
+class SRTLATelemetry(object):
+    """
+    Per link telemetry for srtla_send.
+    srtla_send only says when links come and go, so traffic is measured from each link's interface counters instead.
+    Those count everything on the interface, not just srtla, which is fine as long as the modems aren't used for anything else.
+    """
+    def __init__(self, links, sample_interval=1.0, history=60, window=5, sys_path="/sys/class/net"):
+        """
+        Args:
+            links (dict): {"interface": ["ip addresses"]}, as returned by helpers.find_ips().
+            sample_interval (float, optional): Seconds between samples of the interface counters. Defaults to 1.0.
+            history (int, optional): Samples kept for each link. Defaults to 60.
+            window (int, optional): The rates returned are averaged over this many samples. Defaults to 5.
+            sys_path (str, optional): Where to read interface counters from. Defaults to "/sys/class/net".
+        """
+        self.sample_interval = sample_interval
+        self.history = history
+        self.window = window
+        self.sys_path = sys_path
+        self.lock = threading.Lock()
+        self.links = {}
+        self.unmatched = deque(maxlen=20)
+        self.next_sample = 0
+        self.set_links(links)
+
+    def set_links(self, links):
+        """
+        Replace the set of links, keeping the history of any that are still there.
+        """
+        with self.lock:
+            old = self.links
+            self.links = {}
+            for iface, ips in links.items():
+                for ip in ips:
+                    self.links[ip] = old.get(ip) or LinkStats(iface, ip, self.history)
+
+    def parse(self, msg):
+        """
+        Parse a line of srtla_send output, and update the link it's about.
+        Returns:
+            LinkStats: The link the line was about, or None if it wasn't about any known link.
+        """
+        lower = msg.lower()
+        with self.lock:
+            link = next((self.links[ip] for ip in IP_RE.findall(msg) if ip in self.links), None)
+            if link is None:
+                self.unmatched.append(msg)
+                return None
+            for kind, keywords in LINK_EVENTS:
+                if any(k in lower for k in keywords):
+                    link.event(kind, msg)
+                    break
+            else:
+                link.last_message = msg
+            for key, value in VALUE_RE.findall(lower):
+                link.values[key] = int(value)
+        return link
+
+    def sample(self, now=None):
+        """
+        Sample the interface counters, if sample_interval has passed since the last time.
+        Returns:
+            bool: Whether a sample was taken.
+        """
+        now = monotonic() if now is None else now
+        if now < self.next_sample:
+            return False
+        self.next_sample = now + self.sample_interval
+        with self.lock:
+            for link in self.links.values():
+                link.sample(now, read_counters(link.iface, self.sys_path))
+        return True
+
+    def as_dict(self):
+        """
+        Returns:
+            dict: Per link stats, plus totals over the whole bond.
+        """
+        with self.lock:
+            links = [link.as_dict(self.window) for link in self.links.values()]
+            unmatched = list(self.unmatched)
+        bonded = sum(x["tx_mbps"] for x in links)
+        for x in links:
+            # Each link's share of the bond, which makes a modem that isn't pulling its weight easy to spot.
+            x["share"] = round(x["tx_mbps"] / bonded, 3) if bonded else None
+        return {
+            "links": links,
+            "links_up": sum(1 for x in links if x["state"] != "down"),
+            "bonded_tx_mbps": round(bonded, 3),
+            "bonded_rx_mbps": round(sum(x["rx_mbps"] for x in links), 3),
+            "sample_interval": self.sample_interval,
+            "window": self.window,
+            "recent_messages": unmatched,
+        }
+
+    def series(self, ip):
+        """
+        Returns:
+            list: The full rate history for one link, as dicts.
+        """
+        with self.lock:
+            samples = list(self.links[ip].series)
+        return [{"t": t, "tx_mbps": round(tx / 1000000, 3), "rx_mbps": round(rx / 1000000, 3), "tx_pps": round(tp, 1), "rx_pps": round(rp, 1)} for t, tx, rx, tp, rp in samples]
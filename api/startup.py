@@ -0,0 +1,160 @@
+import json
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+from time import monotonic
+
+import falcon
+
+
+class Stage(object):
+    def __init__(self, name, func, after=()):
+        """
+        One step of the startup.
+        Args:
+            name (str): Name of the stage, also the name its result is passed to later stages as.
+            func (callable): Does the work. Called with the results of the stages in after as keyword arguments.
+            after (list, optional): Names of the stages that need to finish first. Defaults to ().
+        """
+        self.name = name
+        self.func = func
+        self.after = list(after)
+        self.status = "waiting"
+        self.started = None
+        self.seconds = None
+        self.error = None
+        self.result = None
+
+    def as_dict(self):
+        return {"status": self.status, "after": self.after, "started": self.started, "seconds": self.seconds, "error": self.error}
+
+
+class Startup(object):
+    """
+    Runs the startup stages, each one as soon as the ones it needs are done, so independent ones run at the same time.
+    Also the falcon resource for /health, which reports how far along it is.
+    """
+    def __init__(self, max_workers=4, debug=False):
+        """
+        Args:
+            max_workers (int, optional): Most stages running at once. Defaults to 4.
+            debug (bool, optional): Print each stage as it finishes. Defaults to False.
+        """
+        self.max_workers = max_workers
+        self.debug = debug
+        self.stages = {}
+        self.start_time = None
+        self.seconds = None
+        self.finished = threading.Event()
+
+    def add(self, name, func, after=()):
+        """
+        Add a stage. Stages can only depend on ones that have already been added.
+        """
+        missing = [x for x in after if x not in self.stages]
+        if missing:
+            raise ValueError(f"Startup stage {name} is after unknown stages {missing}.")
+        self.stages[name] = Stage(name, func, after)
+
+    @property
+    def ready(self):
+        return self.finished.is_set() and all(x.status == "done" for x in self.stages.values())
+
+    @property
+    def failed(self):
+        return any(x.status in ("failed", "skipped") for x in self.stages.values())
+
+    def run_stage(self, stage):
+        stage.started = round(monotonic() - self.start_time, 3)
+        start = monotonic()
+        try:
+            stage.result = stage.func(**{x: self.stages[x].result for x in stage.after})
+            stage.status = "done"
+        except Exception as e:
+            stage.status = "failed"
+            stage.error = repr(e)
+            print(f"[{datetime.now()}] Startup: {stage.name} failed:")
+            traceback.print_exc()
+        stage.seconds = round(monotonic() - start, 3)
+        if self.debug:
+            print(f"[{datetime.now()}] Startup: {stage.name} {stage.status} in {stage.seconds}s.")
+
+    def run(self):
+        """
+        Run all the stages, blocking until they're finished. If a stage fails, the ones after it are skipped.
+        """
+        self.start_time = monotonic()
+        running = {}
+        with ThreadPoolExecutor(self.max_workers) as pool:
+            while True:
+                for stage in self.stages.values():
+                    if stage.status != "waiting":
+                        continue
+                    before = [self.stages[x].status for x in stage.after]
+                    if any(x in ("failed", "skipped") for x in before):
+                        stage.status = "skipped"
+                    elif all(x == "done" for x in before):
+                        # Set here, not in run_stage, or the next time round it could be submitted again before it's started.
+                        stage.status = "running"
+                        running[pool.submit(self.run_stage, stage)] = stage
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    del running[future]
+        self.seconds = round(monotonic() - self.start_time, 3)
+        self.finished.set()
+        print(f"[{datetime.now()}] Startup: {'failed' if self.failed else 'finished'} in {self.seconds}s.")
+
+    def start(self):
+        """
+        Run the stages in a background thread.
+        """
+        thread = threading.Thread(target=self.run, name="startup", daemon=True)
+        thread.start()
+        return thread
+
+    def result(self, name):
+        return self.stages[name].result
+
+    def as_dict(self):
+        elapsed = self.seconds
+        if elapsed is None and self.start_time is not None:
+            elapsed = round(monotonic() - self.start_time, 3)
+        return {
+            "ready": self.ready,
+            "failed": self.failed,
+            "seconds": elapsed,
+            "stages": {k: v.as_dict() for k, v in self.stages.items()},
+        }
+
+    def on_get(self, req, res):
+        res.body = json.dumps(self.as_dict())
+        res.status = falcon.HTTP_200 if self.ready else falcon.HTTP_503
+
+
+class StartupApp(object):
+    """
+    WSGI app to give to gunicorn while the startup is running.
+    Until ready() is called with the real app, only /health answers, everything else gets a 503.
+    """
+    def __init__(self, startup):
+        self.startup = startup
+        self.app = falcon.API()
+        self.app.add_route("/health", startup)
+        self.app.add_sink(self.starting)
+
+    def starting(self, req, res):
+        if self.startup.failed:
+            raise falcon.HTTPServiceUnavailable(description="Startup failed, see /health.")
+        raise falcon.HTTPServiceUnavailable(description="Starting up, see /health.", retry_after=1)
+
+    def ready(self, app):
+        """
+        Start handing requests to app.
+        """
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        return self.app(environ, start_response)
@@ -0,0 +1,412 @@
+"""
+Benchmark for the SRT stats -> BRB scene switching pipeline, without a real stream or OBS.
+
+A fake srt-live-transmit replays a scenario of stats and messages, SRTThread and OBSControl run as they do live,
+and a mock obs-websocket server records every SetCurrentScene. The report has, for each phase of the scenario:
+    brb_latency: seconds from the start of a degraded phase to the switch to the BRB scene.
+    recovery_latency: seconds from the end of a degraded phase to the switch back to the normal scene.
+plus BRB switches that didn't happen during (or just after) a degraded phase, as false_positives,
+degraded phases that never went to BRB, as missed, switches back and forth during a degraded phase after the first BRB, as extra_switches,
+and the CPU time SRTThread and OBSControl used per stats sample.
+
+Usage:
+    python brb_bench.py [scenario.json] [--config srt_config.toml] [--stats-interval 100] [--report report.json]
+
+Without a scenario, a built in one is used: an RTT spike, a short and a long bitrate drop and a disconnect, with a short RTT blip that shouldn't go BRB.
+A scenario is json, either phases of synthetic stats:
+    {"stats_interval": 100, "phases": [
+        {"name": "warmup", "duration": 5, "rtt": 40, "mbps": 6, "ignore": true},
+        {"name": "spike", "duration": 5, "rtt": 600, "mbps": 6, "degraded": true},
+        {"name": "drop", "duration": 5, "stats": false, "messages": ["SRT source disconnected"], "degraded": true},
+        ...]}
+or a recorded srt-live-transmit log (run with "-pf json") and the times, in seconds from its start, that are degraded:
+    {"interval": 0.1, "log": "srt_stats.log", "degraded": [[30, 42]]}
+Like srt-live-transmit with "-s", a synthetic stats record is printed every stats_interval packets (100 by default, the same as SRTThread),
+so how often they arrive depends on the bitrate: every 0.18s at 6Mb/s, but only every 3.5s at 0.3Mb/s.
+For recorded logs, interval is the seconds between the log's lines.
+Phases take "rtt" (ms), "mbps", "loss" (fraction of packets), "messages" (printed at the start of the phase),
+"stats" (false for no stats at all), "degraded" (a BRB is expected) and "ignore" (don't score switches in it).
+Scenarios should end with a healthy phase, as nothing after the end is scored.
+
+The thresholds come from the config's [brb_thresholds], so different settings can be compared on the same scenario.
+--max-latency, --max-false-positives and --max-extra-switches make this exit with an error, to catch regressions.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import toml
+import websockets
+from loguru import logger as logging
+
+from srt_obs_switcher import OBSControl, OBSWebsocket
+from srt_stats import SRTThread
+from utils import LocalState, get_config
+
+PACKET_SIZE = 1316
+
+DEFAULT_SCENARIO = {
+    "stats_interval": 100,
+    "phases": [
+        {"name": "warmup", "duration": 6, "rtt": 40, "mbps": 6, "ignore": True, "messages": ["Accepted SRT source connection"]},
+        {"name": "good", "duration": 10, "rtt": 40, "mbps": 6},
+        {"name": "rtt_blip", "duration": 0.2, "rtt": 400, "mbps": 6},
+        {"name": "good", "duration": 8, "rtt": 40, "mbps": 6},
+        {"name": "rtt_spike", "duration": 5, "rtt": 600, "mbps": 6, "degraded": True},
+        {"name": "good", "duration": 12, "rtt": 40, "mbps": 6},
+        {"name": "low_bitrate", "duration": 5, "rtt": 60, "mbps": 0.3, "degraded": True},
+        {"name": "good", "duration": 12, "rtt": 40, "mbps": 6},
+        # Stats are sparse at low bitrates, so this one is about staying BRB, not getting there.
+        {"name": "low_bitrate_sustained", "duration": 35, "rtt": 60, "mbps": 0.3, "degraded": True},
+        {"name": "good", "duration": 12, "rtt": 40, "mbps": 6},
+        {"name": "disconnect", "duration": 5, "stats": False, "degraded": True, "messages": ["SRT source disconnected"]},
+        {"name": "good", "duration": 12, "rtt": 40, "mbps": 6, "messages": ["Accepted SRT source connection"]},
+    ],
+}
+
+
+def make_record(t, packets, phase):
+    """
+    Build one srt-live-transmit json stats record for a synthetic phase, as the receiving end sees it.
+    Args:
+        t (float): Seconds since the start.
+        packets (int): Packets the record covers.
+        phase (dict): The phase it's in.
+    """
+    mbps = phase.get("mbps", 0)
+    lost = round(packets * phase.get("loss", 0))
+    return {
+        "sid": 1234567,
+        "time": round(t * 1000),
+        "window": {"flow": 8192, "congestion": 8192, "flight": 0},
+        "link": {"rtt": phase.get("rtt", 40), "bandwidth": max(mbps * 2, 1), "maxBandwidth": 1000},
+        "send": {"packets": 0, "packetsLost": 0, "packetsDropped": 0, "packetsRetransmitted": 0, "bytes": 0, "mbitRate": 0},
+        "recv": {
+            "packets": packets - lost,
+            "packetsUnique": packets - lost,
+            "packetsLost": lost,
+            "packetsDropped": 0,
+            "packetsRetransmitted": 0,
+            "packetsBelated": 0,
+            "bytes": (packets - lost) * PACKET_SIZE,
+            "bytesUnique": (packets - lost) * PACKET_SIZE,
+            "bytesLost": lost * PACKET_SIZE,
+            "bytesDropped": 0,
+            "mbitRate": round(mbps * (1 - phase.get("loss", 0)), 3),
+        },
+    }
+
+
+def scenario_phases(scenario):
+    """
+    Turn a recorded log scenario into phases, each a list of the log's lines. Synthetic phases are returned as is.
+    Returns:
+        list: Phases, with "lines" set for recorded ones.
+    """
+    if "log" not in scenario:
+        return scenario["phases"]
+    with open(scenario["log"], "r") as f:
+        lines = [x.rstrip("\n") for x in f if x.strip()]
+    interval = scenario["interval"]
+    # Split the log at the degraded periods' edges, so each piece is one phase.
+    edges = sorted({0} | {round(t / interval) for period in scenario.get("degraded", []) for t in period} | {len(lines)})
+    phases = []
+    for start, end in zip(edges, edges[1:]):
+        t = start * interval
+        degraded = any(a <= t < b for a, b in scenario.get("degraded", []))
+        phases += [{"name": f"log_{round(t, 1)}s", "duration": (end - start) * interval, "degraded": degraded, "lines": lines[start:end]}]
+    return phases
+
+
+def sleep_until(deadline):
+    delay = deadline - time.monotonic()
+    if delay > 0:
+        time.sleep(delay)
+
+
+def fake_srt_live_transmit(scenario_path, stats_interval, events_path):
+    """
+    Stands in for srt-live-transmit: prints a scenario's stats and messages to stdout, in real time.
+    Synthetic stats come every stats_interval packets, so they're as sparse at low bitrates as the real ones.
+    The wall clock time each phase starts is written to events_path, for the benchmark to score against.
+    """
+    with open(scenario_path, "r") as f:
+        scenario = json.load(f)
+    stats_interval = stats_interval or scenario.get("stats_interval", 100)
+    interval = scenario.get("interval", 0.1)
+    events = open(events_path, "w")
+    start = time.monotonic()
+    t = 0.0
+    # Packets since the last record. Like the real one, this carries on from one phase into the next.
+    packets = 0.0
+    for phase in scenario_phases(scenario):
+        sleep_until(start + t)
+        events.write(json.dumps({"name": phase["name"], "start": time.time()}) + "\n")
+        events.flush()
+        for msg in phase.get("messages", []):
+            print(msg, flush=True)
+        lines = phase.get("lines")
+        if lines is not None:
+            for line in lines:
+                print(line, flush=True)
+                t += interval
+                sleep_until(start + t)
+            continue
+        end = t + phase["duration"]
+        rate = phase.get("mbps", 0) * 1000000 / (PACKET_SIZE * 8)
+        if not phase.get("stats", True) or rate <= 0:
+            # Nothing's getting through, so there's nothing to count.
+            packets = 0.0
+            t = end
+            continue
+        while t + (stats_interval - packets) / rate <= end:
+            t += (stats_interval - packets) / rate
+            packets = 0.0
+            sleep_until(start + t)
+            print(json.dumps(make_record(t, stats_interval, phase)), flush=True)
+        packets += (end - t) * rate
+        t = end
+    sleep_until(start + t)
+    events.write(json.dumps({"name": "end", "start": time.time()}) + "\n")
+    events.close()
+    # Stay up like the real one would, until SRTThread kills it.
+    while True:
+        time.sleep(1)
+
+
+class MockOBS:
+    """
+    Just enough of obs-websocket 4.x for OBSWebsocket to connect and switch scenes. Every SetCurrentScene is recorded.
+    """
+    def __init__(self, normal_scene, brb_scene, host="127.0.0.1", port=0):
+        self.host = host
+        self.port = port
+        self.scenes = [normal_scene, brb_scene]
+        self.current_scene = normal_scene
+        self.switches = []
+        self.requests = 0
+        self.ready = threading.Event()
+        self.loop = None
+        self.stop_event = None
+
+    def response(self, msg):
+        request = msg.get("request-type")
+        res = {"message-id": msg.get("message-id"), "status": "ok"}
+        if request == "GetAuthRequired":
+            res["authRequired"] = False
+        elif request == "GetSceneList":
+            res["current-scene"] = self.current_scene
+            res["scenes"] = [{"name": x, "sources": []} for x in self.scenes]
+        elif request == "GetSourcesList":
+            res["sources"] = []
+        elif request == "GetStreamingStatus":
+            res.update({"streaming": True, "recording": False})
+        elif request == "SetCurrentScene":
+            self.switches += [{"t": time.time(), "scene": msg["scene-name"]}]
+            self.current_scene = msg["scene-name"]
+        return res
+
+    async def handler(self, ws, path=None):
+        async for raw in ws:
+            msg = json.loads(raw)
+            self.requests += 1
+            await ws.send(json.dumps(self.response(msg)))
+            if msg.get("request-type") == "SetCurrentScene":
+                await ws.send(json.dumps({"update-type": "SwitchScenes", "scene-name": self.current_scene, "sources": []}))
+
+    async def serve(self):
+        self.stop_event = asyncio.Event()
+        async with websockets.serve(self.handler, self.host, self.port) as server:
+            self.port = server.sockets[0].getsockname()[1]
+            self.ready.set()
+            await self.stop_event.wait()
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        self.loop.run_until_complete(self.serve())
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+        self.ready.wait(5)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.stop_event.set)
+
+
+def thread_cpu_time(thread):
+    """
+    Returns:
+        float: CPU time another thread has used, in seconds.
+    """
+    return time.clock_gettime(time.pthread_getcpuclockid(thread.ident))
+
+
+def score(phases, switches, normal_scene, brb_scene, max_latency):
+    """
+    Match the scene switches up with the phases.
+    Args:
+        phases (list): Phases with their wall clock start and end times.
+        switches (list): SetCurrentScene calls seen by the mock OBS.
+        max_latency (float): A BRB switch this long after a degraded phase ends still counts as caused by it.
+    Returns:
+        dict: Per phase results and the totals.
+    """
+    # There are no stats before the scenario starts or after it ends, and going BRB for that is correct, so those switches don't count.
+    start, end = phases[0]["start"], phases[-1]["end"]
+    brb_switches = [x["t"] for x in switches if x["scene"] == brb_scene and start <= x["t"] < end]
+    normal_switches = [x["t"] for x in switches if x["scene"] == normal_scene and start <= x["t"] < end]
+    explained = set()
+    results = []
+    for phase in phases:
+        result = {
+            "name": phase["name"],
+            "degraded": phase.get("degraded", False),
+            "start": round(phase["start"] - phases[0]["start"], 3),
+            "duration": round(phase["end"] - phase["start"], 3),
+        }
+        if phase.get("ignore"):
+            explained |= {t for t in brb_switches if phase["start"] <= t < phase["end"]}
+        elif phase.get("degraded"):
+            caused = [t for t in brb_switches if phase["start"] <= t < phase["end"] + max_latency]
+            explained |= set(caused)
+            result["brb_latency"] = round(caused[0] - phase["start"], 3) if caused else None
+            back = [t for t in normal_switches if t >= phase["end"]]
+            result["recovery_latency"] = round(back[0] - phase["end"], 3) if back and caused else None
+            # Once it's gone BRB, it should stay there until the phase is over.
+            flapped = [t for t in brb_switches + normal_switches if caused and caused[0] < t < phase["end"]]
+            result["extra_switches"] = len(flapped)
+        result["brb_switches"] = len([t for t in brb_switches if phase["start"] <= t < phase["end"]])
+        results += [result]
+    latencies = [x["brb_latency"] for x in results if x.get("brb_latency") is not None]
+    recoveries = [x["recovery_latency"] for x in results if x.get("recovery_latency") is not None]
+    return {
+        "phases": results,
+        "brb_switches": len(brb_switches),
+        "false_positives": len([t for t in brb_switches if t not in explained]),
+        "missed": len([x for x in results if x["degraded"] and x.get("brb_latency") is None]),
+        "extra_switches": sum(x.get("extra_switches", 0) for x in results),
+        "brb_latency_mean": round(sum(latencies) / len(latencies), 3) if latencies else None,
+        "brb_latency_max": max(latencies) if latencies else None,
+        "recovery_latency_mean": round(sum(recoveries) / len(recoveries), 3) if recoveries else None,
+    }
+
+
+def run_bench(scenario, config, stats_interval=None, max_latency=10.0):
+    """
+    Run one scenario through SRTThread and OBSControl.
+    Args:
+        scenario (dict): Scenario, see the module docstring.
+        config (dict): srt-obs config, for the thresholds and scene names.
+        stats_interval (int, optional): Packets per stats record, overriding the scenario's. Defaults to None.
+        max_latency (float, optional): See score(). Defaults to 10.0.
+    Returns:
+        dict: The report.
+    """
+    obs_cfg = config["obs"]
+    mock = MockOBS(obs_cfg["scene_name"], obs_cfg["brb_scene_name"])
+    mock.start()
+    with tempfile.TemporaryDirectory() as tmp:
+        scenario_path = os.path.join(tmp, "scenario.json")
+        events_path = os.path.join(tmp, "events.json")
+        config_path = os.path.join(tmp, "srt_config.toml")
+        with open(scenario_path, "w") as f:
+            json.dump(scenario, f)
+        bench_config = dict(config, obs=dict(obs_cfg, websocket_host=mock.host, websocket_port=mock.port, websocket_secret=""))
+        with open(config_path, "w") as f:
+            toml.dump(bench_config, f)
+        interval_arg = f" --stats-interval {stats_interval}" if stats_interval else ""
+        fake = f"{sys.executable} {os.path.abspath(__file__)} fake-slt {scenario_path} {events_path}{interval_arg} --"
+
+        srt_thread = SRTThread(srt_destination="srt://:9000", srt_source="srt://localhost:4001", passphrase="brb-bench", srt_live_transmit=fake)
+        srt_thread.daemon = True
+        srt_thread.start()
+        obs_ctrl = OBSControl(srt_thread=srt_thread, websocket=OBSWebsocket(bench_config), shared_state=LocalState(), config_path=config_path)
+        obs_ctrl.daemon = True
+        obs_ctrl.start()
+
+        phases = []
+        wall_start = time.time()
+        total = sum(x.get("duration", 0) for x in scenario_phases(scenario))
+        # Wait for the fake to finish the scenario, with some slack for it to start up.
+        while time.time() - wall_start < total + 30:
+            time.sleep(0.5)
+            if os.path.exists(events_path):
+                with open(events_path, "r") as f:
+                    phases = [json.loads(x) for x in f if x.endswith("\n")]
+                if phases and phases[-1]["name"] == "end":
+                    break
+        cpu = {"srt_thread": thread_cpu_time(srt_thread), "obs_control": thread_cpu_time(obs_ctrl)}
+        samples = len(srt_thread.history) + srt_thread.skipped_stats_total
+        obs_ctrl.stop()
+        srt_thread.stop()
+        obs_ctrl.join(5)
+        srt_thread.join(5)
+        obs_ctrl.obs_websoc.disconnect()
+    mock.stop()
+
+    if not phases or phases[-1]["name"] != "end":
+        raise RuntimeError("The fake srt-live-transmit didn't finish the scenario.")
+    scenario_list = scenario_phases(scenario)
+    for phase, spec, nxt in zip(phases, scenario_list, phases[1:]):
+        phase.update({k: v for k, v in spec.items() if k in ("degraded", "ignore")}, end=nxt["start"])
+    report = score(phases[:-1], mock.switches, obs_cfg["scene_name"], obs_cfg["brb_scene_name"], max_latency)
+    report.update({
+        "samples": samples,
+        "cpu_seconds": {k: round(v, 4) for k, v in cpu.items()},
+        "cpu_per_sample_us": round(sum(cpu.values()) / samples * 1000000, 1) if samples else None,
+        "obs_requests": mock.requests,
+        "thresholds": config["brb_thresholds"],
+    })
+    return report
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "fake-slt":
+        # srt-live-transmit's own arguments come after "--", and are ignored.
+        args = sys.argv[2:sys.argv.index("--")] if "--" in sys.argv else sys.argv[2:]
+        fake_parser = argparse.ArgumentParser()
+        fake_parser.add_argument("scenario")
+        fake_parser.add_argument("events")
+        fake_parser.add_argument("--stats-interval", type=int, default=None)
+        fake_args = fake_parser.parse_args(args)
+        fake_srt_live_transmit(fake_args.scenario, fake_args.stats_interval, fake_args.events)
+
+    parser = argparse.ArgumentParser(description="Measure how quickly and how accurately the BRB switching reacts to a replayed stream.")
+    parser.add_argument("scenario", nargs="?", help="Scenario json. Defaults to a built in one.")
+    parser.add_argument("--config", default="srt_config.toml", help="Config to take the thresholds and scene names from. Defaults to srt_config.toml.")
+    parser.add_argument("--stats-interval", type=int, default=None, help="Packets per synthetic stats record, overriding the scenario's.")
+    parser.add_argument("--report", default=None, help="Write the json report here as well as printing it.")
+    parser.add_argument("--max-latency", type=float, default=None, help="Fail if any BRB switch takes longer than this, in seconds.")
+    parser.add_argument("--max-false-positives", type=int, default=None, help="Fail if there are more false positive BRB switches than this.")
+    parser.add_argument("--max-extra-switches", type=int, default=None, help="Fail if there are more switches back and forth during degraded phases than this.")
+    parser.add_argument("--log-level", default="warning", help="Log level for the switcher while it runs. Defaults to warning.")
+    args = parser.parse_args()
+
+    logging.remove()
+    logging.add(sys.stderr, level=args.log_level.upper())
+    if args.scenario:
+        with open(args.scenario, "r") as f:
+            scenario = json.load(f)
+    else:
+        scenario = DEFAULT_SCENARIO
+    report = run_bench(scenario, get_config(args.config), args.stats_interval)
+    report["scenario"] = args.scenario or "default"
+    print(json.dumps(report, indent=2))
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+
+    failures = []
+    if args.max_latency is not None and (report["missed"] or (report["brb_latency_max"] or 0) > args.max_latency):
+        failures += [f"BRB latency over {args.max_latency}s, or missed: max {report['brb_latency_max']}, missed {report['missed']}."]
+    if args.max_false_positives is not None and report["false_positives"] > args.max_false_positives:
+        failures += [f"{report['false_positives']} false positive BRB switches, more than {args.max_false_positives}."]
+    if args.max_extra_switches is not None and report["extra_switches"] > args.max_extra_switches:
+        failures += [f"{report['extra_switches']} switches back and forth during degraded phases, more than {args.max_extra_switches}."]
+    if failures:
+        raise SystemExit("\n".join(failures))
@@ -8,6 +8,8 @@ _api_cfg = _cfg["api"]
 
 bind = _api_cfg["listen"]
 workers = 4
+# Threads, so concurrent /status requests in a worker can share one lookup.
+threads = 4
 loglevel = get_log_level(_cfg["logging"]["log_level"].lower())
 _ssl_path = _api_cfg["ssl_path"]
 certfile = f"{_ssl_path}/ssl.crt"
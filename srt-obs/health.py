@@ -0,0 +1,194 @@
+from collections import deque
+from math import exp
+from time import monotonic
+
+
+class WindowedStat:
+    """
+    Time windowed mean and an EWMA of one value, updated incrementally.
+    Adding a sample is amortized O(1): a running sum is kept, and samples that fall out of the window are subtracted off as they expire.
+    """
+    def __init__(self, window, ewma_time):
+        """
+        Args:
+            window (float): Length of the window for the mean, in seconds.
+            ewma_time (float): Time constant of the EWMA, in seconds. Older samples decay by 1/e every this many seconds.
+        """
+        self.window = window
+        self.ewma_time = ewma_time
+        self.samples = deque()
+        self.total = 0.0
+        self.ewma = None
+        self.last_time = None
+
+    def add(self, value, t):
+        if self.ewma is None:
+            self.ewma = value
+        else:
+            # Weight by the time since the last sample, so irregular stats intervals don't skew the average.
+            alpha = 1 - exp(-max(t - self.last_time, 0) / self.ewma_time)
+            self.ewma += alpha * (value - self.ewma)
+        self.last_time = t
+        self.samples.append((t, value))
+        self.total += value
+        self.expire(t)
+
+    def expire(self, now):
+        cutoff = now - self.window
+        while self.samples and self.samples[0][0] < cutoff:
+            self.total -= self.samples.popleft()[1]
+
+    def reset(self):
+        self.samples.clear()
+        self.total = 0.0
+        self.ewma = None
+        self.last_time = None
+
+    @property
+    def count(self):
+        return len(self.samples)
+
+    @property
+    def mean(self):
+        """
+        Mean of the samples in the window, or None if there aren't any.
+        Only divides by the number of samples actually present, so a partly filled window doesn't read low.
+        """
+        if not self.samples:
+            return None
+        return self.total / len(self.samples)
+
+
+class HealthEvaluator:
+    """
+    Tracks the health of the incoming SRT link from its stats, for the BRB decision.
+    Feed it each new stats sample with add_sample(), then ask it whether the bitrate/rtt/loss are healthy.
+
+    Signals:
+        bitrate, rtt: windowed mean and EWMA.
+        rtt_p95: 95th percentile RTT over the window, if a StatsHistory is given.
+        loss_rate: lost / received packets over the window.
+    """
+    def __init__(self, thresholds, history=None, stats_interval=100):
+        """
+        Args:
+            thresholds (dict): The [brb_thresholds] config section.
+            history (StatsHistory, optional): SRT stats history, used for percentiles. Defaults to None.
+            stats_interval (int, optional): Packets per stats sample, srt-live-transmit's -s. Defaults to 100.
+        """
+        self.thresholds = thresholds
+        self.history = history
+        # Fall back to what running_avg used to cover, but at least as long as a stats sample takes to arrive at the bitrate threshold,
+        # otherwise the window is empty most of the time on exactly the links that are failing.
+        self.window = thresholds.get("avg_window", max(thresholds["running_avg"] * thresholds["check_interval"], self.sample_time(stats_interval)))
+        ewma_time = thresholds.get("ewma_time", self.window)
+        self.bitrate = WindowedStat(self.window, ewma_time)
+        self.rtt = WindowedStat(self.window, ewma_time)
+        self.lost = WindowedStat(self.window, ewma_time)
+        self.received = WindowedStat(self.window, ewma_time)
+
+    def sample_time(self, stats_interval, packet_size=1316):
+        """
+        Returns:
+            float: Seconds between stats samples at the bitrate threshold, or 0 if the bitrate check is disabled.
+        """
+        if self.thresholds["bitrate"] <= 0:
+            return 0
+        return stats_interval * packet_size * 8 / (self.thresholds["bitrate"] * 1000000)
+
+    def add_sample(self, stats, t=None):
+        """
+        Add one srt-live-transmit stats sample.
+        Args:
+            stats (dict): Decoded json stats.
+            t (float, optional): time.monotonic() of the sample. Defaults to now.
+        Returns:
+            bool: False if the bitrate was skipped because both directions read 0, True otherwise.
+        """
+        t = monotonic() if t is None else t
+        self.rtt.add(stats["link"]["rtt"], t)
+        self.lost.add(stats["recv"].get("packetsLost", 0), t)
+        self.received.add(stats["recv"].get("packets", 0), t)
+        # When the stats are (0, 0), this could trigger a spurious disconnect.
+        # For whatever reason, srt-live-transmit will report a 0 bitrate, even if bits are being sent, so ignore these.
+        rates = (stats["send"]["mbitRate"], stats["recv"]["mbitRate"])
+        if rates == (0, 0):
+            return False
+        # This is a workaround for not always getting the same stats.
+        self.bitrate.add(max(rates), t)
+        return True
+
+    def expire(self, now=None):
+        """
+        Drop samples that have aged out of the window, without adding a new one.
+        """
+        now = monotonic() if now is None else now
+        for s in (self.bitrate, self.rtt, self.lost, self.received):
+            s.expire(now)
+
+    def reset(self):
+        for s in (self.bitrate, self.rtt, self.lost, self.received):
+            s.reset()
+
+    @property
+    def rtt_p95(self):
+        if self.history is None:
+            return None
+        return self.history.percentile("rtt", 95, self.window)
+
+    @property
+    def loss_rate(self):
+        """
+        Fraction of packets lost over the window, or None with nothing received.
+        """
+        total = self.received.total + self.lost.total
+        if not total:
+            return None
+        return self.lost.total / total
+
+    def bitrate_healthy(self):
+        """
+        Returns:
+            bool: True if the windowed bitrate is at or above the threshold, or the check is disabled. None if there are no samples in the window, which isn't a verdict either way.
+        """
+        if self.thresholds["bitrate"] == -1:
+            return True
+        if self.bitrate.mean is None:
+            return None
+        return self.bitrate.mean >= self.thresholds["bitrate"]
+
+    def rtt_healthy(self):
+        """
+        Returns:
+            bool: True if the windowed RTT is at or below the threshold, or the check is disabled. None if there are no samples in the window, which isn't a verdict either way.
+        """
+        if self.thresholds["rtt"] == -1:
+            return True
+        if self.rtt.mean is None:
+            return None
+        return self.rtt.mean <= self.thresholds["rtt"]
+
+    def loss_healthy(self):
+        """
+        Returns:
+            bool: True if the loss rate is at or below the threshold, or the check is disabled (the default).
+        """
+        max_loss = self.thresholds.get("loss_rate", -1)
+        if max_loss == -1 or self.loss_rate is None:
+            return True
+        return self.loss_rate <= max_loss
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: Current values of all the signals, for logging or the API.
+        """
+        return {
+            "bitrate": self.bitrate.mean,
+            "bitrate_ewma": self.bitrate.ewma,
+            "rtt": self.rtt.mean,
+            "rtt_ewma": self.rtt.ewma,
+            "rtt_p95": self.rtt_p95,
+            "loss_rate": self.loss_rate,
+            "samples": self.rtt.count,
+        }
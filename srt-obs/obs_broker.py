@@ -0,0 +1,442 @@
+import fcntl
+import json
+import multiprocessing as mp
+import os
+import socket
+import socketserver
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, sleep
+
+from loguru import logger as logging
+
+from srt_obs_switcher import OBSStateCache, OBSWebsocket
+
+
+# OBSWebsocket methods that clients are allowed to call through the broker.
+BROKER_METHODS = (
+    "go_brb",
+    "go_normal",
+    "set_scene",
+    "start_stream",
+    "stop_stream",
+    "stream_status",
+    "refresh_state",
+    "restart_active_source",
+    "stop_media_source",
+    "play_media_source",
+    "pause_media_source",
+)
+
+
+class BrokerResponse:
+    """
+    Stand-in for an obs-websocket response object, as returned through the broker.
+    """
+    def __init__(self, status, datain):
+        self.status = status
+        self.datain = datain
+
+    def __getattr__(self, name):
+        # Mimic obs-websocket's getXyz() accessors, e.g. getStreaming() reads datain["streaming"].
+        if name.startswith("get") and len(name) > 3:
+            key = name[3].lower() + name[4:]
+            return lambda: self.datain.get(key)
+        raise AttributeError(name)
+
+
+class BrokerHandler(socketserver.StreamRequestHandler):
+    """
+    One of these per client connection. Requests are newline delimited json: {"id", "method", "args", "timeout"}.
+    Responses {"id", "result", "error"} can come back in any order, and the current OBS state is pushed as {"state"} whenever it changes.
+    """
+    def setup(self):
+        super().setup()
+        self.write_lock = threading.Lock()
+        self.server.broker.add_client(self)
+
+    def finish(self):
+        self.server.broker.remove_client(self)
+        super().finish()
+
+    def handle(self):
+        self.send({"state": self.server.broker.obs_websoc.state.as_dict()})
+        for line in self.rfile:
+            try:
+                req = json.loads(line)
+            except json.decoder.JSONDecodeError:
+                logging.error(f"OBS broker: invalid request: {line}")
+                continue
+            # Requests are queued, not handled in turn, so a client can have several in flight at once.
+            deadline = monotonic() + req["timeout"] if req.get("timeout") else None
+            self.server.broker.executor.submit(self.respond, req, deadline)
+
+    def respond(self, req, deadline):
+        res = {"id": req["id"], "result": None, "error": None}
+        if deadline is not None and monotonic() > deadline:
+            # The client has given up on this, and an old scene switch is worse than none.
+            res["error"] = "timeout"
+        else:
+            res.update(self.server.broker.dispatch(req["method"], req.get("args", [])))
+        self.send(res)
+
+    def send(self, msg):
+        data = (json.dumps(msg) + "\n").encode("utf-8")
+        try:
+            with self.write_lock:
+                self.wfile.write(data)
+        except OSError:
+            pass
+
+
+class BrokerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class OBSBroker:
+    """
+    Owns the one websocket connection to OBS, and shares it with every gunicorn worker over a unix socket.
+    Calls to OBS are made one at a time, in the order they arrive. The OBS state cache is pushed to all clients when it changes.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.socket_path = config["obs"].get("broker_socket", "/tmp/srt-obs-broker.sock")
+        self.obs_websoc = OBSWebsocket(config)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.clients = set()
+        self.clients_lock = threading.Lock()
+        self.obs_websoc.state.add_listener(self.push_state)
+
+    def add_client(self, client):
+        with self.clients_lock:
+            self.clients.add(client)
+
+    def remove_client(self, client):
+        with self.clients_lock:
+            self.clients.discard(client)
+
+    def push_state(self):
+        msg = {"state": self.obs_websoc.state.as_dict()}
+        with self.clients_lock:
+            clients = list(self.clients)
+        for client in clients:
+            client.send(msg)
+
+    def dispatch(self, method, args):
+        if method not in BROKER_METHODS:
+            return {"error": f"unknown method {method}"}
+        try:
+            res = getattr(self.obs_websoc, method)(*args)
+        except Exception as e:
+            logging.error(f"OBS broker: {method} failed: {e}")
+            return {"error": str(e)}
+        if res is None:
+            return {"result": None}
+        return {"result": {"status": res.status, "datain": res.datain}}
+
+    def serve(self):
+        """
+        Run the broker until killed. This is the broker process's main function.
+        """
+        # Several workers can try to start a broker at the same time, only the one that gets the lock runs.
+        self.lock_file = open(f"{self.socket_path}.lock", "w")
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logging.info(f"OBS broker: already running, pid={os.getpid()} exiting.")
+            return
+        if os.path.exists(self.socket_path):
+            # Left over from a broker that didn't exit cleanly, as we hold the lock.
+            os.unlink(self.socket_path)
+        server = BrokerServer(self.socket_path, BrokerHandler)
+        server.broker = self
+        logging.warning(f"OBS broker: listening on {self.socket_path}, pid={os.getpid()}.")
+        try:
+            self.obs_websoc.ensure_connected()
+        except Exception as e:
+            # OBS may not be up yet, the first call will try again.
+            logging.error(f"OBS broker: initial connection failed: {e}")
+        server.serve_forever()
+
+
+def run_broker(config):
+    OBSBroker(config).serve()
+
+
+class OBSBrokerClient:
+    """
+    Drop in replacement for OBSWebsocket that goes through the OBS broker process.
+    Any thread can make calls, and they're pipelined over the one connection. State reads use the copy the broker pushes, with no round trip.
+    After a fork (like gunicorn's workers), the first call opens a new connection for that process.
+    If the broker isn't running, like after the process that started it has exited, the next call starts a new one.
+    """
+    def __init__(self, config, broker_process=None, start_timeout=5.0):
+        """
+        Args:
+            config (dict): Full configuration.
+            broker_process (multiprocessing.Process, optional): The broker, if this process started it. Defaults to None.
+            start_timeout (float, optional): How long to wait for a newly started broker to listen, in seconds. Defaults to 5.0.
+        """
+        self.full_config = config
+        self.config = config["obs"]
+        self.normal_scene = self.config["scene_name"]
+        self.brb_scene = self.config["brb_scene_name"]
+        self.socket_path = self.config.get("broker_socket", "/tmp/srt-obs-broker.sock")
+        self.timeout = self.config.get("broker_timeout", 5.0)
+        self.broker_process = broker_process
+        self.start_timeout = start_timeout
+        self.state = OBSStateCache()
+        self.state_received = threading.Event()
+        self.scene_listeners = []
+        self.sock = None
+        self.pid = None
+        self.next_id = 0
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.socket_path)
+        self.sock = sock
+        self.pid = os.getpid()
+        # Each connection has its own, so when one closes only its own calls are failed.
+        self.pending = {}
+        self.state_received.clear()
+        reader = threading.Thread(target=self.read_loop, args=(sock, self.pending), name="OBSbroker", daemon=True)
+        reader.start()
+        logging.info(f"OBS broker client: connected to {self.socket_path}, pid={self.pid}.")
+
+    def broker_running(self):
+        """
+        Returns:
+            bool: True if a broker holds the lock, even if it isn't listening yet.
+        """
+        with open(f"{self.socket_path}.lock", "w") as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+            fcntl.flock(f, fcntl.LOCK_UN)
+            return False
+
+    def start_broker(self):
+        process = mp.get_context("fork").Process(target=run_broker, args=(self.full_config,), name="OBSbroker", daemon=True)
+        process.start()
+        self.broker_process = process
+        logging.warning(f"OBS broker client: started a broker, pid={process.pid}.")
+
+    def connect_or_start(self):
+        """
+        Connect to the broker, starting one first if nothing holds the broker's lock.
+        If two processes start one at the same time, the broker that doesn't get the lock exits, and both connect to the other.
+        """
+        try:
+            self.connect()
+            return
+        except (FileNotFoundError, ConnectionRefusedError):
+            pass
+        if not self.broker_running():
+            self.start_broker()
+        deadline = monotonic() + self.start_timeout
+        while True:
+            try:
+                self.connect()
+                return
+            except (FileNotFoundError, ConnectionRefusedError):
+                if monotonic() > deadline:
+                    raise
+                sleep(0.05)
+
+    def ensure_connected(self):
+        with self.lock:
+            if self.sock is None or self.pid != os.getpid():
+                self.connect_or_start()
+
+    def read_loop(self, sock, pending):
+        try:
+            with sock.makefile("rb") as f:
+                for line in f:
+                    msg = json.loads(line)
+                    if "state" in msg:
+                        self.on_state(msg["state"])
+                        continue
+                    with self.lock:
+                        waiter = pending.pop(msg["id"], None)
+                    if waiter is not None:
+                        waiter[1] = msg
+                        waiter[0].set()
+        except (OSError, ValueError) as e:
+            # disconnect() closing the socket under us, or a garbled line.
+            logging.error(f"OBS broker client: reading failed: {e}")
+        logging.error("OBS broker client: connection closed.")
+        with self.lock:
+            if self.sock is sock:
+                self.sock = None
+            waiters = list(pending.values())
+            pending.clear()
+        # Otherwise the calls waiting on this connection only find out when they time out.
+        for waiter in waiters:
+            waiter[1] = {"error": "connection closed", "result": None, "closed": True}
+            waiter[0].set()
+
+    def on_state(self, state):
+        old_scene = self.state.current_scene
+        self.state.load(state)
+        self.state_received.set()
+        if self.state.current_scene != old_scene:
+            for callback in self.scene_listeners:
+                callback()
+
+    def call(self, method, *args, timeout=None):
+        """
+        Call an OBSWebsocket method in the broker.
+        Args:
+            method (str): Name of the method, one of BROKER_METHODS.
+            timeout (float, optional): Seconds to wait for the result. Defaults to the broker_timeout config setting.
+        Returns:
+            BrokerResponse: The response, or None if the method returned None.
+        Raises:
+            TimeoutError: If there was no response in time.
+            ConnectionError: If the connection to the broker closed before the response, or the request couldn't be sent.
+            RuntimeError: If the call failed in the broker.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        self.ensure_connected()
+        waiter = [threading.Event(), None]
+        with self.lock:
+            # The connection can close between ensure_connected() and here.
+            if self.sock is None:
+                raise ConnectionError(f"OBS broker: {method} failed: not connected.")
+            self.next_id += 1
+            req_id = self.next_id
+            self.pending[req_id] = waiter
+            data = (json.dumps({"id": req_id, "method": method, "args": list(args), "timeout": timeout}) + "\n").encode("utf-8")
+            try:
+                self.sock.sendall(data)
+            except OSError as e:
+                self.pending.pop(req_id, None)
+                raise ConnectionError(f"OBS broker: {method} failed: {e}")
+        if not waiter[0].wait(timeout):
+            with self.lock:
+                self.pending.pop(req_id, None)
+            raise TimeoutError(f"OBS broker: {method} timed out after {timeout}s.")
+        msg = waiter[1]
+        if msg.get("closed"):
+            raise ConnectionError(f"OBS broker: {method} failed: connection closed.")
+        if msg["error"]:
+            raise RuntimeError(f"OBS broker: {method} failed: {msg['error']}")
+        if msg["result"] is None:
+            return None
+        return BrokerResponse(msg["result"]["status"], msg["result"]["datain"])
+
+    def wait_for_state(self):
+        """
+        Wait for the broker's state, and if it's invalid, have the broker reconnect to OBS and refresh it.
+        The new state is pushed before the call returns.
+        Returns:
+            bool: True if the state is valid. False if OBS can't be reached, and the state is unknown.
+        """
+        self.ensure_connected()
+        if not self.state_received.wait(self.timeout):
+            raise TimeoutError("OBS broker: no state received.")
+        if self.state.valid:
+            return True
+        try:
+            self.call("refresh_state")
+        except (RuntimeError, TimeoutError, ConnectionError) as e:
+            logging.error(f"OBS broker client: can't refresh the state: {e}")
+            return False
+        return self.state.valid
+
+    def disconnect(self):
+        logging.info("OBS broker client: disconnect.")
+        with self.lock:
+            if self.sock is not None:
+                self.sock.close()
+                self.sock = None
+
+    def shutdown_broker(self):
+        if self.broker_process is not None:
+            logging.info(f"OBS broker: stopping, pid={self.broker_process.pid}.")
+            self.broker_process.terminate()
+
+    def add_scene_listener(self, callback):
+        """
+        Call callback() whenever the broker reports a scene switch. It's called from the reader thread, so needs to be quick.
+        """
+        self.scene_listeners += [callback]
+
+    def go_brb(self):
+        logging.info("OBS command: switch to BRB scene.")
+        return self.call("go_brb")
+
+    def go_normal(self):
+        logging.info("OBS command: switch to normal scene.")
+        return self.call("go_normal")
+
+    def set_scene(self, scene_name):
+        return self.call("set_scene", scene_name)
+
+    def start_stream(self):
+        logging.info("OBS command: start stream.")
+        return self.call("start_stream")
+
+    def stop_stream(self):
+        logging.info("OBS command: stop stream.")
+        return self.call("stop_stream")
+
+    def stream_status(self):
+        logging.info("OBS command: get stream status.")
+        return self.call("stream_status")
+
+    def restart_active_source(self):
+        return self.call("restart_active_source")
+
+    def get_current_scene(self):
+        logging.info("OBS command: get current scene.")
+        return self.current_scene
+
+    @property
+    def current_scene(self):
+        if not self.wait_for_state():
+            return None
+        return self.state.current_scene
+
+    @property
+    def streaming(self):
+        if not self.wait_for_state():
+            return None
+        return self.state.streaming
+
+    @property
+    def recording(self):
+        if not self.wait_for_state():
+            return None
+        return self.state.recording
+
+    def get_media_sources(self):
+        if not self.wait_for_state():
+            return []
+        return self.state.media_sources()
+
+    @property
+    def active_media_source(self):
+        for s in self.get_media_sources():
+            if self.state.is_visible(self.normal_scene, s["name"]):
+                return s["name"]
+
+
+def connect_or_start(config, start_timeout=5.0):
+    """
+    Connect to the OBS broker, starting it first if it isn't already running.
+    When gunicorn loads the app in the master process this starts the broker once, before the workers are forked.
+    Otherwise, the first worker in starts it, and the rest connect to it. Whichever worker next finds it gone starts it again.
+    Args:
+        config (dict): Full configuration.
+        start_timeout (float, optional): How long to wait for a newly started broker to listen, in seconds. Defaults to 5.0.
+    Returns:
+        OBSBrokerClient: Connected client.
+    """
+    client = OBSBrokerClient(config, start_timeout=start_timeout)
+    client.ensure_connected()
+    return client
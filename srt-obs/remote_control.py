@@ -1,21 +1,28 @@
+import fcntl
 import json
 import logging as lg
+import math
 import multiprocessing as mp
+import os
+import struct
+import tempfile
 import threading
+from contextlib import contextmanager
 from datetime import datetime
-from multiprocessing import Lock
-from multiprocessing.managers import AcquirerProxy, BaseManager, DictProxy
+from multiprocessing import resource_tracker, shared_memory
 from multiprocessing.queues import Queue as mpQueue
 
 import falcon
 from loguru import logger as logging
 
+import obs_broker
 import srt_obs_switcher as srtos
+from status_cache import CoalescingCache
 from utils import configure_logging, generate_api_key
 
 
 class StreamControls:
-    def __init__(self, api_key, shared_state, websocket=None):
+    def __init__(self, api_key, shared_state, websocket=None, status_ttl=0.25):
         self.api_key = api_key
         self.key_len = 32
         self.last_hearbeat = None
@@ -27,6 +34,8 @@ class StreamControls:
         print(f"{self.api_key}")
         print(div)
         self.obs_websoc = websocket
+        # Every phone polls this, so serve it from a cache and only build it once per status_ttl.
+        self.status_cache = CoalescingCache(self.get_status, status_ttl)
 
     def nice_hearbeat(self):
         return datetime.strftime(self.last_hearbeat, self.time_str)
@@ -38,20 +47,28 @@ class StreamControls:
         res.text = json.dumps(j)
         res.status = falcon.HTTP_200
 
-    def on_get(self, req, res):
-        logging.debug("Control: stats get")
-        status = self.obs_websoc.stream_status()
+    def get_status(self):
         curr_scene = self.obs_websoc.get_current_scene()
-        j = {"streaming": status.getStreaming(),
-            "recording": status.getRecording(),
+        health = self.shared_state.get_many()
+        j = {"streaming": self.obs_websoc.streaming,
+            "recording": self.obs_websoc.recording,
             "scene": curr_scene,
-            "locked": self.shared_state.get("scene_lock"),}
+            "locked": health.pop("scene_lock"),
+            "health": health,}
+        return json.dumps(j)
 
-        res.text = json.dumps(j)
+    def on_get(self, req, res):
+        logging.debug("Control: stats get")
+        res.text = self.status_cache.get()
+        res.status = falcon.HTTP_200
+
+    def on_get_cache(self, req, res):
+        res.text = json.dumps(self.status_cache.stats())
         res.status = falcon.HTTP_200
 
     def on_post_start(self, req, res):
         res = self.obs_websoc.start_stream()
+        self.status_cache.invalidate()
         logging.debug(f"Controls: start: {res}")
         if res:
             j = {"message": "Stream started."}
@@ -66,6 +83,7 @@ class StreamControls:
 
     def on_post_stop(self, req, res):
         res = self.obs_websoc.stop_stream()
+        self.status_cache.invalidate()
         logging.debug(f"Controls: stop: {res}")
         if res:
             j = {"message": "Stream stopped."}
@@ -82,6 +100,7 @@ class StreamControls:
         res = self.obs_websoc.go_brb()
         # Explicitly lock, because that's how it behaved before.
         self.shared_state.put("scene_lock", True)
+        self.status_cache.invalidate()
         logging.debug(f"Controls: brb: {res}")
         if res:
             j = {"message": "Going brb."}
@@ -98,6 +117,7 @@ class StreamControls:
         res = self.obs_websoc.go_normal()
         # Explicitly unlock, because that's how it behaved before.
         self.shared_state.put("scene_lock", False)
+        self.status_cache.invalidate()
         logging.debug(f"Controls: back: {res}")
         if res:
             j = {"message": "Going normal."}
@@ -112,6 +132,7 @@ class StreamControls:
 
     def on_post_unlock(self, req, res):
         self.shared_state.put("scene_lock", False)
+        self.status_cache.invalidate()
         j = {"message": "Scene unlocked."}
         logging.warning(f"Controls: Scene Unlocked.")
         res.text = json.dumps(j)
@@ -119,6 +140,7 @@ class StreamControls:
 
     def on_post_lock(self, req, res):
         self.shared_state.put("scene_lock", True)
+        self.status_cache.invalidate()
         j = {"message": "Scene locked."}
         logging.warning(f"Controls: Scene locked.")
         res.text = json.dumps(j)
@@ -157,47 +179,165 @@ class SharedState:
     """
     This needs some serious explanation.
     Basically, given Gunicorn's pre-fork model, there's no way to share any sort of state between processes.
-    Not even mp.Queue or mp.Lock, because they are forked as well, so the forked process now has independent copies.
-    This is full on IPC using network communication. Probably should be replaced with full async code at some point, but that may not help.
+    So the state lives in a small shared memory segment with a fixed layout, which every process maps in.
+
+    Reads don't take a lock. A sequence counter (a seqlock) is bumped before and after every write,
+    and a read that sees it change, or odd (mid-write), just reads again. Writers take a file lock, so there's only ever one at a time.
+
+    Every process using the segment also holds a shared lock on a second file. The first one to start, when nothing holds that lock,
+    knows any existing segment is left over from an earlier run, and replaces it, so a scene_lock that was never released doesn't carry over.
 
     Methods:
-        Note: There is a shared lock protecting the calls, but use_lock=False will not lock the dict. This is hazardous, but may improve performance.
+        Note: use_lock=False skips the retry on reads and the lock on writes. This is hazardous, and not much faster.
 
         get(key, optional_default): behaves like dict.get(key, optional_default)
-        put(key, value): behaves like dict[key] = value. Not that nested values are not support, so a list or dict (etc.) will need to be updated in one go.
+        put(key, value): behaves like dict[key] = value. Only the keys in SharedState.fields can be stored.
+        get_many(keys)/put_many(dict): same, but for several keys in one consistent read or write.
     """
-    def __init__(self, host="localhost", port=42424, key="gunicorn-local"):
-        self.host = host
-        self.port = port
-        self.key = key.encode("ascii")
-        self.shared_dict, self.shared_lock = self._get_shared_state()
+    # name: struct format. None is stored as NaN in float fields.
+    fields = {
+        "scene_lock": "?",
+        "srt_connected": "?",
+        "srt_healthy": "?",
+        "bitrate": "d",
+        "bitrate_ewma": "d",
+        "rtt": "d",
+        "rtt_ewma": "d",
+        "rtt_p95": "d",
+        "loss_rate": "d",
+        "stats_time": "d",
+    }
+    version = 1
+
+    def __init__(self, name="srt-obs-state"):
+        self.name = name
+        self.header = struct.Struct("=QQ")  # version, sequence
+        self.body = struct.Struct("=" + "".join(self.fields.values()))
+        self.index = {k: idx for idx, k in enumerate(self.fields)}
+        self.lock_file = open(os.path.join(tempfile.gettempdir(), f"{name}.lock"), "w")
+        # Held shared for as long as this process (or its forks) uses the segment.
+        self.users_file = open(os.path.join(tempfile.gettempdir(), f"{name}.users"), "w")
+        self.shm = self._get_shared_state()
+
+    def _first_user(self):
+        """
+        Take a shared lock on the users file.
+        Returns:
+            bool: True if no other process had it, so nothing else is using the segment.
+        """
+        try:
+            fcntl.flock(self.users_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            first = True
+        except BlockingIOError:
+            first = False
+        fcntl.flock(self.users_file, fcntl.LOCK_SH)
+        return first
+
+    def _unlink_stale(self):
+        try:
+            stale = shared_memory.SharedMemory(name=self.name)
+        except FileNotFoundError:
+            return
+        logging.info(f"SharedState: replacing {self.name} left over from an earlier run.")
+        stale.close()
+        stale.unlink()
 
     def _get_shared_state(self):
-        shared_dict = {"scene_lock": False}
-        shared_lock = Lock()
-        manager = BaseManager((self.host, self.port), self.key)
-        manager.register("get_dict", lambda: shared_dict, DictProxy)
-        manager.register("get_lock", lambda: shared_lock, AcquirerProxy)
-        # Check and see if the process is running, and if it isn't start it.
-        # Note that this will fail if there is another process on the system using the host:post combo.
+        size = self.header.size + self.body.size
+        # Under the write lock, so only one process at a time decides whether the segment is stale, and sets it up.
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        try:
+            if self._first_user():
+                self._unlink_stale()
+            try:
+                shm = shared_memory.SharedMemory(name=self.name, create=True, size=size)
+                created = True
+            except FileExistsError:
+                shm = shared_memory.SharedMemory(name=self.name)
+                created = False
+                # Only the creator should unlink it, otherwise the first worker to exit takes it away from the rest.
+                resource_tracker.unregister(shm._name, "shared_memory")
+            version, _ = self.header.unpack_from(shm.buf, 0)
+            if created or version != self.version:
+                # New, or left over from an older layout. A new segment is zeroed, which isn't the same as unset for the float fields.
+                self.header.pack_into(shm.buf, 0, self.version, 0)
+                self.body.pack_into(shm.buf, self.header.size, *self._encode(dict.fromkeys(self.fields)))
+        finally:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+        return shm
+
+    def _encode(self, values):
+        return [
+            (float("nan") if v is None else float(v)) if self.fields[k] == "d" else bool(v)
+            for k, v in values.items()
+        ]
+
+    def _decode(self, raw):
+        return {
+            k: None if self.fields[k] == "d" and math.isnan(v) else v
+            for k, v in zip(self.fields, raw)
+        }
+
+    @contextmanager
+    def _write_lock(self):
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
         try:
-            manager.connect()
-        except ConnectionRefusedError:
-            manager.get_server()
-            manager.start()
-        return manager.get_dict(), manager.get_lock()
+            yield
+        finally:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    def _read(self, use_lock=True):
+        buf = self.shm.buf
+        while True:
+            _, seq = self.header.unpack_from(buf, 0)
+            raw = self.body.unpack_from(buf, self.header.size)
+            if not use_lock:
+                return raw
+            _, seq2 = self.header.unpack_from(buf, 0)
+            if seq == seq2 and not seq % 2:
+                return raw
+
+    def _write(self, values):
+        buf = self.shm.buf
+        current = self._decode(self.body.unpack_from(buf, self.header.size))
+        current.update(values)
+        _, seq = self.header.unpack_from(buf, 0)
+        self.header.pack_into(buf, 0, self.version, seq + 1)
+        self.body.pack_into(buf, self.header.size, *self._encode(current))
+        self.header.pack_into(buf, 0, self.version, seq + 2)
 
     def get(self, dict_key, default=None, use_lock=True):
-        if not use_lock:
-            return self.shared_dict.get(dict_key, default)
-        with self.shared_lock:
-            return self.shared_dict.get(dict_key, default)
+        if dict_key not in self.index:
+            return default
+        return self._decode(self._read(use_lock))[dict_key]
+
+    def get_many(self, keys=None, use_lock=True):
+        """
+        Returns:
+            dict: The values of keys (all of them, if None), all from the same write.
+        """
+        values = self._decode(self._read(use_lock))
+        if keys is None:
+            return values
+        return {k: values[k] for k in keys}
 
     def put(self, dict_key, value, use_lock=True):
+        self.put_many({dict_key: value}, use_lock)
+
+    def put_many(self, values, use_lock=True):
+        unknown = set(values) - set(self.fields)
+        if unknown:
+            raise KeyError(f"SharedState: unknown keys {unknown}")
         if not use_lock:
-            self.shared_dict[dict_key] = value
-        with self.shared_lock:
-            self.shared_dict[dict_key] = value
+            self._write(values)
+            return
+        with self._write_lock():
+            self._write(values)
+
+    def close(self, unlink=False):
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
 
 config = srtos.get_config()
 
@@ -210,7 +350,8 @@ api_key = generate_api_key(config)
 
 key_check = KeyMiddleware(api_key)
 api = application = falcon.App(middleware=[key_check])
-obs_websoc = srtos.OBSWebsocket(config)
+# All OBS calls, from every worker, go through the one connection the broker process holds.
+obs_websoc = obs_broker.connect_or_start(config)
 
 srt_thread = srtos.start_srt(config)
 srtla_thread = srtos.start_srtla(config)
@@ -219,7 +360,7 @@ obs_ctrl = srtos.OBSControl(srt_thread=srt_thread, websocket=obs_websoc, shared_
 obs_ctrl.daemon = True
 obs_ctrl.start()
 
-stream_controls = StreamControls(api_key=api_key, shared_state=shared_state, websocket=srtos.OBSWebsocket(config))
+stream_controls = StreamControls(api_key=api_key, shared_state=shared_state, websocket=obs_websoc, status_ttl=config["api"].get("status_cache_ms", 250) / 1000)
 
 api.add_route("/heartbeat", stream_controls, suffix="heartbeat")
 api.add_route("/start", stream_controls, suffix="start")
@@ -229,6 +370,7 @@ api.add_route("/back", stream_controls, suffix="back")
 api.add_route("/unlock", stream_controls, suffix="unlock")
 api.add_route("/lock", stream_controls, suffix="lock")
 api.add_route("/status", stream_controls)
+api.add_route("/status/cache", stream_controls, suffix="cache")
 api.add_route("/", stream_controls)
 
 for thread in threading.enumerate():
@@ -237,6 +379,7 @@ for thread in threading.enumerate():
 def on_exit(arbiter):
     obs_websoc.go_brb()
     obs_websoc.disconnect()
+    obs_websoc.shutdown_broker()
     logging.info("Shutting down.")
     logging.info(f"SRT Thread start: {srt_thread.start_time}")
     logging.info(f"SRTLA Thread start: {srtla_thread.start_time}")
@@ -244,3 +387,4 @@ def on_exit(arbiter):
     srt_thread.stop()
     srtla_thread.stop()
     obs_ctrl.stop()
+    shared_state.close(unlink=True)
@@ -0,0 +1,184 @@
+"""
+asyncio/ASGI version of remote_control.py, for running under uvicorn as a single process:
+    uvicorn remote_control_asgi:app --host 0.0.0.0 --port 4443 --ssl-keyfile ssl/ssl.key --ssl-certfile ssl/ssl.crt
+
+The API, the SRT/SRTLA process watchers and the scene switcher are all tasks on one event loop.
+As there's only one process, there's one OBS connection and state is a plain dict, no SharedState needed.
+"""
+import asyncio
+import json
+from datetime import datetime
+
+import falcon
+import falcon.asgi
+from loguru import logger as logging
+
+import srt_obs_switcher as srtos
+from srt_obs_async import AsyncOBSControl, AsyncOBSWebsocket, ProcessWatcher, srt_handler, srtla_handler
+from utils import LocalState, configure_logging, generate_api_key
+
+
+class StreamControls:
+    def __init__(self, api_key, shared_state, websocket):
+        self.api_key = api_key
+        self.last_hearbeat = None
+        self.shared_state = shared_state
+        self.time_str = "%Y-%m-%dT%H:%M:%S.%fZ"
+        self.obs_websoc = websocket
+
+    def nice_hearbeat(self):
+        return datetime.strftime(self.last_hearbeat, self.time_str)
+
+    async def on_get_heartbeat(self, req, res):
+        self.last_hearbeat = datetime.now()
+        j = {"heartbeat": self.nice_hearbeat()}
+        logging.debug("Control: heartbeat")
+        res.text = json.dumps(j)
+        res.status = falcon.HTTP_200
+
+    async def on_get(self, req, res):
+        logging.debug("Control: stats get")
+        # Connects if needed, after that the state is kept up to date by events.
+        await self.obs_websoc.ensure_connected()
+        health = self.shared_state.get_many()
+        j = {"streaming": self.obs_websoc.streaming,
+            "recording": self.obs_websoc.recording,
+            "scene": self.obs_websoc.current_scene,
+            "locked": health.pop("scene_lock"),
+            "health": health,}
+        res.text = json.dumps(j)
+        res.status = falcon.HTTP_200
+
+    async def obs_command(self, res, call, ok_msg, err_msg):
+        """
+        Make an OBS call and fill in the response, 200 if it worked and 409 otherwise.
+        """
+        try:
+            obs_res = await call
+            ok = obs_res.status
+        except Exception as e:
+            logging.error(f"Controls: {e}")
+            ok = False
+        if ok:
+            logging.info(f"Controls: {ok_msg}")
+            res.text = json.dumps({"message": ok_msg})
+            res.status = falcon.HTTP_200
+        else:
+            logging.critical(f"Controls: {err_msg}")
+            res.text = json.dumps({"message": err_msg})
+            res.status = falcon.HTTP_409
+
+    async def on_post_start(self, req, res):
+        await self.obs_command(res, self.obs_websoc.start_stream(), "Stream started.", "Error starting stream.")
+
+    async def on_post_stop(self, req, res):
+        await self.obs_command(res, self.obs_websoc.stop_stream(), "Stream stopped.", "Error stopping stream.")
+
+    async def on_post_brb(self, req, res):
+        # Explicitly lock, because that's how it behaved before.
+        self.shared_state.put("scene_lock", True)
+        await self.obs_command(res, self.obs_websoc.go_brb(), "Going brb.", "Error going brb.")
+
+    async def on_post_back(self, req, res):
+        # Explicitly unlock, because that's how it behaved before.
+        self.shared_state.put("scene_lock", False)
+        await self.obs_command(res, self.obs_websoc.go_normal(), "Going normal.", "Error going normal.")
+
+    async def on_post_unlock(self, req, res):
+        self.shared_state.put("scene_lock", False)
+        logging.warning(f"Controls: Scene Unlocked.")
+        res.text = json.dumps({"message": "Scene unlocked."})
+        res.status = falcon.HTTP_200
+
+    async def on_post_lock(self, req, res):
+        self.shared_state.put("scene_lock", True)
+        logging.warning(f"Controls: Scene locked.")
+        res.text = json.dumps({"message": "Scene locked."})
+        res.status = falcon.HTTP_200
+
+
+class KeyMiddleware:
+    def __init__(self, api_key):
+        self.api_key = api_key
+
+    async def process_request(self, req, res):
+        key = req.get_header('X-API-Key')
+        if key != self.api_key:
+            err = json.dumps({"message": "API key required"})
+            raise falcon.HTTPUnauthorized(err)
+
+
+class Supervisor:
+    """
+    Starts the SRT/SRTLA processes and the scene switcher when the server starts, and stops them when it shuts down.
+    This is ASGI lifespan middleware, the equivalent of the module level setup and on_exit in remote_control.py.
+    """
+    def __init__(self, config, shared_state, websocket):
+        self.config = config
+        self.shared_state = shared_state
+        self.obs_websoc = websocket
+        self.tasks = []
+        self.srt_thread = None
+        self.srtla_thread = None
+        self.obs_ctrl = None
+
+    async def process_startup(self, scope, event):
+        # The threads aren't started, their output is handled from the event loop instead.
+        self.srt_thread = srtos.make_srt(self.config)
+        self.srtla_thread = srtos.make_srtla(self.config)
+        try:
+            await self.obs_websoc.ensure_connected()
+        except Exception as e:
+            # OBS may not be up yet, the next call will try again.
+            logging.error(f"OBS: initial connection failed: {e}")
+        self.obs_ctrl = AsyncOBSControl(srt_thread=self.srt_thread, websocket=self.obs_websoc, shared_state=self.shared_state)
+        self.tasks = [
+            asyncio.create_task(ProcessWatcher(self.srt_thread, srt_handler(self.srt_thread)).run()),
+            asyncio.create_task(ProcessWatcher(self.srtla_thread, srtla_handler(self.srtla_thread)).run()),
+            asyncio.create_task(self.obs_ctrl.run_async()),
+        ]
+
+    async def process_shutdown(self, scope, event):
+        logging.info("Shutting down.")
+        try:
+            await self.obs_websoc.go_brb()
+        except Exception as e:
+            logging.error(f"OBS: go brb on exit failed: {e}")
+        self.obs_ctrl.stop()
+        self.srt_thread.stop()
+        self.srtla_thread.stop()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        await self.obs_websoc.disconnect()
+
+
+config = srtos.get_config()
+
+# Configure logging first, before doing anything else.
+configure_logging(log_level=config["logging"]["log_level"])
+
+api_key = generate_api_key(config)
+div = "--------------------------------------------"
+print(f"\nAPI Key:")
+print(div)
+print(f"{api_key}")
+print(div)
+
+shared_state = LocalState()
+obs_websoc = AsyncOBSWebsocket(config)
+supervisor = Supervisor(config, shared_state, obs_websoc)
+
+app = application = falcon.asgi.App(middleware=[supervisor, KeyMiddleware(api_key)])
+
+stream_controls = StreamControls(api_key=api_key, shared_state=shared_state, websocket=obs_websoc)
+
+app.add_route("/heartbeat", stream_controls, suffix="heartbeat")
+app.add_route("/start", stream_controls, suffix="start")
+app.add_route("/stop", stream_controls, suffix="stop")
+app.add_route("/brb", stream_controls, suffix="brb")
+app.add_route("/back", stream_controls, suffix="back")
+app.add_route("/unlock", stream_controls, suffix="unlock")
+app.add_route("/lock", stream_controls, suffix="lock")
+app.add_route("/status", stream_controls)
+app.add_route("/", stream_controls)
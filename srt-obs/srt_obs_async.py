@@ -0,0 +1,303 @@
+import asyncio
+import base64
+import hashlib
+import json
+
+import websockets
+from loguru import logger as logging
+from obswebsocket import events, requests
+
+from srt_obs_switcher import OBSControl, OBSStateCache
+
+
+class AsyncOBSWebsocket:
+    """
+    asyncio version of OBSWebsocket, speaking the obs-websocket 4.x protocol directly over the websockets library.
+    obs-websocket-py's request and event classes are still used to build requests and parse responses/events.
+    Requests are pipelined, each one waits on its own future, and OBS state is read from the same event driven cache.
+    """
+    def __init__(self, obs_cfg):
+        self.config = obs_cfg["obs"]
+        self.normal_scene = self.config["scene_name"]
+        self.brb_scene = self.config["brb_scene_name"]
+        self.timeout = self.config.get("request_timeout", 5.0)
+        self.ws = None
+        self.recv_task = None
+        self.ready = False
+        self.next_id = 0
+        self.pending = {}
+        self.state = OBSStateCache()
+        self.event_handlers = {}
+        for callback, event in self.state.handlers():
+            self.event_handlers.setdefault(event.__name__, []).append(callback)
+        self.scene_listeners = []
+        self.connect_lock = asyncio.Lock()
+
+    @property
+    def is_connected(self):
+        # An invalid cache, like after OBS says it's exiting, needs a reconnect to refresh it too.
+        return self.ready and not self.recv_task.done() and self.state.valid
+
+    async def ws_connect(self):
+        ws_host = self.config["websocket_host"]
+        ws_port = self.config["websocket_port"]
+        logging.debug(f"OBS command: connect. host: {ws_host}, port: {ws_port}.")
+        self.ready = False
+        if self.ws is not None:
+            # Let the old connection's recv loop finish first, so it can't invalidate the state after it's been refreshed.
+            await self.ws.close()
+            await self.recv_task
+        self.ws = await websockets.connect(f"ws://{ws_host}:{ws_port}", max_size=None)
+        self.recv_task = asyncio.create_task(self.recv_loop(self.ws))
+        await self.auth(self.config["websocket_secret"])
+        # Register for events (by having the recv loop running) before fetching the state, so nothing gets missed.
+        scene_list = await self.request(requests.GetSceneList())
+        sources = await self.request(requests.GetSourcesList())
+        status = await self.request(requests.GetStreamingStatus())
+        self.state.update(scene_list, sources.getSources(), status)
+        self.ready = True
+        logging.warning(f"OBS command: connected.")
+
+    async def ensure_connected(self):
+        async with self.connect_lock:
+            if not self.is_connected:
+                await self.ws_connect()
+
+    async def auth(self, password):
+        result = await self.send({"request-type": "GetAuthRequired"})
+        if not result.get("authRequired"):
+            return
+        secret = base64.b64encode(hashlib.sha256((password + result["salt"]).encode("utf-8")).digest())
+        auth = base64.b64encode(hashlib.sha256(secret + result["challenge"].encode("utf-8")).digest()).decode("utf-8")
+        result = await self.send({"request-type": "Authenticate", "auth": auth})
+        if result["status"] != "ok":
+            raise ConnectionError(f"OBS authentication failed: {result.get('error')}")
+
+    async def recv_loop(self, ws):
+        try:
+            async for message in ws:
+                result = json.loads(message)
+                if "update-type" in result:
+                    self.on_event(result)
+                elif "message-id" in result:
+                    future = self.pending.pop(result["message-id"], None)
+                    if future is not None and not future.done():
+                        future.set_result(result)
+        except websockets.ConnectionClosed:
+            pass
+        logging.error("OBS: websocket closed.")
+        self.state.invalidate()
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("OBS websocket closed."))
+        self.pending = {}
+
+    def on_event(self, data):
+        name = data["update-type"]
+        callbacks = self.event_handlers.get(name, [])
+        if not callbacks and name != "SwitchScenes":
+            return
+        event = getattr(events, name)()
+        event.input(data)
+        for callback in callbacks:
+            callback(event)
+        if name == "SwitchScenes":
+            for callback in self.scene_listeners:
+                callback()
+
+    async def send(self, data, timeout=None):
+        """
+        Send a raw request and wait for its response.
+        Args:
+            data (dict): Request, without "message-id".
+            timeout (float, optional): Seconds to wait for a response. Defaults to the request_timeout config setting.
+        Returns:
+            dict: Raw response.
+        """
+        self.next_id += 1
+        message_id = str(self.next_id)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[message_id] = future
+        await self.ws.send(json.dumps(dict(data, **{"message-id": message_id})))
+        try:
+            return await asyncio.wait_for(future, self.timeout if timeout is None else timeout)
+        finally:
+            self.pending.pop(message_id, None)
+
+    async def call(self, obj, timeout=None):
+        """
+        Make a call with an obs-websocket-py request object, connecting first if needed.
+        Returns:
+            Baserequests: The request object, populated with the response.
+        """
+        if not self.is_connected:
+            await self.ensure_connected()
+        return await self.request(obj, timeout)
+
+    async def request(self, obj, timeout=None):
+        obj.input(await self.send(obj.data(), timeout))
+        return obj
+
+    async def disconnect(self):
+        logging.info("OBS command: disconnect.")
+        self.ready = False
+        if self.ws is not None:
+            await self.ws.close()
+        self.ws = None
+
+    def add_scene_listener(self, callback):
+        self.scene_listeners += [callback]
+
+    async def go_brb(self):
+        logging.info("OBS command: switch to BRB scene.")
+        return await self.set_scene(self.brb_scene)
+
+    async def go_normal(self):
+        logging.info("OBS command: switch to normal scene.")
+        return await self.set_scene(self.normal_scene)
+
+    async def set_scene(self, scene_name):
+        res = await self.call(requests.SetCurrentScene(scene_name))
+        if res.status:
+            with self.state.lock:
+                self.state.current_scene = scene_name
+            self.state.notify()
+        return res
+
+    async def start_stream(self):
+        logging.info("OBS command: start stream.")
+        return await self.call(requests.StartStreaming())
+
+    async def stop_stream(self):
+        logging.info("OBS command: stop stream.")
+        return await self.call(requests.StopStreaming())
+
+    # These can't connect, so they're None while the cache isn't valid. ensure_connected() first to refresh it.
+    @property
+    def current_scene(self):
+        return self.state.current_scene if self.state.valid else None
+
+    @property
+    def streaming(self):
+        return self.state.streaming if self.state.valid else None
+
+    @property
+    def recording(self):
+        return self.state.recording if self.state.valid else None
+
+
+class AsyncOBSControl(OBSControl):
+    """
+    OBSControl run as an asyncio task instead of a thread. The decisions are the same, in OBSControl.check().
+    Scene switches are started as tasks, so a slow OBS never holds up the checks.
+    This needs to be created from inside the running event loop.
+    """
+    def __init__(self, *args, **kwargs):
+        self.switch_tasks = set()
+        super().__init__(*args, **kwargs)
+        self.wakeup = asyncio.Event()
+
+    def wake(self):
+        # Listeners are called from the event loop, so this doesn't need call_soon_threadsafe.
+        self.wakeup.set()
+
+    def go_brb(self):
+        return self.switch(self.obs_websoc.go_brb())
+
+    def go_normal(self):
+        return self.switch(self.obs_websoc.go_normal())
+
+    def switch(self, coro):
+        task = asyncio.ensure_future(coro)
+        self.switch_tasks.add(task)
+        task.add_done_callback(self.switch_done)
+        return task
+
+    def switch_done(self, task):
+        self.switch_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logging.error(f"OBSControl: scene switch failed: {task.exception()}")
+
+    async def run_async(self):
+        logging.info("OBSControl task started.")
+        self.last_check = self.start_time
+        while not self.event.is_set():
+            self.wakeup.clear()
+            timeout = self.check()
+            logging.debug(f"SRT: next update on new stats, or in {round(timeout, 2)}s")
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+class ProcessWatcher:
+    """
+    Handles a ThreadManager's process output from the event loop, instead of running its thread.
+    """
+    def __init__(self, thread, handler):
+        """
+        Args:
+            thread (ThreadManager): Thread object that owns the process. It shouldn't be started.
+            handler (callable): Called when there's output to read. Returns False once the output has closed.
+        """
+        self.thread = thread
+        self.handler = handler
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while not self.thread.event.is_set():
+            # Look the fd up each time, as restarting the process replaces it.
+            fd = self.thread.stdout_fd
+            readable = asyncio.Event()
+            loop.add_reader(fd, readable.set)
+            try:
+                await readable.wait()
+            finally:
+                loop.remove_reader(fd)
+            if not self.handler():
+                logging.error(f"{self.thread.name}: process output closed.")
+                await self.restart()
+            elif self.thread.restart_requested:
+                self.thread.restart_requested = False
+                # restart_process() waits for the old process to exit, so it runs in a worker thread, not on the loop.
+                await loop.run_in_executor(None, self.thread.restart_process)
+
+    async def restart(self):
+        """
+        Restart the thread's process once it's exited, with the same backoff as ThreadManager.supervise().
+        """
+        while self.thread.process_running and not self.thread.event.is_set():
+            await asyncio.sleep(0.1)
+        delay = self.thread.crash_delay()
+        logging.error(f"{self.thread.name}: restarting in {delay}s. Crash count: {self.thread.crashes}.")
+        loop = asyncio.get_running_loop()
+        restart_at = loop.time() + delay
+        while not self.thread.event.is_set() and loop.time() < restart_at:
+            await asyncio.sleep(min(0.5, restart_at - loop.time()))
+        if not self.thread.event.is_set():
+            self.thread.restarts += 1
+            self.thread.start_process()
+
+
+def srt_handler(srt_thread):
+    # Never block in the event loop, the watcher only calls this once there's output.
+    srt_thread.update_interval = 0
+    # The watcher does planned restarts, off the event loop.
+    srt_thread.defer_restarts = True
+
+    def handler():
+        srt_thread.run_inner()
+        return not srt_thread.output_closed
+    return handler
+
+
+def srtla_handler(srtla_thread):
+    def handler():
+        msg = srtla_thread.read()
+        if msg == b'':
+            return False
+        if msg:
+            logging.info(f"SRTLA Message: {msg.decode('ASCII')}")
+        return True
+    return handler
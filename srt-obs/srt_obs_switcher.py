@@ -1,6 +1,6 @@
 from srt_stats import SRTThread, SRTLAThread
 import toml
-from obswebsocket import obsws, requests
+from obswebsocket import obsws, requests, events
 from dataclasses import dataclass
 from time import sleep
 from itertools import chain
@@ -8,8 +8,209 @@ import threading
 from datetime import datetime, timedelta
 from loguru import logger as logging
 from utils import get_config, ThreadManager
+from health import HealthEvaluator
 import threading
 
+
+class OBSStateCache:
+    """
+    Local copy of the OBS state we care about: current scene, sources, scene item visibility, and streaming/recording.
+    Filled once with refresh() when the websocket connects, and kept up to date by the obs-websocket events in handlers().
+    Events arrive on the websocket's thread, so everything is behind a lock.
+    Once the connection drops or OBS exits, events may have been missed, so it's invalid until it's been refreshed again.
+    """
+    media_src_types = ("vlc_source", "ffmpeg_source")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.valid = False
+        self.current_scene = None
+        self.sources = {}
+        self.scene_items = {}
+        self.streaming = False
+        self.recording = False
+        self.listeners = []
+
+    def add_listener(self, callback):
+        """
+        Call callback() after any change to the cache. It's called from the websocket's thread, so needs to be quick.
+        """
+        self.listeners += [callback]
+
+    def notify(self):
+        for callback in self.listeners:
+            callback()
+
+    def as_dict(self):
+        """
+        Returns:
+            dict: json serializable copy of the cache, that load() can read back.
+        """
+        with self.lock:
+            return {
+                "valid": self.valid,
+                "current_scene": self.current_scene,
+                "sources": list(self.sources.values()),
+                "scene_items": [[scene, item, visible] for (scene, item), visible in self.scene_items.items()],
+                "streaming": self.streaming,
+                "recording": self.recording,
+            }
+
+    def load(self, state):
+        """
+        Replace the cache with a copy from as_dict(), for keeping a copy of another process's cache.
+        """
+        with self.lock:
+            self.valid = state["valid"]
+            self.current_scene = state["current_scene"]
+            self.sources = {x["name"]: x for x in state["sources"]}
+            self.scene_items = {(scene, item): visible for scene, item, visible in state["scene_items"]}
+            self.streaming = state["streaming"]
+            self.recording = state["recording"]
+        self.notify()
+
+    def refresh(self, ws):
+        """
+        Fetch everything from OBS. This is the only time the cache makes requests.
+        Args:
+            ws (obsws): Connected websocket to use.
+        """
+        logging.debug("OBS state: refresh.")
+        scene_list = ws.call(requests.GetSceneList())
+        sources = ws.call(requests.GetSourcesList()).getSources()
+        status = ws.call(requests.GetStreamingStatus())
+        self.update(scene_list, sources, status)
+
+    def update(self, scene_list, sources, status):
+        """
+        Replace the cache with fresh responses from OBS.
+        Args:
+            scene_list (GetSceneList): Response to GetSceneList.
+            sources (list): Sources from the response to GetSourcesList.
+            status (GetStreamingStatus): Response to GetStreamingStatus.
+        """
+        with self.lock:
+            self.current_scene = scene_list.getCurrentScene()
+            self.scene_items = {
+                (scene["name"], item["name"]): item["render"]
+                for scene in scene_list.getScenes()
+                for item in scene["sources"]
+            }
+            self.sources = {x["name"]: x for x in sources}
+            self.streaming = status.getStreaming()
+            self.recording = status.getRecording()
+            self.valid = True
+        self.notify()
+
+    def invalidate(self):
+        with self.lock:
+            self.valid = False
+        self.notify()
+
+    def handlers(self):
+        """
+        Returns:
+            list: (callback, event) pairs to register on the websocket.
+        """
+        return [
+            (self.on_switch_scenes, events.SwitchScenes),
+            (self.on_item_visibility, events.SceneItemVisibilityChanged),
+            (self.on_item_added, events.SceneItemAdded),
+            (self.on_item_removed, events.SceneItemRemoved),
+            (self.on_source_created, events.SourceCreated),
+            (self.on_source_destroyed, events.SourceDestroyed),
+            (self.on_source_renamed, events.SourceRenamed),
+            (self.on_streaming, events.StreamStarted),
+            (self.on_streaming, events.StreamStopped),
+            (self.on_recording, events.RecordingStarted),
+            (self.on_recording, events.RecordingStopped),
+            (self.on_exiting, events.Exiting),
+        ]
+
+    def on_exiting(self, message):
+        logging.warning("OBS event: OBS is exiting.")
+        self.invalidate()
+
+    def on_switch_scenes(self, message):
+        with self.lock:
+            self.current_scene = message.getSceneName()
+        logging.debug(f"OBS event: scene switched to {message.getSceneName()}.")
+        self.notify()
+
+    def on_item_visibility(self, message):
+        with self.lock:
+            self.scene_items[(message.getSceneName(), message.getItemName())] = message.getItemVisible()
+        self.notify()
+
+    def on_item_added(self, message):
+        # New scene items are visible by default. If not, a visibility event follows.
+        with self.lock:
+            self.scene_items[(message.getSceneName(), message.getItemName())] = True
+        self.notify()
+
+    def on_item_removed(self, message):
+        with self.lock:
+            self.scene_items.pop((message.getSceneName(), message.getItemName()), None)
+        self.notify()
+
+    def on_source_created(self, message):
+        with self.lock:
+            name = message.getSourceName()
+            self.sources[name] = {"name": name, "typeId": message.getSourceKind(), "type": message.getSourceType()}
+        self.notify()
+
+    def on_source_destroyed(self, message):
+        with self.lock:
+            self.sources.pop(message.getSourceName(), None)
+        self.notify()
+
+    def on_source_renamed(self, message):
+        old, new = message.getPreviousName(), message.getNewName()
+        with self.lock:
+            if old in self.sources:
+                self.sources[new] = dict(self.sources.pop(old), name=new)
+            for scene, item in [k for k in self.scene_items if k[1] == old]:
+                self.scene_items[(scene, new)] = self.scene_items.pop((scene, item))
+        self.notify()
+
+    def on_streaming(self, message):
+        with self.lock:
+            self.streaming = message.name == "StreamStarted"
+        logging.debug(f"OBS event: {message.name}.")
+        self.notify()
+
+    def on_recording(self, message):
+        with self.lock:
+            self.recording = message.name == "RecordingStarted"
+        self.notify()
+
+    def media_sources(self):
+        with self.lock:
+            return [x for x in self.sources.values() if x["typeId"] in self.media_src_types]
+
+    def is_visible(self, scene_name, item_name):
+        with self.lock:
+            return self.scene_items.get((scene_name, item_name), False)
+
+
+class CachingObsws(obsws):
+    """
+    obsws that invalidates the state cache when the connection drops, instead of reconnecting by itself.
+    A reconnect here wouldn't refresh the cache, and any events in between would be lost.
+    OBSWebsocket.ensure_connected() reconnects and refreshes it the next time it's used.
+    """
+    def __init__(self, *args, state=None, **kwargs):
+        self.state = state
+        super().__init__(*args, **kwargs)
+
+    def reconnect(self):
+        # Called from the receive thread when the connection closes.
+        logging.error("OBS: websocket closed.")
+        if self.state is not None:
+            self.state.invalidate()
+        self.thread_recv.running = False
+
+
 class OBSWebsocket:
     def __init__(self, obs_cfg):
         self.config = obs_cfg["obs"]
@@ -18,16 +219,24 @@ class OBSWebsocket:
         self.ws = None
         self.scenes = None
         self.is_connected = False
+        # Kept up to date from obs-websocket events, so reads don't need a round trip to OBS.
+        self.state = OBSStateCache()
+        self.scene_listeners = []
 
     def ws_connect(self):
         logging.debug("OBS Command: Attempting websocket connection.")
         ws_host = self.config["websocket_host"]
         ws_port = self.config["websocket_port"]
         ws_secret = self.config["websocket_secret"]
-        ws = obsws(ws_host, ws_port, ws_secret)
+        ws = CachingObsws(ws_host, ws_port, ws_secret, state=self.state)
         logging.debug(f"OBS command: connect. host: {ws_host}, port: {ws_port}, secret: {ws_secret}.")
+        for callback, event in self.state.handlers():
+            ws.register(callback, event)
+        ws.register(self.on_switch_scenes, events.SwitchScenes)
         ws.connect()
         logging.debug(f"OBS Command: Websocket successful: {ws}")
+        # Register before refreshing, so that nothing that changes in between gets missed.
+        self.state.refresh(ws)
         return ws
 
     def ws_call(self, *args, **kwargs):
@@ -37,16 +246,66 @@ class OBSWebsocket:
         Basically, defer connecting the websocket until the first time a call is made to it.
         This _does_ mean that there will be one connection per thread/process using it.
         """
-        if not self.is_connected:
-            self.ws = self.ws_connect()
-            logging.warning(f"OBS command: first connect.")
-            self.is_connected = True
-        return self.ws.call(*args, **kwargs)
+        self.ensure_connected()
+        try:
+            return self.ws.call(*args, **kwargs)
+        except Exception:
+            # The cache can't be trusted if we might have missed events, so reconnect and refresh on the next call.
+            logging.error(f"OBS command: call failed, will reconnect.")
+            self.is_connected = False
+            self.state.invalidate()
+            raise
+
+    @property
+    def connected(self):
+        """
+        True if the websocket is up and the state cache can be trusted.
+        """
+        if not self.is_connected or not self.state.valid:
+            return False
+        thread = self.ws.thread_recv
+        return thread is not None and thread.is_alive()
+
+    def ensure_connected(self):
+        """
+        Connect, or reconnect if the connection has dropped or the cache may have missed events, which also refreshes the cache.
+        """
+        if self.connected:
+            return
+        if self.ws is not None:
+            try:
+                self.ws.disconnect()
+            except Exception:
+                pass
+        self.is_connected = False
+        self.ws = self.ws_connect()
+        logging.warning(f"OBS command: connected.")
+        self.is_connected = True
+
+    def refresh_state(self):
+        """
+        Reconnect and refresh the state cache if it isn't valid. For the broker, so its clients don't read stale state.
+        """
+        self.ensure_connected()
+
+    def ensure_state(self):
+        """
+        Returns:
+            bool: True if the state cache is valid, reconnecting first if it needs to. False if OBS can't be reached, and the state is unknown.
+        """
+        try:
+            self.ensure_connected()
+            return True
+        except Exception as e:
+            logging.error(f"OBS command: can't refresh the state: {e}")
+            self.is_connected = False
+            return False
 
     def disconnect(self):
         logging.info("OBS command: disconnect.")
         self.ws.disconnect()
         self.is_connected = False
+        self.state.invalidate()
 
     def get_scenes(self):
         logging.info("OBS command: get all scenes.")
@@ -55,12 +314,21 @@ class OBSWebsocket:
     def go_brb(self):
         logging.info("OBS command: switch to BRB scene.")
         # self.media_source_toggle()
-        return self.ws_call(requests.SetCurrentScene(self.brb_scene))
+        return self.set_scene(self.brb_scene)
 
     def go_normal(self):
         logging.info("OBS command: switch to normal scene.")
         self.media_source_toggle()
-        return self.ws_call(requests.SetCurrentScene(self.normal_scene))
+        return self.set_scene(self.normal_scene)
+
+    def set_scene(self, scene_name):
+        res = self.ws_call(requests.SetCurrentScene(scene_name))
+        if res.status:
+            # Don't wait for the SwitchScenes event to come back.
+            with self.state.lock:
+                self.state.current_scene = scene_name
+            self.state.notify()
+        return res
 
     def start_stream(self):
         logging.info("OBS command: start stream.")
@@ -74,6 +342,21 @@ class OBSWebsocket:
         logging.info("OBS command: get stream status.")
         return self.ws_call(requests.GetStreamingStatus())
 
+    @property
+    def streaming(self):
+        """
+        None if OBS can't be reached, rather than what it was before.
+        """
+        if not self.ensure_state():
+            return None
+        return self.state.streaming
+
+    @property
+    def recording(self):
+        if not self.ensure_state():
+            return None
+        return self.state.recording
+
     def get_current_scene(self):
         logging.info("OBS command: get current scene.")
         return self.current_scene
@@ -81,23 +364,38 @@ class OBSWebsocket:
     @property
     def current_scene(self):
         logging.debug(f"OBS property: current_scene.")
-        return self.ws_call(requests.GetCurrentScene()).getName()
+        if not self.ensure_state():
+            return None
+        return self.state.current_scene
+
+    def on_switch_scenes(self, message):
+        """
+        obs-websocket SwitchScenes event callback, from the websocket's thread.
+        The state cache has its own handler for it, this only passes it on.
+        """
+        for callback in self.scene_listeners:
+            callback()
+
+    def add_scene_listener(self, callback):
+        """
+        Call callback() whenever OBS reports a scene switch. It's called from the websocket's thread, so needs to be quick.
+        """
+        self.scene_listeners += [callback]
 
     def get_media_sources(self):
-        srcs = self.ws_call(requests.GetSourcesList()).getSources()
-        media_src_types = ("vlc_source", "ffmpeg_source")
-        media_sources = [x for x in srcs if x['typeId'] in media_src_types]
+        if not self.ensure_state():
+            return []
+        media_sources = self.state.media_sources()
         logging.debug(f"OBS command: get media sources.\n{media_sources}")
         return media_sources
 
     @property
-    def active_media_source(self, live_scene_name="IRL Input"):
-        # This assumes that the only visible media source is active.
+    def active_media_source(self):
+        # This assumes that the only visible media source in the live scene is active.
         logging.debug(f"OBS property: active_media_source.")
-        srcs = self.get_media_sources()
-        for s in srcs:
+        for s in self.get_media_sources():
             k = s["name"]
-            if self.ws_call(requests.GetSceneItemProperties(k, live_scene_name)).getVisible():
+            if self.state.is_visible(self.normal_scene, k):
                 return k
 
     def stop_media_source(self, source_name):
@@ -152,9 +450,15 @@ class OBSControl(threading.Thread):
         self.brb_scene = self.obs_cfg["brb_scene_name"]
         self.stabilize_dec = self.thresholds["check_interval"]
         self.obs_websoc = websocket
+        # Set whenever there's something to react to: new stats, an SRT message or a scene switch.
+        self.wakeup = threading.Event()
+        self.srt_thread.add_update_listener(self.wake)
+        self.obs_websoc.add_scene_listener(self.wake)
+        # Nothing from another process wakes us (like the scene lock), so still check this often when idle.
+        self.idle_interval = self.thresholds.get("idle_interval", 1.0)
         self.ra_samples = self.thresholds["running_avg"]
-        self.bitrate_samples = [None for _ in range(self.ra_samples)]
-        self.rtt_samples = [None for _ in range(self.ra_samples)]
+        self.health = HealthEvaluator(self.thresholds, self.srt_thread.history, self.srt_thread.stats_interval)
+        self.last_sample_time = None
         self.connected = False
         #  5 added because it seemed too short otherwise. This seems like a hack...
         self.update_timeout = timedelta(seconds=self.stabilize_dec * self.ra_samples * 5)
@@ -163,8 +467,20 @@ class OBSControl(threading.Thread):
         self.start_time = datetime.now()
         self.name="OBSctrl"
         self.shared_state = shared_state
+        self.stabilize_countdown = 0
+        self.healthy = False
+        self.last_check = datetime.now()
         # Make sure we're on our live scene.
-        self.obs_websoc.go_normal()
+        self.go_normal()
+
+    def wake(self):
+        self.wakeup.set()
+
+    def go_brb(self):
+        return self.obs_websoc.go_brb()
+
+    def go_normal(self):
+        return self.obs_websoc.go_normal()
 
     @property
     def scene_locked(self):
@@ -180,174 +496,243 @@ class OBSControl(threading.Thread):
 
     @property
     def bitrate_ra(self):
-        res = sum([x for x in self.bitrate_samples if not x in (None, 0)]) / self.ra_samples
-        return round(res, 2) 
+        res = self.health.bitrate.mean
+        return round(res, 2) if res is not None else None
 
     @property
     def rtt_ra(self):
-        res = sum([x for x in self.rtt_samples if not x in (None, 0)]) / self.ra_samples
-        return round(res, 2)
+        res = self.health.rtt.mean
+        return round(res, 2) if res is not None else None
 
     def run(self):
         logging.info("OBSControl thread started.")
-
-        stabilize_countdown = 0
-        idx = 0
-        healthy = False
+        self.last_check = datetime.now()
         while not self.event.is_set():
-            idx += 1
-            current_scene = self.obs_websoc.current_scene
-            logging.debug(f"Current scene: {current_scene}, countdown: {round(stabilize_countdown, 2)}.")
-            stats = self.srt_thread.last_stats
-            stats_time = self.srt_thread.last_update
-            timestamp = datetime.now()
-
-            # track connection state
-            self.connected = self.srt_thread.connected
-
-            # If the source disconnects due to a drop without explicitly disconnecting, we should go brb.
-            # This is explicitly needed because the stats don't update in this case, so the code never sees the bitrate disappear.
-            # We should only complain about a failure to update stats when the source is connected. There may be an edge case here.
-            last_update_delta = timestamp - stats_time
-            stats_fresh = True
-            if last_update_delta >= self.update_timeout and self.connected and healthy:
-                logging.warning(f"SRT: Stats have not been updated for: {last_update_delta}, which is longer than cutoff: {self.update_timeout}.")
-                healthy = False
-                # Otherwise the health checks use stale stats, and while this check doesn't need to be before this part, this seems cleaner.
-                stats_fresh = False
+            self.wakeup.clear()
+            timeout = self.check()
+            logging.debug(f"SRT: next update on new stats, or in {round(timeout, 2)}s")
+            self.wakeup.wait(timeout)
+
+    def check(self):
+        """
+        Check the SRT health and switch scenes if needed. Called whenever there are new stats, or a deadline passes.
+        Returns:
+            float: Longest time to wait before calling this again, in seconds.
+        """
+        stabilize_countdown = self.stabilize_countdown
+        healthy = self.healthy
+        last_check = self.last_check
+        current_scene = self.obs_websoc.current_scene
+        logging.debug(f"Current scene: {current_scene}, countdown: {round(stabilize_countdown, 2)}.")
+        stats = self.srt_thread.last_stats
+        stats_time = self.srt_thread.last_update
+        timestamp = datetime.now()
+        # The countdowns go by how long it's actually been, as checks don't happen at a fixed interval.
+        elapsed = (timestamp - last_check).total_seconds()
+        last_check = timestamp
+
+        # track connection state
+        self.connected = self.srt_thread.connected
+
+        # If the source disconnects due to a drop without explicitly disconnecting, we should go brb.
+        # This is explicitly needed because the stats don't update in this case, so the code never sees the bitrate disappear.
+        # We should only complain about a failure to update stats when the source is connected. There may be an edge case here.
+        last_update_delta = timestamp - stats_time
+        stats_fresh = True
+        if last_update_delta >= self.update_timeout and self.connected and healthy:
+            logging.warning(f"SRT: Stats have not been updated for: {last_update_delta}, which is longer than cutoff: {self.update_timeout}.")
+            healthy = False
+            # Otherwise the health checks use stale stats, and while this check doesn't need to be before this part, this seems cleaner.
+            stats_fresh = False
+            stats = {}
+            
+        self.health.expire()
+        if stats != {} and stats_fresh:
+            # Only feed each sample in once, the windows are time based.
+            if stats_time != self.last_sample_time:
+                self.last_sample_time = stats_time
+                self.health.add_sample(stats)
+            bitrate_healthy = self.check_bitrate_health(stats)
+            rtt_healthy = self.check_rtt_health(stats)
+            loss_healthy = self.check_loss_health()
+            if bitrate_healthy is None or rtt_healthy is None:
+                # Nothing to judge by, so stay as healthy or unhealthy as we were, rather than calling it healthy.
+                logging.info(f"SRT: sid: {str(stats['sid'])[-2:]}: Skipping! {stats['send']['mbitRate']}, {stats['recv']['mbitRate']}")
                 stats = {}
-                
-            if stats != {} and stats_fresh:
-                bitrate_healthy = self.check_bitrate_health(idx)
-                rtt_healthy = self.check_rtt_health(idx)
-                if bitrate_healthy is None:
-                    bitrate_healthy = True
-                    logging.info(f"SRT: sid: {str(stats['sid'])[-2:]}: Skipping! {stats['send']['mbitRate']}, {stats['recv']['mbitRate']}")
-                    stats = {}
-                if bitrate_healthy and rtt_healthy:
-                    logging.info(f"SRT: Healthy, Bitrate: {self.bitrate_ra}Mb/s, RTT: {self.rtt_ra}ms.")
-                    healthy = True
-                else:
-                    healthy = False
-            elif stats == {} and stats_fresh:
-                logging.info(f"SRT stats blank.")
+            elif bitrate_healthy and rtt_healthy and loss_healthy:
+                logging.info(f"SRT: Healthy, Bitrate: {self.bitrate_ra}Mb/s, RTT: {self.rtt_ra}ms.")
+                healthy = True
             else:
-                pass
-
-            if not self.connected:
                 healthy = False
-            else:
-                pass
-                # healthy = True
+        elif stats == {} and stats_fresh:
+            logging.info(f"SRT stats blank.")
+        else:
+            pass
+
+        if not self.connected:
+            healthy = False
+        else:
+            pass
+            # healthy = True
 
-            if stats != {}:
-                logging.debug(f"rtt: {self.rtt_ra}, bitrate: {self.bitrate_ra}, healthy: {healthy}, locked: {self.scene_locked}, connected: {self.connected}.")
-                logging.debug(f"rtt hist: {self.rtt_samples}, bitrate hist: {self.bitrate_samples}, update delta: {last_update_delta}.")
+        if stats != {}:
+            logging.debug(f"rtt: {self.rtt_ra}, bitrate: {self.bitrate_ra}, healthy: {healthy}, locked: {self.scene_locked}, connected: {self.connected}.")
+            logging.debug(f"health: {self.health.snapshot()}, update delta: {last_update_delta}.")
+        else:
+            logging.debug(f"No stats. Healthy: {healthy}, locked: {self.scene_locked}, connected: {self.connected}.")
+            logging.debug(f"health: {self.health.snapshot()}, update delta: {last_update_delta}.")
+
+        self.publish_health(healthy, stats_time)
+
+        if not self.scene_locked and not self.connected:
+        # if not self.obs_websoc.scene_locked and not self.connected:
+            healthy = False
+
+        # If scene has been manually locked, don't switch scenes, even if we otherwise should.
+        if self.scene_locked:
+            pass
+        elif not healthy and current_scene != self.brb_scene and self.srt_thread.restarting:
+            # srt-live-transmit was restarted on purpose, and the source should be back before the grace time is up.
+            logging.info(f"SRT: srt-live-transmit restarting, holding the current scene until {self.srt_thread.restart_grace_until}.")
+        elif healthy:
+            if stabilize_countdown >= 0.0:
+                stabilize_countdown -= elapsed
+                logging.info(f"SRT: in stabilization countdown: {round(stabilize_countdown, 2)}s.")
+            if current_scene == self.brb_scene and stabilize_countdown < 0.0:
+                logging.warning(f"SRT: stabilization countdown finished.")
+                self.go_normal()
+        elif current_scene != self.brb_scene:
+            logging.info(f"SRT: cooldown timer: {self.cooldown_timer}")
+            if timestamp > self.cooldown_timer:
+                logging.warning(f"SRT: Switching to BRB scene.")
+                self.go_brb()
+                stabilize_countdown = self.thresholds["stabilize_time"]
+                self.cooldown_timer = datetime.now() + self.cooldown_timeout
+            else:
+                logging.info(f"BRB triggered, but on cooldown for {timestamp - self.cooldown_timeout}.")
+        else:
+            logging.info(f"Current scene: {current_scene}")
+            logging.debug(f"SRT: starting stabilization countdown {stabilize_countdown}")
+            if stabilize_countdown <= 0:
+                stabilize_countdown = self.thresholds["stabilize_time"]
             else:
-                logging.debug(f"No stats. Healthy: {healthy}, locked: {self.scene_locked}, connected: {self.connected}.")
-                logging.debug(f"rtt hist: {self.rtt_samples}, bitrate hist: {self.bitrate_samples}, update delta: {last_update_delta}.")
+                stabilize_countdown -= elapsed
 
-            if not self.scene_locked and not self.connected:
-            # if not self.obs_websoc.scene_locked and not self.connected:
-                healthy = False
+        self.stabilize_countdown = stabilize_countdown
+        self.healthy = healthy
+        self.last_check = last_check
+        return self.next_deadline(healthy, stabilize_countdown, stats_time)
 
-            # If scene has been manually locked, don't switch scenes, even if we otherwise should.
-            if self.scene_locked:
-                pass
-            elif healthy:
-                if stabilize_countdown >= 0.0:
-                    stabilize_countdown -= self.stabilize_dec
-                    logging.info(f"SRT: in stabilization countdown: {round(stabilize_countdown, 2)}s.")
-                elif current_scene == self.brb_scene and stabilize_countdown <= 0.0:
-                    logging.warning(f"SRT: stabilization countdown finished.")
-                    self.obs_websoc.go_normal()
-            elif current_scene != self.brb_scene:
-                logging.info(f"SRT: cooldown timer: {self.cooldown_timer}")
-                if timestamp > self.cooldown_timer:
-                    logging.warning(f"SRT: Switching to BRB scene.")
-                    self.obs_websoc.go_brb()
-                    stabilize_countdown = self.thresholds["stabilize_time"]
-                    self.cooldown_timer = datetime.now() + self.cooldown_timeout
-                else:
-                    logging.info(f"BRB triggered, but on cooldown for {timestamp - self.cooldown_timeout}.")
-            else:
-                logging.info(f"Current scene: {current_scene}")
-                logging.debug(f"SRT: starting stabilization countdown {stabilize_countdown}")
-                if stabilize_countdown <= 0:
-                    stabilize_countdown = self.thresholds["stabilize_time"]
-                else:
-                    stabilize_countdown -= self.stabilize_dec
+    def publish_health(self, healthy, stats_time):
+        """
+        Put the latest health in the shared state, so any worker can report it without asking this thread.
+        """
+        snapshot = self.health.snapshot()
+        del snapshot["samples"]
+        snapshot.update(srt_connected=self.connected, srt_healthy=healthy, stats_time=stats_time.timestamp())
+        self.shared_state.put_many(snapshot)
 
-            logging.debug(f"SRT: next update in {self.thresholds['check_interval']}s")
-            self.event.wait(self.thresholds["check_interval"])
+    def next_deadline(self, healthy, stabilize_countdown, stats_time):
+        """
+        Work out the longest we can wait for new stats before something needs checking anyway.
+        Returns:
+            float: Seconds to wait.
+        """
+        now = datetime.now()
+        deadlines = [self.idle_interval]
+        if healthy and self.connected:
+            # Stats going stale is the one failure that doesn't produce any stats to wake us.
+            deadlines += [(stats_time + self.update_timeout - now).total_seconds()]
+        if stabilize_countdown >= 0.0:
+            deadlines += [stabilize_countdown]
+        if self.cooldown_timer > now:
+            deadlines += [(self.cooldown_timer - now).total_seconds()]
+        if self.srt_thread.restarting:
+            deadlines += [(self.srt_thread.restart_grace_until - now).total_seconds()]
+        return max(min(deadlines), self.stabilize_dec)
 
     def stop(self):
         logging.info(f"Stopping OBS control thread started at {self.start_time}.")
         self.event.set()
+        self.wakeup.set()
 
-    def check_bitrate_health(self, idx):
+    def check_bitrate_health(self, stats):
         """
         Handles the bitrate health checks. If the bitrate threshold is -1, skip checking.
         """
         logging.debug("Health check: Bitrate.")
         if self.thresholds["bitrate"] == -1:
             return True
-        stats = self.srt_thread.last_stats
         # When the stats are (0, 0), this could trigger a spurious disconnect.
         # For whatever reason, srt-live-transmit will report a 0 bitrate, even if bits are being sent.
         # So this should be ignored. This may cause an issue with actual 0 birates, but if the bitrate is under any circumstances, then the brb scene should probably be switched to.
-        if (stats["send"]["mbitRate"], stats['recv']['mbitRate']) != (0, 0):
-            # This is a workaround for not always getting the same stats.
-            max_bitrate = max(stats["send"]["mbitRate"], stats['recv']['mbitRate'])
-            self.bitrate_samples[idx % self.ra_samples] = max_bitrate
-
-            logging.debug(f"SRT: sid: {str(stats['sid'])[-2:]}: tx: {stats['send']['mbitRate']}, rx: {stats['recv']['mbitRate']}")
-            bitrate_healthy = self.bitrate_ra >= self.thresholds["bitrate"]
-            if not bitrate_healthy:
-                logging.warning(f"SRT: Bitrate failed health check. Bitrate: {self.bitrate_ra}Mb/s.")
-                return False
-            else:
-                return True
-        else:
+        # The health evaluator doesn't record these samples either.
+        if (stats["send"]["mbitRate"], stats['recv']['mbitRate']) == (0, 0):
             return None
+        logging.debug(f"SRT: sid: {str(stats['sid'])[-2:]}: tx: {stats['send']['mbitRate']}, rx: {stats['recv']['mbitRate']}")
+        bitrate_healthy = self.health.bitrate_healthy()
+        if bitrate_healthy is None:
+            return None
+        if not bitrate_healthy:
+            logging.warning(f"SRT: Bitrate failed health check. Bitrate: {self.bitrate_ra}Mb/s, EWMA: {self.health.bitrate.ewma}Mb/s.")
+        return bitrate_healthy
 
-    def check_rtt_health(self, idx):
+    def check_rtt_health(self, stats):
         """
         Handles the RTT health checks. If the RTT threshold is -1, skip checking.
+        Returns None if there haven't been any samples to judge by.
         """
         logging.debug("Health check: RTT.")
         if self.thresholds["rtt"] == -1:
             return True
-        stats = self.srt_thread.last_stats
-        self.rtt_samples[idx % self.ra_samples] = stats["link"]["rtt"]
         logging.debug(f"SRT: sid: {str(stats['sid'])[-2:]}: {stats['link']['rtt']}")
-        rtt_healthy = self.rtt_ra <= self.thresholds["rtt"]
-        if not rtt_healthy:
-            logging.warning(f"SRT: Failed health check. RTT: {self.rtt_ra}ms.")
-            return False
-        return True
+        rtt_healthy = self.health.rtt_healthy()
+        if rtt_healthy is False:
+            logging.warning(f"SRT: Failed health check. RTT: {self.rtt_ra}ms, p95: {self.health.rtt_p95}ms.")
+        return rtt_healthy
 
-def start_srt(config):
+    def check_loss_health(self):
+        """
+        Handles the packet loss health checks. If the loss_rate threshold is -1 or not set, skip checking.
+        """
+        loss_healthy = self.health.loss_healthy()
+        if not loss_healthy:
+            logging.warning(f"SRT: Failed health check. Loss rate: {self.health.loss_rate}.")
+        return loss_healthy
+
+def make_srt(config):
+    """
+    Create the SRTThread from the [srt_relay] config, which also starts srt-live-transmit. The thread itself isn't started.
+    """
     srt_cfg = config["srt_relay"]
-    srt_passphrase = srt_cfg["encryption_passphrase"]
-    srt_thread = SRTThread(
+    return SRTThread(
         srt_destination=f"srt://:{srt_cfg['output_port']}",
         srt_source=f"srt://localhost:4001",
-        passphrase=srt_passphrase,
+        passphrase=srt_cfg["encryption_passphrase"],
         srt_live_transmit=srt_cfg['srtla_slt_path'],
-        loss_max_ttl=srt_cfg['srt_latency'],
-        srt_latency=srt_cfg['loss_max_ttl'],)
-    srt_thread.daemon = True
-    srt_thread.start()
-    return srt_thread
-
-def start_srtla(config):
+        loss_max_ttl=srt_cfg['loss_max_ttl'],
+        srt_latency=srt_cfg['srt_latency'],
+        restart_grace=srt_cfg.get('restart_grace', 5.0),)
+
+def make_srtla(config):
+    """
+    Create the SRTLAThread from the [srt_relay] config, which also starts srtla_rec. The thread itself isn't started.
+    """
     srtla_cfg = config["srt_relay"]
-    srtla_thread = SRTLAThread(
+    return SRTLAThread(
         srtla_cfg['srtla_rec_path'],
         srtla_cfg['listen_port'],
         "localhost",
         4001)
+
+def start_srt(config):
+    srt_thread = make_srt(config)
+    srt_thread.daemon = True
+    srt_thread.start()
+    return srt_thread
+
+def start_srtla(config):
+    srtla_thread = make_srtla(config)
     srtla_thread.daemon = True
     srtla_thread.start()
     return srtla_thread
@@ -5,9 +5,10 @@ from os import set_blocking, getpgid
 from datetime import datetime, timedelta
 from loguru import logger as logging
 from utils import ThreadManager, get_passphrase
+from stats_history import StatsHistory
 
 class SRTThread(ThreadManager):
-    def __init__(self, srt_destination, srt_source, stats_interval=100, update_interval=0.1, passphrase='', srt_live_transmit="srt-live-transmit", loss_max_ttl=50, srt_latency=2000):
+    def __init__(self, srt_destination, srt_source, stats_interval=100, update_interval=None, passphrase='', srt_live_transmit="srt-live-transmit", loss_max_ttl=50, srt_latency=2000, skip_to_latest=True, history_size=3000, restart_grace=5.0):
         """
         Wrapper thread to start/stop srt-live-transmit and get stats out of it.
         Source and destination as per documentation at: https://github.com/Haivision/srt/blob/master/docs/srt-live-transmit.md
@@ -15,11 +16,15 @@ class SRTThread(ThreadManager):
             srt_destination (str): Destination srt server to send to.
             srt_source (str): Port and protocol that srt-live-transmit listens on.
             stats_interval (int, optional): How often to update the SRT stats, in _packets_, not time. Defaults to 100.
-            update_interval (float, optional): How often to should read stats from the process, too often and it blocks the web thread, not often enough and output from the process gets blocked.. Defaults to 0.1.
+            update_interval (float, optional): Longest time, in seconds, to block waiting on the process before re-running the health checks.
+                None blocks until there's output, as stats and messages are read as soon as they arrive. Defaults to None.
             passphrase (str, optional): Passphrase to use for encryption. If this is blank, one will be generated and printed on the console.
             srt_live_transmit (Path, optional): Path to the srt-live-transmit binary. If none specified, will use whatever one is in your path. Defaults to "srt-live-transmit".
             loss_max_ttl (int, optional): Tolerance to packet re-ordering. Defaults to 50.
             srt_latency (int, optional): Maximum acceptable transmission latency. If we go past this, drop the packets. Defaults to 200.
+            skip_to_latest (bool, optional): Only decode the newest stats record of each burst read from the process. Defaults to True.
+            history_size (int, optional): How many stats samples to keep in the history ring buffer. Defaults to 3000.
+            restart_grace (float, optional): Seconds after a planned restart during which restarting is True, so the switcher doesn't go BRB for it. Defaults to 5.0.
         """
         super().__init__()
         self.stats_interval = stats_interval
@@ -30,6 +35,17 @@ class SRTThread(ThreadManager):
         self.name = "SLT"
         self.last_update = datetime.now()
         self.connected = False
+        # Consumers can wait on this to be woken as soon as new stats or a message arrive, instead of polling.
+        self.update_cond = threading.Condition()
+        self.update_count = 0
+        self.update_listeners = []
+        self.skip_to_latest = skip_to_latest
+        self.skipped_stats = 0
+        self.skipped_stats_total = 0
+        # Recent stats as a time series, so consumers don't each need to keep their own.
+        self.history = StatsHistory(history_size)
+        self.restart_grace = restart_grace
+        self.restart_grace_until = None
         # srt-live-transmit command variables
         self.srt_exec = srt_live_transmit
         self.loss_max_ttl = loss_max_ttl
@@ -46,6 +62,8 @@ class SRTThread(ThreadManager):
         """
         stats, msg = self.stats_parse()
         if stats:
+            for s in stats:
+                self.history.append(s)
             self.last_stats = stats[-1]
             self.last_update = datetime.now()
             logging.debug(f"SRT raw stats: {stats}")
@@ -57,12 +75,44 @@ class SRTThread(ThreadManager):
 
         # SRT connection and process health checks.
         self.check_is_connected()
+        if stats or msg:
+            self.publish_update()
         self.check_time_workaround()
 
     def run(self):
-        self.wait_interval = self.update_interval
+        # No sleep between iterations, get_raw_stats() blocks until there's output.
+        self.wait_interval = 0
         super().run()
 
+    def publish_update(self):
+        """
+        Wake up anything waiting in wait_for_update(), and call the update listeners.
+        """
+        with self.update_cond:
+            self.update_count += 1
+            self.update_cond.notify_all()
+        for callback in self.update_listeners:
+            callback()
+
+    def add_update_listener(self, callback):
+        """
+        Call callback() from this thread whenever there are new stats or a message. It needs to be quick, like setting an Event.
+        """
+        self.update_listeners += [callback]
+
+    def wait_for_update(self, last_count, timeout=None):
+        """
+        Block until there are stats or a message newer than last_count, or the timeout expires.
+        Args:
+            last_count (int): The update_count the caller last saw.
+            timeout (float, optional): Longest time to wait, in seconds. None waits forever. Defaults to None.
+        Returns:
+            int: The current update_count. If it's the same as last_count, the wait timed out.
+        """
+        with self.update_cond:
+            self.update_cond.wait_for(lambda: self.update_count != last_count, timeout)
+            return self.update_count
+
     def check_is_connected(self):
         """
         Track connection state, because the switcher uses it to determine health.
@@ -76,6 +126,13 @@ class SRTThread(ThreadManager):
             self.connected = True
             logging.warning(f"SRT: Source Connected.")
 
+    @property
+    def restarting(self):
+        """
+        True for restart_grace seconds after a planned restart, while the source reconnects.
+        """
+        return self.restart_grace_until is not None and datetime.now() < self.restart_grace_until
+
     def check_time_workaround(self):
         """
         This is a workaround for a clock drift (or something) but in srt-live-transmit.
@@ -84,32 +141,30 @@ class SRTThread(ThreadManager):
         """
         if "Wrong source time was provided" in self.last_message:
             logging.error(f"SRT Live Transmit source time error. Process started: {self.start_time}.")
-            self.restart_process()
-            logging.warning("SRT Live Transmit recovered from source time error.")
+            # Otherwise the old message triggers another restart straight away.
+            self.last_message = ''
+            self.restart_grace_until = datetime.now() + timedelta(seconds=self.restart_grace)
+            if self.request_restart():
+                logging.warning("SRT Live Transmit recovered from source time error.")
 
     def get_raw_stats(self):
         """
-        Get the raw stats from the SRT process.
+        Get the raw stats from the SRT process, blocking until there are some (or update_interval passes).
         Returns:
-            bytestring: Raw output strings from srt-live-transmit's stderr and stdout.
-        """
-        res = []
-        idx = 0
-        while True:
-            idx += 1
-            l = self.readline()
-            if l == b'':
-                break
-            res += [l]
-        return res
+            list: Raw output lines from srt-live-transmit's stderr and stdout.
+        """
+        return self.read_lines(self.update_interval)
 
     def stats_parse(self):
         """
         Parses a raw message from srt-live-transmit, into either a dict or a message.
+        With skip_to_latest, only the newest stats record in a burst is decoded, older ones are counted and dropped.
         Returns:
             tuple: message (empty if there isn't one, making this json only), dictionary (empty, otherwise decoded json).
         """
         raw_stats = self.get_raw_stats()
+        if self.skip_to_latest:
+            return self.stats_parse_latest(raw_stats)
         messages = []
         stats = []
         for line in raw_stats:
@@ -119,6 +174,36 @@ class SRTThread(ThreadManager):
                 messages += [line.decode('ASCII')]
         return stats, messages
 
+    def stats_parse_latest(self, raw_stats):
+        """
+        Scans the lines backwards, decoding only the newest stats record plus any messages.
+        When we fall behind, a burst can be hundreds of stats lines and only the last one is used anyway.
+        Args:
+            raw_stats (list): Raw output lines from srt-live-transmit.
+        Returns:
+            tuple: stats (list with at most the newest decoded json), messages (in the order they arrived).
+        """
+        messages = []
+        stats = []
+        skipped = 0
+        for line in reversed(raw_stats):
+            if line.startswith(b'{'):
+                if stats:
+                    skipped += 1
+                    continue
+                try:
+                    stats = [json.loads(line)]
+                    continue
+                except json.decoder.JSONDecodeError:
+                    pass
+            messages += [line.decode('ASCII')]
+        messages.reverse()
+        self.skipped_stats = skipped
+        if skipped:
+            self.skipped_stats_total += skipped
+            logging.info(f"SRT: Skipped {skipped} stale stats records, {self.skipped_stats_total} total.")
+        return stats, messages
+
 class SRTLAThread(ThreadManager):
     def __init__(self, srtla_rec="srtla_rec", source_port=4000, destination_host="localhost", destination_port=4001):
         super().__init__()
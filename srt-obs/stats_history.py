@@ -0,0 +1,155 @@
+import threading
+from time import monotonic
+
+import numpy as np
+
+
+class StatsHistory:
+    """
+    Fixed size ring buffer of srt-live-transmit stats, stored column-wise in a preallocated numpy array.
+    Appending is O(1) and never allocates, windowed queries are vectorized over the whole buffer.
+    Timestamps are time.monotonic() seconds, so windows aren't affected by the wall clock changing.
+
+    The field names map to the nested keys in srt-live-transmit's json stats. Missing values are stored as NaN and ignored by the queries.
+    """
+    fields = {
+        "rtt": ("link", "rtt"),
+        "bandwidth": ("link", "bandwidth"),
+        "send_mbitrate": ("send", "mbitRate"),
+        "recv_mbitrate": ("recv", "mbitRate"),
+        "flight": ("window", "flight"),
+        "flow": ("window", "flow"),
+        "congestion": ("window", "congestion"),
+        "send_dropped": ("send", "packetsDropped"),
+        "send_lost": ("send", "packetsLost"),
+        "send_retransmitted": ("send", "packetsRetransmitted"),
+        "send_ms_buf": ("send", "msBuf"),
+        "recv_dropped": ("recv", "packetsDropped"),
+        "recv_lost": ("recv", "packetsLost"),
+    }
+
+    def __init__(self, capacity=3000):
+        """
+        Args:
+            capacity (int, optional): How many samples to keep. At the default stats interval this is several minutes. Defaults to 3000.
+        """
+        self.capacity = capacity
+        self.columns = {name: idx + 1 for idx, name in enumerate(self.fields)}
+        # Column 0 is the timestamp.
+        self.data = np.full((capacity, len(self.fields) + 1), np.nan)
+        self.idx = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.count
+
+    def append(self, stats, timestamp=None):
+        """
+        Add a sample, overwriting the oldest one if the buffer is full.
+        Args:
+            stats (dict): Decoded json stats from srt-live-transmit.
+            timestamp (float, optional): time.monotonic() of the sample. Defaults to now.
+        """
+        with self.lock:
+            row = self.data[self.idx]
+            row[0] = monotonic() if timestamp is None else timestamp
+            for col, (section, key) in enumerate(self.fields.values(), start=1):
+                try:
+                    row[col] = stats[section][key]
+                except (KeyError, TypeError, ValueError):
+                    row[col] = np.nan
+            self.idx = (self.idx + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+
+    def clear(self):
+        with self.lock:
+            self.data.fill(np.nan)
+            self.idx = 0
+            self.count = 0
+
+    def window(self, field, seconds=None, now=None):
+        """
+        Get the samples of one field from the last few seconds.
+        Args:
+            field (str): Name of the field, one of StatsHistory.fields.
+            seconds (float, optional): How far back to look. None is the whole buffer. Defaults to None.
+            now (float, optional): time.monotonic() to measure the window back from. Defaults to now.
+        Returns:
+            tuple(np.ndarray, np.ndarray): (timestamps, values), copies, unordered and without missing values.
+        """
+        col = self.columns[field]
+        with self.lock:
+            filled = self.data[:self.count]
+            ts = filled[:, 0]
+            vals = filled[:, col]
+            mask = ~np.isnan(vals)
+            if seconds is not None:
+                now = monotonic() if now is None else now
+                mask &= ts >= now - seconds
+            return ts[mask], vals[mask]
+
+    def latest(self, field):
+        """
+        Returns:
+            float: The most recent value of the field, or None if there isn't one.
+        """
+        col = self.columns[field]
+        with self.lock:
+            if not self.count:
+                return None
+            val = self.data[(self.idx - 1) % self.capacity, col]
+        return None if np.isnan(val) else float(val)
+
+    def mean(self, field, seconds=None):
+        _, vals = self.window(field, seconds)
+        return float(vals.mean()) if vals.size else None
+
+    def percentile(self, field, q, seconds=None):
+        """
+        Args:
+            q (float): Percentile to get, 0-100. 95 is the p95.
+        """
+        _, vals = self.window(field, seconds)
+        return float(np.percentile(vals, q)) if vals.size else None
+
+    def min(self, field, seconds=None):
+        _, vals = self.window(field, seconds)
+        return float(vals.min()) if vals.size else None
+
+    def max(self, field, seconds=None):
+        _, vals = self.window(field, seconds)
+        return float(vals.max()) if vals.size else None
+
+    def rate(self, field, seconds=None):
+        """
+        Rate of change, per second, as the least squares slope over the window.
+        A fit is used instead of (last - first) so a single outlier at either end doesn't dominate.
+        Returns:
+            float: Change per second, or None if there are fewer than two samples.
+        """
+        ts, vals = self.window(field, seconds)
+        if vals.size < 2:
+            return None
+        dt = ts - ts.mean()
+        denom = np.dot(dt, dt)
+        if denom == 0:
+            return None
+        return float(np.dot(dt, vals - vals.mean()) / denom)
+
+    def summary(self, seconds=5, fields=("rtt", "send_mbitrate", "recv_mbitrate", "flight", "send_dropped")):
+        """
+        Convenience summary of a few fields, for logging or the API.
+        Returns:
+            dict: {field: {"mean", "p95", "min", "max", "rate"}} over the window.
+        """
+        return {
+            f: {
+                "mean": self.mean(f, seconds),
+                "p95": self.percentile(f, 95, seconds),
+                "min": self.min(f, seconds),
+                "max": self.max(f, seconds),
+                "rate": self.rate(f, seconds),
+            }
+            for f in fields
+        }
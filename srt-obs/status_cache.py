@@ -0,0 +1,94 @@
+import threading
+from time import monotonic
+
+
+class Flight:
+    """
+    One in progress fetch, that any number of requests can wait on.
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class CoalescingCache:
+    """
+    Caches one value for a short time, and coalesces concurrent fetches of it.
+    While the value is fresh it's returned as is. Once it's stale, the first caller fetches it again,
+    and everyone else that asks in the meantime waits for that one fetch instead of making their own.
+    """
+    def __init__(self, fetch, ttl=0.25):
+        """
+        Args:
+            fetch (callable): Gets a new value. Exceptions are passed on to every caller waiting on that fetch.
+            ttl (float, optional): How long a value stays fresh, in seconds. 0 disables caching, but fetches are still coalesced. Defaults to 0.25.
+        """
+        self.fetch = fetch
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.value = None
+        self.expires = 0
+        self.flight = None
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.errors = 0
+
+    def get(self):
+        with self.lock:
+            if self.value is not None and monotonic() < self.expires:
+                self.hits += 1
+                return self.value
+            flight = self.flight
+            if flight is None:
+                flight = self.flight = Flight()
+                leader = True
+                self.misses += 1
+            else:
+                leader = False
+                self.coalesced += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+        try:
+            flight.value = self.fetch()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                if flight.error is None:
+                    self.value = flight.value
+                    self.expires = monotonic() + self.ttl
+                else:
+                    self.errors += 1
+                self.flight = None
+            flight.done.set()
+        return flight.value
+
+    def invalidate(self):
+        """
+        Make the next get() fetch a new value, for when we know it's changed.
+        """
+        with self.lock:
+            self.value = None
+            self.expires = 0
+
+    def stats(self):
+        """
+        Returns:
+            dict: Hit/miss counters, for tuning the ttl.
+        """
+        with self.lock:
+            total = self.hits + self.misses + self.coalesced
+            return {
+                "ttl_ms": round(self.ttl * 1000),
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "errors": self.errors,
+                "hit_rate": round((self.hits + self.coalesced) / total, 3) if total else None,
+            }
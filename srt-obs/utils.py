@@ -1,5 +1,7 @@
 import os
 import secrets
+import selectors
+import signal
 import subprocess
 import sys
 import threading
@@ -66,6 +68,28 @@ def generate_api_key(cfg, key_len=32):
     return api_key
 
 
+class LocalState:
+    """
+    SharedState's get/put API on a plain dict, for when everything runs in one process.
+    """
+    def __init__(self):
+        self.state = {"scene_lock": False}
+
+    def get(self, dict_key, default=None, use_lock=True):
+        return self.state.get(dict_key, default)
+
+    def get_many(self, keys=None, use_lock=True):
+        if keys is None:
+            return dict(self.state)
+        return {k: self.state.get(k) for k in keys}
+
+    def put(self, dict_key, value, use_lock=True):
+        self.state[dict_key] = value
+
+    def put_many(self, values, use_lock=True):
+        self.state.update(values)
+
+
 class ThreadManager(threading.Thread):
     def __init__(self, name=""):
         super().__init__()
@@ -77,7 +101,22 @@ class ThreadManager(threading.Thread):
         self.event = threading.Event()
         self.wait_interval = 0.001
         self.cmd = ""
-        
+        self.read_size = 65536
+        self._selector = None
+        self._buffer = bytearray()
+        self._eof = False
+        # Crash handling: a process that exits by itself is restarted after backoff_base seconds, doubling with each crash
+        # up to backoff_max. Once one has run for stable_time, it's back to backoff_base.
+        self.backoff_base = 1.0
+        self.backoff_max = 30.0
+        self.stable_time = 60.0
+        self.kill_timeout = 2.0
+        self.crashes = 0
+        self.restarts = 0
+        self._restart_at = None
+        # When the process is read from an event loop, restart_process() would block it, so planned restarts are only flagged.
+        self.defer_restarts = False
+        self.restart_requested = False
 
     def start_process(self, blocking=False):
         """
@@ -87,8 +126,10 @@ class ThreadManager(threading.Thread):
             blocking (bool, optional): True if the processes output should be blocking, false otherwise. Defaults to False.
         """
         logging.info(f"{self.name}: Process starting with command: {self.cmd}.")
+        # exec, so the process waited on is the command itself and not the shell, and its own session, so its process group can be signalled
+        # without hitting this one (or gunicorn). Otherwise stopping it only stops the shell, and the command keeps running, holding its ports.
         self._process = subprocess.Popen(
-            f"{self.cmd}", shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+            f"exec {self.cmd}", shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, start_new_session=True
         )
         self._pid = self._process.pid
         self._pgid = os.getpgid(self._pid)
@@ -97,21 +138,89 @@ class ThreadManager(threading.Thread):
         )
         self.start_time = datetime.now()
         os.set_blocking(self._process.stdout.fileno(), blocking)
+        # A fresh selector and buffer per process, so a restart never reads a stale fd or a half line from the old one.
+        if self._selector is not None:
+            self._selector.close()
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._process.stdout, selectors.EVENT_READ)
+        self._buffer = bytearray()
+        self._eof = False
 
     def stop(self):
         """
         Stops the process and the run-loop.
         """
-        self.kill_process()
+        # Stop the loop first, so it doesn't see the process exit and restart it.
         self.event.set()
+        self.kill_process()
         logging.info(f"{self.name}: Process stopped.")
 
+    def signal_process(self, sig):
+        """
+        Send sig to the process's whole process group, so anything it started goes too.
+        """
+        try:
+            os.killpg(self._pgid, sig)
+        except ProcessLookupError:
+            # Already gone.
+            pass
+
     def kill_process(self):
         """
         Kills the process spawned.
         """
         logging.warning(f"{self.name}: Killing process with pid={self._pid}.")
-        self._process.terminate()
+        self.signal_process(signal.SIGTERM)
+
+    def stop_process(self):
+        """
+        Terminates the process and waits for it to exit, killing it if that takes longer than kill_timeout.
+        """
+        self.kill_process()
+        try:
+            self._process.wait(self.kill_timeout)
+        except subprocess.TimeoutExpired:
+            logging.error(f"{self.name}: Process pid={self._pid} didn't exit after {self.kill_timeout}s, killing it.")
+            self.signal_process(signal.SIGKILL)
+            self._process.wait()
+
+    @property
+    def process_running(self):
+        return self._process is not None and self._process.poll() is None
+
+    def crash_delay(self):
+        """
+        Counts a crash, and works out how long to wait before restarting.
+        Returns:
+            float: Seconds to wait before restarting the process.
+        """
+        uptime = (datetime.now() - self.start_time).total_seconds() if self.start_time else 0
+        if uptime >= self.stable_time:
+            self.crashes = 0
+        delay = min(self.backoff_base * 2 ** self.crashes, self.backoff_max)
+        self.crashes += 1
+        return delay
+
+    def supervise(self):
+        """
+        Restarts the process, with backoff, if it's exited by itself.
+        Returns:
+            bool: True if the process is running.
+        """
+        if self.process_running:
+            return True
+        if self._restart_at is None:
+            delay = self.crash_delay()
+            logging.error(f"{self.name}: Process exited with code {self._process.returncode}, restarting in {delay}s. Crash count: {self.crashes}.")
+            self._restart_at = time.monotonic() + delay
+        remaining = self._restart_at - time.monotonic()
+        if remaining > 0:
+            self.event.wait(remaining)
+            return False
+        self._restart_at = None
+        self.restarts += 1
+        self.start_process()
+        return True
 
     def run(self):
         """
@@ -120,35 +229,90 @@ class ThreadManager(threading.Thread):
         """
         logging.warning(f"{self.name}: run thread started.")
         while not self.event.is_set():
-            self.run_inner()
+            if self.supervise():
+                self.run_inner()
             self.event.wait(self.wait_interval)
 
-    def restart_process(self, wait_time=1.0):
+    def restart_process(self, wait_time=0.0):
         """
-        Restarts a process. The wait_time parameter is useful if there's an issue restarting a process immediately after it's killed.
+        Restarts a process. The new one is started as soon as the old one has exited.
         Args:
-            wait_time (float, optional): Time, in seconds, to wait before the process restarts. Defaults to 1.0.
+            wait_time (float, optional): Time, in seconds, to wait before the process restarts, if there's an issue restarting it immediately. Defaults to 0.0.
         """
-        logging.warning(f"{self.name}: Process restarted.")
-        self.kill_process()
-        self.tsleep(wait_time)
+        logging.warning(f"{self.name}: Process restarting.")
+        self.stop_process()
+        if wait_time:
+            self.tsleep(wait_time)
         self.start_process()
+        self.restarts += 1
+        logging.warning(f"{self.name}: Process restarted.")
+
+    def request_restart(self):
+        """
+        Restart the process now, or if defer_restarts is set, flag it for whatever is reading the process to do.
+        Returns:
+            bool: True if it was restarted now.
+        """
+        if self.defer_restarts:
+            self.restart_requested = True
+            return False
+        self.restart_process()
+        return True
 
     def tsleep(self, t):
         """
-        Thread-aware sleep for t seconds.
+        Thread-aware sleep for t seconds, cut short if the thread is stopped.
         Args:
             t (float): Time to sleep, in seconds.
         """
         logging.debug(f"{self.name}: tsleep for {t}s.")
-        threading.Timer(t, self.tsleep, kwargs={"t": t}).start()
-        time.sleep(t)
+        self.event.wait(t)
 
     def run_inner():
         logging.error(f"Override run_inner() in subclass.")
 
+    @property
+    def stdout_fd(self):
+        return self._process.stdout.fileno()
+
+    @property
+    def output_closed(self):
+        """
+        True once read_lines() has seen the process's output close.
+        """
+        return self._eof
+
     def read(self):
         return self._process.stdout.read()
 
     def readline(self):
         return self._process.stdout.readline()
+
+    def read_lines(self, timeout=None):
+        """
+        Block until the process writes something, and return any complete lines.
+        Reads go straight to the fd into a reusable buffer, partial lines are kept until the rest arrives.
+        Don't mix this with read()/readline(), which go through the file object's own buffer.
+        Args:
+            timeout (float, optional): Longest time to block for, in seconds. None blocks until there is output. Defaults to None.
+        Returns:
+            list: Complete lines (bytearray) without line endings. Empty on timeout, or if the process has exited.
+        """
+        if self._eof:
+            # The pipe stays readable at EOF, so don't spin on it. The process is restarted once it's exited.
+            self.event.wait(0.1 if timeout is None else min(timeout, 0.1))
+            return []
+        if not self._selector.select(timeout):
+            return []
+        chunk = os.read(self._process.stdout.fileno(), self.read_size)
+        if not chunk:
+            logging.error(f"{self.name}: Process output closed, pid={self._pid}.")
+            self._eof = True
+            return []
+        self._buffer += chunk
+        end = self._buffer.rfind(b"\n")
+        if end == -1:
+            return []
+        lines = [x for x in self._buffer[:end].splitlines() if x.strip()]
+        del self._buffer[:end + 1]
+        return lines